@@ -0,0 +1,172 @@
+"""
+Context building for the analysis endpoints (/api/analyze_interactions and
+/api/analysis_chat). Loads every selected interaction, with its patient and
+messages, in a single query and formats the transcripts sent to the model.
+"""
+
+import os
+import json
+
+from sqlalchemy.orm import Session
+
+from database import Patient, Interaction, Message
+from summary_cache import messages_hash
+
+
+class AnalysisContextBuilder:
+    def __init__(self, db: Session, dialogos_dir=None):
+        self.db = db
+        # Optional fallback for interactions that only exist as JSON files
+        self.dialogos_dir = dialogos_dir
+
+    def load(self, filenames):
+        """
+        Returns the selected interactions in the requested order as dicts with
+        id, filename, timestamp, patient_name, config and messages.
+        One query for the whole selection: interaction, patient and message
+        columns come back as joined rows.
+        """
+        if not filenames:
+            return []
+
+        rows = self.db.query(
+            Interaction.id,
+            Interaction.filename,
+            Interaction.timestamp,
+            Interaction.chatbot_model,
+            Interaction.patient_model,
+            Interaction.patient_system_prompt,
+            Patient.nombre.label('patient_name'),
+            Message.role,
+            Message.content,
+        ).outerjoin(Patient, Interaction.patient_id == Patient.id).outerjoin(
+            Message, Message.interaction_id == Interaction.id
+        ).filter(
+            Interaction.filename.in_(filenames)
+        ).order_by(Interaction.id, Message.order).all()
+
+        found = {}
+        for row in rows:
+            item = found.get(row.filename)
+            if item is None:
+                item = found[row.filename] = {
+                    'id': row.id,
+                    'filename': row.filename,
+                    'timestamp': row.timestamp.isoformat() if row.timestamp else 'Unknown',
+                    'patient_name': row.patient_name or 'Unknown',
+                    'config': {
+                        'chatbot_model': row.chatbot_model,
+                        'patient_model': row.patient_model,
+                        'patient_system_prompt': row.patient_system_prompt,
+                        'patient_name': row.patient_name,
+                    },
+                    'messages': [],
+                }
+            if row.role is not None:
+                item['messages'].append({'role': row.role, 'content': row.content})
+
+        interactions = []
+        for fname in dict.fromkeys(filenames):
+            item = found.get(fname) or self._load_from_disk(fname)
+            if item:
+                interactions.append(item)
+            else:
+                print(f"Warning: Interaction {fname} not found in DB or disk.")
+        return interactions
+
+    def _load_from_disk(self, fname):
+        if not self.dialogos_dir:
+            return None
+        fpath = os.path.join(self.dialogos_dir, fname)
+        if not os.path.exists(fpath):
+            return None
+        try:
+            with open(fpath, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+        except Exception as e:
+            print(f"Error reading interaction file {fname}: {e}")
+            return None
+        config = data.get('config', {})
+        return {
+            'id': None,
+            'filename': fname,
+            'timestamp': data.get('timestamp', 'Unknown'),
+            'patient_name': config.get('patient_name') or 'Unknown',
+            'config': config,
+            'messages': data.get('messages', []),
+        }
+
+    @staticmethod
+    def format_transcript(interaction):
+        """Conversation as ROLE: content lines"""
+        return "".join(
+            f"{msg.get('role', 'unknown').upper()}: {msg.get('content', '')}\n"
+            for msg in interaction['messages']
+        )
+
+    @staticmethod
+    def format_analysis_header(interaction):
+        return f"--- Interaction Date: {interaction['timestamp']} | Patient: {interaction['patient_name']} ---\n"
+
+    @staticmethod
+    def format_analysis_text(interaction):
+        return (
+            AnalysisContextBuilder.format_analysis_header(interaction)
+            + AnalysisContextBuilder.format_transcript(interaction)
+        )
+
+    def analysis_parts(self, interactions):
+        """
+        Context parts for DualLLMOrchestrator.summarize_parts / analyze_interactions.
+        Interactions stored in the database carry a summary_key so their
+        summaries are cached per header and message set (a metadata edit such
+        as a patient rename changes the header the summary was made from).
+        """
+        return [
+            {
+                "text": self.format_analysis_text(interaction),
+                "summary_key": (
+                    interaction['id'], messages_hash(interaction['messages'], self.format_analysis_header(interaction))
+                ) if interaction['id'] else None,
+            }
+            for interaction in interactions
+        ]
+
+    def build_analysis_context(self, filenames):
+        """
+        Context parts for /api/analyze_interactions plus the metadata returned
+        with the analysis (patient models and prompts in the selection).
+        """
+        interactions = self.load(filenames)
+        patient_models = set()
+        patient_prompts = set()
+        for interaction in interactions:
+            config = interaction['config']
+            if config.get('patient_model'):
+                patient_models.add(config['patient_model'])
+            if config.get('patient_system_prompt'):
+                patient_prompts.add(config['patient_system_prompt'])
+        return {
+            "interactions": interactions,
+            "parts": self.analysis_parts(interactions),
+            "patient_models": patient_models,
+            "patient_prompts": patient_prompts,
+        }
+
+    @staticmethod
+    def format_chat_context(interactions, summaries=None):
+        """
+        Context for /api/analysis_chat, headed by filename: full transcripts, or
+        the given per-interaction summaries.
+        """
+        text = ""
+        for index, interaction in enumerate(interactions):
+            text += (
+                f"\n--- Interaction: {interaction['filename']} "
+                f"({interaction['timestamp']}, Patient: {interaction['patient_name']}) ---\n"
+            )
+            if summaries is not None:
+                text += f"[Resumen] {summaries[index]}\n"
+            else:
+                text += AnalysisContextBuilder.format_transcript(interaction)
+        return text
@@ -0,0 +1,191 @@
+"""
+Concurrent batch simulation of autonomous interactions.
+Runs N patient profiles x M prompt configurations in a thread pool, with a bounded
+number of simultaneous LLM calls per model (sentiment scoring included), and saves each
+interaction as soon as it finishes.
+"""
+
+import os
+import json
+import uuid
+import threading
+import traceback
+from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor
+
+import db_helpers
+from orchestrator import validate_sentiment_mode
+
+DEFAULT_MAX_WORKERS = int(os.getenv("SIM_MAX_WORKERS", "8"))
+DEFAULT_MAX_CONCURRENCY_PER_MODEL = int(os.getenv("SIM_MAX_CONCURRENCY_PER_MODEL", "2"))
+# Finished batches (and their per-job results) stay pollable for a while, then are dropped
+FINISHED_BATCH_TTL_SECONDS = float(os.getenv("SIM_FINISHED_BATCH_TTL", "3600"))
+MAX_FINISHED_BATCHES = int(os.getenv("SIM_MAX_FINISHED_BATCHES", "50"))
+
+
+def build_simulation_record(patient_profile, config, messages, timestamp=None):
+    """
+    Builds the interaction data saved for an autonomous simulation
+    (same shape as /api/save_interaction).
+    """
+    timestamp = timestamp or datetime.now()
+    return {
+        "timestamp": timestamp.isoformat(),
+        "config": {
+            "chatbot_model": config["chatbot_model"],
+            "patient_model": config["patient_model"],
+            "psychologist_system_prompt": config["psychologist_system_prompt"],
+            "patient_system_prompt": config["patient_system_prompt"],
+            "patient_name": patient_profile.get('nombre', 'Unknown'),
+            "mode": "autonomous",
+            # Pass params so they get saved to DB columns too
+            "psychologist_temperature": config.get("psychologist_temperature"),
+            "patient_temperature": config.get("patient_temperature"),
+        },
+        "messages": messages
+    }
+
+
+class BatchSimulation:
+    """Progress and results of one batch (kept in memory)"""
+
+    def __init__(self, jobs):
+        self.id = uuid.uuid4().hex
+        self.jobs = jobs
+        self.status = "queued"
+        self.completed = 0
+        self.failed = 0
+        self.results = []
+        self.started_at = None
+        self.finished_at = None
+        self.lock = threading.Lock()
+
+    def to_dict(self):
+        with self.lock:
+            return {
+                "batch_id": self.id,
+                "status": self.status,
+                "total": len(self.jobs),
+                "completed": self.completed,
+                "failed": self.failed,
+                "started_at": self.started_at.isoformat() if self.started_at else None,
+                "finished_at": self.finished_at.isoformat() if self.finished_at else None,
+                "results": list(self.results),
+            }
+
+
+class BatchSimulator:
+    def __init__(self, orchestrator, session_factory, dialogos_dir=None, max_workers=None):
+        self.orchestrator = orchestrator
+        self.session_factory = session_factory
+        self.dialogos_dir = dialogos_dir
+        self.max_workers = max_workers or DEFAULT_MAX_WORKERS
+        self.batches = {}
+        self._batches_lock = threading.Lock()
+        # SQLite allows a single writer: saves are serialized
+        self._save_lock = threading.Lock()
+
+    @staticmethod
+    def expand_jobs(patients, configs):
+        """Cartesian product of patients (profile + patient prompt) and prompt configurations."""
+        jobs = []
+        for patient in patients:
+            for config in configs:
+                job_config = dict(config)
+                job_config["patient_system_prompt"] = patient["patient_system_prompt"]
+                jobs.append({"patient_profile": patient["patient_profile"], "config": job_config})
+        return jobs
+
+    def submit(self, jobs, turns=10, max_concurrency_per_model=None, sentiment_mode="background"):
+        """Starts a batch in the background and returns it immediately."""
+        sentiment_mode = sentiment_mode or "background"
+        validate_sentiment_mode(sentiment_mode)
+        batch = BatchSimulation(jobs)
+        with self._batches_lock:
+            self._evict_finished()
+            self.batches[batch.id] = batch
+        limit = max_concurrency_per_model or DEFAULT_MAX_CONCURRENCY_PER_MODEL
+        threading.Thread(target=self._run_batch, args=(batch, turns, limit, sentiment_mode), daemon=True).start()
+        return batch
+
+    def get(self, batch_id):
+        with self._batches_lock:
+            self._evict_finished()
+            return self.batches.get(batch_id)
+
+    def _evict_finished(self):
+        """Drops finished batches older than the TTL, and the oldest beyond MAX_FINISHED_BATCHES."""
+        expiry = datetime.now() - timedelta(seconds=FINISHED_BATCH_TTL_SECONDS)
+        finished = sorted(
+            (batch for batch in self.batches.values() if batch.finished_at),
+            key=lambda batch: batch.finished_at
+        )
+        for position, batch in enumerate(finished):
+            if batch.finished_at < expiry or position < len(finished) - MAX_FINISHED_BATCHES:
+                del self.batches[batch.id]
+
+    def _run_batch(self, batch, turns, limit, sentiment_mode):
+        with batch.lock:
+            batch.status = "running"
+            batch.started_at = datetime.now()
+
+        models = {job["config"][key] for job in batch.jobs for key in ("chatbot_model", "patient_model")}
+        semaphores = {model: threading.BoundedSemaphore(limit) for model in models}
+
+        print(f"--- Batch {batch.id}: {len(batch.jobs)} simulations, {limit} per model ---")
+        with ThreadPoolExecutor(max_workers=max(1, min(self.max_workers, len(batch.jobs)))) as executor:
+            for index, job in enumerate(batch.jobs):
+                executor.submit(self._run_job, batch, index, job, turns, semaphores, sentiment_mode)
+
+        with batch.lock:
+            batch.status = "finished"
+            batch.finished_at = datetime.now()
+        print(f"--- Batch {batch.id} finished: {batch.completed} ok, {batch.failed} failed ---")
+
+    def _run_job(self, batch, index, job, turns, semaphores, sentiment_mode):
+        profile = job["patient_profile"]
+        config = job["config"]
+        result = {"index": index, "patient_name": profile.get("nombre", "Unknown"), "chatbot_model": config["chatbot_model"]}
+        try:
+            # Every LLM call of the simulation (background sentiment included) holds a slot
+            # on its model only for the duration of the call, so no call waits on another slot
+            messages = self.orchestrator.simulate_interaction(
+                config["chatbot_model"],
+                config["patient_model"],
+                config["psychologist_system_prompt"],
+                config["patient_system_prompt"],
+                turns=turns,
+                psychologist_temperature=config.get("psychologist_temperature", 0.7),
+                patient_temperature=config.get("patient_temperature", 0.7),
+                sentiment_mode=sentiment_mode,
+                model_slot=semaphores.__getitem__
+            )
+
+            result["filename"] = self._save(profile, config, messages)
+            result["status"] = "success"
+            with batch.lock:
+                batch.completed += 1
+                batch.results.append(result)
+        except Exception as e:
+            print(f"Error in batch simulation {index} ({result['patient_name']}): {e}")
+            traceback.print_exc()
+            result["status"] = "error"
+            result["error"] = str(e)
+            with batch.lock:
+                batch.failed += 1
+                batch.results.append(result)
+
+    def _save(self, profile, config, messages):
+        with self._save_lock:
+            data = build_simulation_record(profile, config, messages)
+            db = self.session_factory()
+            try:
+                saved_filename = db_helpers.save_interaction(db, data)['filename']
+            finally:
+                db.close()
+
+            if self.dialogos_dir:
+                filepath = os.path.join(self.dialogos_dir, saved_filename)
+                with open(filepath, 'w', encoding='utf-8') as f:
+                    json.dump(data, f, indent=4, ensure_ascii=False)
+        return saved_filename
@@ -0,0 +1,102 @@
+"""
+Benchmark for document chunking (chunking.py) on synthetic markdown documents.
+Measures the native .txt/.md path with a reused Chunker, the same path with a fresh
+Chunker per document (tokenizer loaded every time, as the old per-document HybridChunker
+did), and, when docling is installed, docling conversion + HybridChunker on the same files.
+Also checks that chunks respect chunk_size and carry the requested overlap.
+
+Usage: python bench_chunking.py [num_documents] [paragraphs_per_document] [chunk_size] [overlap]
+       add --approx-tokens to count tokens as chars/3 when the HF tokenizer is not available
+"""
+import os
+import sys
+import time
+import random
+import tempfile
+
+from chunking import Chunker, read_text
+
+WORDS = (
+    "paciente ansiedad sueño familia trabajo tratamiento sesión emoción miedo tristeza terapia "
+    "recaída tacrolimus micofenolato adherencia trasplante dosis control síntomas apoyo"
+).split()
+
+
+def make_documents(directory, num_documents, paragraphs):
+    random.seed(0)
+    paths = []
+    for d in range(num_documents):
+        lines = [f"# Guía clínica {d}"]
+        for p in range(paragraphs):
+            if p % 8 == 0:
+                lines.append(f"## Sección {p // 8}")
+            sentences = [
+                " ".join(random.choice(WORDS) for _ in range(random.randint(6, 25))).capitalize() + "."
+                for _ in range(random.randint(2, 6))
+            ]
+            lines.append(" ".join(sentences))
+        path = os.path.join(directory, f"guia_{d}.md")
+        with open(path, "w", encoding="utf-8") as f:
+            f.write("\n\n".join(lines))
+        paths.append(path)
+    return paths
+
+
+def run(label, paths, chunk, chunk_size, overlap):
+    start = time.perf_counter()
+    results = [chunk(path) for path in paths]
+    elapsed = time.perf_counter() - start
+    chars = sum(os.path.getsize(path) for path in paths)
+    chunks = sum(len(r) for r in results)
+    print(f"{label:<38} {elapsed:8.2f}s  {chars / elapsed / 1e6:7.2f} MB/s  {chunks / elapsed:9.0f} chunks/s  ({chunks} chunks)")
+    return results
+
+
+def check(chunker, results, chunk_size, overlap):
+    sizes = [chunker.count_tokens(c) for r in results for c in r]
+    with_overlap = sum(
+        1 for r in results for previous, current in zip(r, r[1:])
+        if current.split()[0] in previous.split()[-max(1, overlap):]
+    )
+    pairs = sum(max(0, len(r) - 1) for r in results)
+    print(f"chunk tokens: max {max(sizes)} (limit {chunk_size}), mean {sum(sizes) / len(sizes):.0f}; "
+          f"chunks starting with the previous chunk's tail: {with_overlap}/{pairs}")
+
+
+def main():
+    args = [a for a in sys.argv[1:] if not a.startswith("--")]
+    approx = "--approx-tokens" in sys.argv
+    num_documents = int(args[0]) if len(args) > 0 else 50
+    paragraphs = int(args[1]) if len(args) > 1 else 200
+    chunk_size = int(args[2]) if len(args) > 2 else 256
+    overlap = int(args[3]) if len(args) > 3 else 32
+
+    count_tokens = (lambda text: len(text) // 3 + 1) if approx else None
+    with tempfile.TemporaryDirectory() as directory:
+        paths = make_documents(directory, num_documents, paragraphs)
+        print(f"{num_documents} documents x {paragraphs} paragraphs, chunk_size={chunk_size}, overlap={overlap}"
+              f"{' (approximate token counts)' if approx else ''}")
+
+        chunker = Chunker(count_tokens=count_tokens)
+        chunker.count_tokens("warm-up")
+        results = run("native, reused Chunker", paths,
+                      lambda path: chunker.chunk_text(read_text(path), chunk_size, overlap), chunk_size, overlap)
+        run("native, new Chunker per document", paths[:max(1, len(paths) // 5)],
+            lambda path: Chunker(count_tokens=count_tokens).chunk_text(read_text(path), chunk_size, overlap),
+            chunk_size, overlap)
+
+        try:
+            from docling.document_converter import DocumentConverter
+        except ImportError:
+            print("docling not installed: skipping the docling + HybridChunker comparison")
+        else:
+            converter = DocumentConverter()
+            run("docling conversion + HybridChunker", paths,
+                lambda path: chunker.chunk_document(converter.convert(path).document, chunk_size, overlap),
+                chunk_size, overlap)
+
+        check(chunker, results, chunk_size, overlap)
+
+
+if __name__ == "__main__":
+    main()
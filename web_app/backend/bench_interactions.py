@@ -0,0 +1,124 @@
+"""
+Benchmark for the interaction listing/detail paths on a synthetic archive.
+Uses a temporary SQLite database (the real chatbot.db is never touched) and
+counts the SQL statements each helper issues.
+
+Usage: python bench_interactions.py [num_interactions] [messages_per_interaction]
+"""
+import os
+import sys
+import time
+import tempfile
+from datetime import datetime, timedelta
+
+from sqlalchemy import create_engine, event
+from sqlalchemy.orm import sessionmaker
+
+from database import Base, Patient, Interaction, Message
+from analysis_context import AnalysisContextBuilder
+import db_helpers
+
+
+def seed(db, num_interactions, messages_per_interaction, num_patients=50):
+    patients = [Patient(id=f"paciente_{i}", nombre=f"Paciente {i}") for i in range(num_patients)]
+    db.add_all(patients)
+    db.flush()
+    start = datetime(2025, 1, 1)
+    for i in range(num_interactions):
+        interaction = Interaction(
+            timestamp=start + timedelta(minutes=i),
+            patient_id=patients[i % num_patients].id,
+            chatbot_model="mental_llama3.1-8b-mix-sft" if i % 2 else "deepseek-r1",
+            patient_model="openai/gpt-oss-20b",
+            filename=f"interaction_bench_{i:06d}.json",
+        )
+        interaction.messages = [
+            Message(order=j, role="user" if j % 2 else "assistant", content=f"Mensaje {j} de la sesión {i}")
+            for j in range(messages_per_interaction)
+        ]
+        db.add(interaction)
+    db.commit()
+
+
+class QueryCounter:
+    def __init__(self, engine):
+        self.count = 0
+        event.listen(engine, "before_cursor_execute", self._on_execute)
+
+    def _on_execute(self, *args, **kwargs):
+        self.count += 1
+
+
+def measure(label, counter, fn):
+    counter.count = 0
+    started = time.perf_counter()
+    result = fn()
+    elapsed = (time.perf_counter() - started) * 1000
+    rows = result["items"] if isinstance(result, dict) else result
+    size = len(rows) if hasattr(rows, "__len__") else "-"
+    print(f"{label:<45} {counter.count:>6} queries {elapsed:>9.1f} ms  (rows: {size})")
+    return result
+
+
+def legacy_chat_context(db, filenames):
+    """Previous /api/analysis_chat loop: full listing per selected interaction to find its filename."""
+    headers = []
+    for data in db_helpers.get_interactions_by_filenames(db, filenames):
+        all_ints = db_helpers.get_all_interactions(db)
+        filename = next((i['filename'] for i in all_ints if i['timestamp'] == data['timestamp']), 'unknown')
+        headers.append(f"--- Interaction: {filename} ---")
+    return headers
+
+
+def main():
+    num_interactions = int(sys.argv[1]) if len(sys.argv) > 1 else 3000
+    messages_per_interaction = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+
+    tmpdir = tempfile.mkdtemp()
+    engine = create_engine(f"sqlite:///{os.path.join(tmpdir, 'bench.db')}")
+    Base.metadata.create_all(bind=engine)
+    db = sessionmaker(bind=engine)()
+
+    print(f"Seeding {num_interactions} interactions x {messages_per_interaction} messages...")
+    seed(db, num_interactions, messages_per_interaction)
+    db.expire_all()
+
+    counter = QueryCounter(engine)
+    all_filenames = [f"interaction_bench_{i:06d}.json" for i in range(num_interactions)]
+
+    measure("get_all_interactions (sidebar load)", counter, lambda: db_helpers.get_all_interactions(db))
+
+    first_page = measure("get_interactions_page (first 50)", counter,
+                         lambda: db_helpers.get_interactions_page(db, limit=50))
+    middle = num_interactions // 2
+    middle_cursor = db_helpers.encode_interaction_cursor(datetime(2025, 1, 1) + timedelta(minutes=middle), middle + 1)
+    measure("get_interactions_page (deep page, 50)", counter,
+            lambda: db_helpers.get_interactions_page(db, limit=50, cursor=middle_cursor))
+    measure("get_interactions_page (patient filter, 50)", counter,
+            lambda: db_helpers.get_interactions_page(db, limit=50, patient_id="paciente_7"))
+    measure("get_interactions_page (model + date range)", counter,
+            lambda: db_helpers.get_interactions_page(db, limit=50, chatbot_model="deepseek-r1",
+                                                     date_from=datetime(2025, 1, 1), date_to=datetime(2025, 1, 2)))
+    assert first_page["next_cursor"] is not None or num_interactions <= 50
+    for selection in (1, 10, 100):
+        db.expire_all()
+        measure(f"get_interactions_by_filenames ({selection})", counter,
+                lambda: db_helpers.get_interactions_by_filenames(db, all_filenames[:selection]))
+    builder = AnalysisContextBuilder(db)
+    for selection in (1, 10, 100, 1000):
+        selected = all_filenames[:selection]
+        if selection <= 100:
+            db.expire_all()
+            measure(f"analysis_chat context, legacy ({selection})", counter,
+                    lambda: legacy_chat_context(db, selected))
+        db.expire_all()
+        measure(f"AnalysisContextBuilder.load ({selection})", counter, lambda: builder.load(selected))
+    db.expire_all()
+    measure("search_interactions_by_patient", counter,
+            lambda: db_helpers.search_interactions_by_patient(db, "paciente_0"))
+
+    db.close()
+
+
+if __name__ == "__main__":
+    main()
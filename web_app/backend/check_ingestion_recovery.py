@@ -0,0 +1,106 @@
+"""
+Recovery check for IngestionPipeline when a conversion worker dies.
+
+A fake process pool completes the conversion of some documents and then breaks
+(as ProcessPoolExecutor does when a worker is killed, e.g. out of memory): the
+document that was running fails with BrokenProcessPool and every later submit on
+that pool raises it. It checks that:
+  1. only the document whose worker died is reported as an error
+  2. documents already converted are chunked on a fresh pool and stored
+  3. the broken pool is replaced exactly once
+"""
+from concurrent.futures import Future
+from concurrent.futures.process import BrokenProcessPool
+
+from ingestion import IngestionPipeline, convert_file
+
+
+class FakePool:
+    """Runs tasks inline; a task for `kill` breaks the pool like a dead worker."""
+
+    def __init__(self, kill=None):
+        self.kill = kill
+        self.broken = False
+
+    def submit(self, fn, filepath, *args):
+        if self.broken:
+            raise BrokenProcessPool("A child process terminated abruptly, the process pool is not usable anymore")
+        future = Future()
+        if filepath == self.kill:
+            self.broken = True
+            future.set_exception(BrokenProcessPool("A process in the process pool was terminated abruptly"))
+        elif fn is convert_file:
+            future.set_result(f"hash-{filepath}")
+        else:
+            future.set_result([f"texto de {filepath}"])
+        return future
+
+    def shutdown(self, wait=True, cancel_futures=False):
+        pass
+
+
+class FakeStore:
+    """Stands in for the Chroma collection, BM25 index and query cache of a RAGManager."""
+
+    def __init__(self):
+        self.ids = []
+
+    def add(self, ids, *args, **kwargs):
+        self.ids.extend(ids)
+
+    def delete(self, *args, **kwargs):
+        pass
+
+    def delete_filenames(self, filenames):
+        pass
+
+    def invalidate_filenames(self, filenames):
+        pass
+
+
+class FakeRAG:
+    def __init__(self):
+        self.conversions = type("Conversions", (), {"cache_dir": "/tmp/unused"})()
+        self.embedding_function = lambda texts: [[0.0] for _ in texts]
+        self.collection = FakeStore()
+        self.lexical_index = FakeStore()
+        self.query_cache = FakeStore()
+
+
+def run_checks():
+    rag = FakeRAG()
+    pipeline = IngestionPipeline(rag, workers=2, embed_batch_size=1)
+    pools = [FakePool(kill="c.pdf")]
+    pipeline._executor = pools[0]
+
+    def fresh_pool():
+        if pipeline._executor is None:
+            pools.append(FakePool())
+            pipeline._executor = pools[-1]
+        return pipeline._executor
+
+    pipeline._get_executor = fresh_pool
+    states = []
+    files = [("a.pdf", "a.pdf"), ("b.pdf", "b.pdf"), ("c.pdf", "c.pdf")]
+    report = pipeline.ingest(files, on_stage=lambda filename, state, **info: states.append((filename, state)))
+
+    problems = []
+    statuses = {entry["filename"]: entry["status"] for entry in report}
+    if statuses != {"a.pdf": "success", "b.pdf": "success", "c.pdf": "error"}:
+        problems.append(f"statuses {statuses}")
+    if sorted(rag.collection.ids) != ["a.pdf_0", "b.pdf_0"]:
+        problems.append(f"stored chunks {rag.collection.ids}")
+    if len(pools) != 2:
+        problems.append(f"{len(pools)} pools created, expected the broken one to be replaced once")
+    if ("c.pdf", "failed") not in states:
+        problems.append("no failed notification for c.pdf")
+
+    if problems:
+        print("❌ worker killed after other conversions finished: " + "; ".join(problems))
+        return False
+    print("✅ worker killed after other conversions finished")
+    return True
+
+
+if __name__ == "__main__":
+    raise SystemExit(0 if run_checks() else 1)
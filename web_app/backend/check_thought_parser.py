@@ -0,0 +1,103 @@
+"""
+Fixture corpus for the streaming thought/response parser.
+
+For every model family handled in DualLLMOrchestrator._optimize_system_prompt it checks,
+under several chunkings of the stream, that the thought and content rebuilt from the
+events emitted by ThoughtStreamParser:
+  1. match the blocking parser (_extract_thought_and_response) for well-formed outputs
+  2. do not depend on the chunking (same result as the whole completion in one chunk)
+  3. never leak reasoning into the patient-facing stream
+"""
+from orchestrator import DualLLMOrchestrator
+from thought_parser import ThoughtStreamParser
+
+# (family, description, raw completion, streamed buffers must equal the final result)
+FIXTURES = [
+    # TIPO 1: llama / mix / deepseek / qwen / mental -> <think> XML
+    ("llama", "think block", "<think>\nEl paciente muestra baja motivación por cansancio.\n</think>\nEntiendo que estés cansado, es normal.", True),
+    ("mental", "think block, no newline", "<think>COM-B: oportunidad reducida.</think>¿Probamos una alarma en el celular?", True),
+    ("deepseek", "missing opening tag", "Analizo la adherencia del paciente.\n</think>\n\nMe alegra que hayas tomado la medicación.", True),
+    ("qwen", "unclosed think (cut off)", "<think>\nEl paciente está frustrado con los horarios y", True),
+    # Header fallback after an empty think block: streamed as content, reclassified at the end
+    ("mix", "empty spaced think, then header", "< think ></ think >Pensamiento: revisar horarios.\n\nContame cómo te fue hoy.", True),
+    ("llama", "empty think, then header", "<think></think>Thought: revisar horarios.\n\nContame cómo te fue hoy.", True),
+    ("mix", "think with spaces and case", "< Think >Validar emoción primero.</ THINK >Qué bueno que me lo cuentes.", True),
+    ("llama", "html-escaped tags", "&lt;think&gt;Razonamiento&lt;/think&gt;Hola, ¿cómo seguís?", True),
+    ("qwen", "empty answer after thought", "<think>Solo pensamiento, sin respuesta.</think>", True),
+    # TIPO 2: gpt / openai -> Thought:/Response: headers and harmony channels
+    ("gpt", "thought/response headers", "Thought:\nEl paciente evita hablar de la medicación.\n\nResponse:\nContame un poco más sobre tu día.", True),
+    ("gpt", "spanish headers", "Pensamiento: debo reforzar la autoeficacia.\nRespuesta: ¡Muy bien hecho hoy!", True),
+    ("gpt", "header without response marker", "Thought: analizar barreras\n\nHola, ¿cómo te fue con las pastillas?", False),
+    # The blocking parser keeps harmony 'analysis' text in the content; the stream hides it and
+    # the final 'done' event still carries the blocking result
+    ("gpt-oss", "harmony channels", "<|channel|>analysis<|message|>Need empathic reply.<|end|><|start|>assistant<|channel|>final<|message|>Hola, ¿cómo te sentís hoy?", False),
+    ("gpt", "plain answer", "Hola doctor, hoy me olvidé la pastilla de la mañana.", True),
+    # TIPO 3: mistral / mixtral / gemma -> short <think>
+    ("mistral", "short think", "<think> Breve: validar. </think> Te entiendo, sigamos así.", True),
+    ("gemma", "thought tags", "<thought>Paciente hostil.</thought>Entiendo tu enojo.", True),
+    ("mixtral", "unclosed thought tag", "Hola.<thought>Esto quedó abierto", True),
+    # DEFAULT: generic models
+    ("phi", "reasoning tags", "<reasoning>interno</reasoning>Buen día, ¿cómo amaneciste?", True),
+    ("phi", "pipe thought tags", "<|thought|>interno<|/thought|>Buen día.", True),
+    ("phi", "fullwidth tokens", "<｜begin of sentence｜>Human:Buen día, ¿todo bien?", False),
+    ("phi", "angle bracket in text", "Tomá la dosis si la presión es < 140 y avisame.", True),
+    ("phi", "empty", "", True),
+]
+
+CHUNK_SIZES = [1, 2, 3, 5, 7, 16, 10_000]
+
+
+def stream(text, size):
+    """(parser, thought, content) rebuilt from the emitted events only."""
+    parser = ThoughtStreamParser()
+    thought, shown = "", ""
+    chunks = [text[i:i + size] for i in range(0, len(text), size)]
+    for events in [parser.feed(chunk) for chunk in chunks] + [parser.flush()]:
+        for event, data in events:
+            if event == "reset":
+                shown = ""
+            elif event == "token":
+                shown += data
+            elif event == "thought":
+                thought += data
+    return parser, thought.strip(), shown.strip()
+
+
+def run_checks():
+    orchestrator = DualLLMOrchestrator(api_url="http://127.0.0.1:1/v1/chat/completions")
+    failures = 0
+
+    for family, description, text, stream_exact in FIXTURES:
+        expected = orchestrator._extract_thought_and_response(text)
+        # Placeholders ("[No se detectó ...]") are added by the blocking parser only
+        expected_thought = "" if (expected["thought"] or "[").startswith("[") else expected["thought"]
+        expected_content = "" if expected["content"].startswith("[") else expected["content"]
+        _, whole_thought, whole_content = stream(text, len(text) or 1)
+        for size in CHUNK_SIZES:
+            parser, thought, shown = stream(text, size)
+            problems = []
+            if parser.content_text.strip() != shown or parser.thought_text.strip() != thought:
+                problems.append("parser buffers differ from the emitted events")
+            if expected_thought and expected_thought in shown:
+                problems.append(f"thought leaked into stream: {shown!r}")
+            if (thought, shown) != (whole_thought, whole_content):
+                problems.append(f"chunked result {(thought, shown)!r} != unchunked {(whole_thought, whole_content)!r}")
+            if stream_exact:
+                if shown != expected_content:
+                    problems.append(f"streamed content {shown!r} != {expected_content!r}")
+                # The blocking parser drops <reasoning>-style blocks without reporting a thought
+                if expected_thought and thought != expected_thought:
+                    problems.append(f"streamed thought {thought!r} != {expected_thought!r}")
+            if problems:
+                failures += 1
+                print(f"❌ [{family}] {description} (chunk={size}): " + "; ".join(problems))
+                break
+        else:
+            print(f"✅ [{family}] {description}")
+
+    print(f"\n{len(FIXTURES) - failures}/{len(FIXTURES)} fixtures OK")
+    return failures == 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(0 if run_checks() else 1)
@@ -0,0 +1,170 @@
+"""
+Chunking of documents for the RAG collection.
+chunk_size and overlap are counted in tokens of the embedding model's tokenizer: a chunk
+holds at most chunk_size tokens, the first `overlap` of which repeat the end of the
+previous chunk. Docling documents go through HybridChunker; .txt/.md files skip docling
+and are split natively on paragraphs, sentences and words. The tokenizer (and one
+HybridChunker per size) is loaded once per process and reused for every document.
+"""
+
+import os
+import re
+import threading
+
+TOKENIZER_MODEL = os.getenv("CHUNK_TOKENIZER", "sentence-transformers/all-MiniLM-L6-v2")
+NATIVE_EXTENSIONS = (".txt", ".md", ".markdown")
+# Part of the chunk cache key and chunk metadata: bump when chunk boundaries change
+CHUNKING_VERSION = "v2"
+
+_BLOCK_RE = re.compile(r"\n\s*\n")
+_SENTENCE_RE = re.compile(r"(?<=[.!?…])\s+")
+
+
+def is_native(filepath):
+    """Plain text / markdown: chunked directly, without docling conversion."""
+    return filepath.lower().endswith(NATIVE_EXTENSIONS)
+
+
+def read_text(filepath):
+    with open(filepath, "rb") as f:
+        data = f.read()
+    try:
+        return data.decode("utf-8")
+    except UnicodeDecodeError:
+        return data.decode("latin-1")
+
+
+def validate(chunk_size, overlap):
+    if chunk_size <= 0 or overlap < 0 or overlap >= chunk_size:
+        raise ValueError("El solapamiento debe ser menor que el tamaño del fragmento.")
+
+
+class Chunker:
+    def __init__(self, count_tokens=None, tokenizer_model=TOKENIZER_MODEL):
+        """count_tokens: optional callable(text) -> int replacing the HuggingFace tokenizer."""
+        self.tokenizer_model = tokenizer_model
+        self._count_tokens = count_tokens
+        self._tokenizer = None
+        self._hybrid_chunkers = {}  # max_tokens -> HybridChunker
+        self._lock = threading.Lock()
+
+    def _get_tokenizer(self):
+        with self._lock:
+            if self._tokenizer is None:
+                from docling_core.transforms.chunker.tokenizer.huggingface import HuggingFaceTokenizer
+                self._tokenizer = HuggingFaceTokenizer.from_pretrained(self.tokenizer_model, max_tokens=512)
+            return self._tokenizer
+
+    def count_tokens(self, text):
+        if self._count_tokens:
+            return self._count_tokens(text)
+        return self._get_tokenizer().count_tokens(text)
+
+    def _get_hybrid_chunker(self, max_tokens):
+        chunker = self._hybrid_chunkers.get(max_tokens)
+        if chunker is None:
+            from docling.chunking import HybridChunker
+            from docling_core.transforms.chunker.tokenizer.huggingface import HuggingFaceTokenizer
+            # Shares the loaded HF tokenizer, only the limit differs
+            tokenizer = HuggingFaceTokenizer(tokenizer=self._get_tokenizer().get_tokenizer(), max_tokens=max_tokens)
+            chunker = self._hybrid_chunkers[max_tokens] = HybridChunker(tokenizer=tokenizer)
+        return chunker
+
+    def chunk_document(self, doc, chunk_size=1000, overlap=200):
+        """Chunk texts of a DoclingDocument (layout-aware, via HybridChunker)."""
+        validate(chunk_size, overlap)
+        chunker = self._get_hybrid_chunker(chunk_size - overlap)
+        return self._add_overlap([chunk.text for chunk in chunker.chunk(doc)], overlap)
+
+    def chunk_text(self, text, chunk_size=1000, overlap=200):
+        """Chunk texts of plain text / markdown: paragraphs packed up to the size limit."""
+        validate(chunk_size, overlap)
+        budget = chunk_size - overlap
+
+        # (text, tokens, separator before it) units no larger than the budget
+        units = []
+        for block in _BLOCK_RE.split(text):
+            block = block.strip()
+            if not block:
+                continue
+            tokens = self.count_tokens(block)
+            if tokens <= budget:
+                units.append((block, tokens, "\n\n"))
+                continue
+            separator = "\n\n"
+            for sentence in _SENTENCE_RE.split(block):
+                tokens = self.count_tokens(sentence)
+                if tokens <= budget:
+                    units.append((sentence, tokens, separator))
+                else:
+                    for i, (piece, piece_tokens) in enumerate(self._split_words(sentence, budget)):
+                        units.append((piece, piece_tokens, separator if i == 0 else " "))
+                separator = " "
+
+        chunks = []
+        current, current_tokens = "", 0
+        for unit, tokens, separator in units:
+            if current and current_tokens + tokens > budget:
+                chunks.append(current)
+                current, current_tokens = "", 0
+            current = f"{current}{separator}{unit}" if current else unit
+            current_tokens += tokens
+        if current:
+            chunks.append(current)
+        return self._add_overlap(chunks, overlap)
+
+    def _longest_prefix(self, words, max_tokens, from_end=False):
+        """Largest number of words (from the start, or the end) fitting in max_tokens (binary search)."""
+        low, high = 0, len(words)
+        while low < high:
+            middle = (low + high + 1) // 2
+            piece = words[-middle:] if from_end else words[:middle]
+            if self.count_tokens(" ".join(piece)) <= max_tokens:
+                low = middle
+            else:
+                high = middle - 1
+        return low
+
+    def _split_words(self, sentence, budget):
+        words = sentence.split()
+        pieces = []
+        while words:
+            size = max(1, self._longest_prefix(words, budget))
+            piece = " ".join(words[:size])
+            pieces.append((piece, self.count_tokens(piece)))
+            words = words[size:]
+        return pieces
+
+    def _add_overlap(self, chunks, overlap):
+        """Prefixes each chunk with the last `overlap` tokens (whole words) of the previous one."""
+        if not overlap or len(chunks) < 2:
+            return chunks
+        result = [chunks[0]]
+        for previous, chunk in zip(chunks, chunks[1:]):
+            words = previous.split()
+            tail = " ".join(words[len(words) - self._longest_prefix(words, overlap, from_end=True):])
+            result.append(f"{tail} {chunk}" if tail else chunk)
+        return result
+
+
+_chunker = None
+
+
+def get_chunker():
+    """Process-wide Chunker (each ingestion worker process gets its own)."""
+    global _chunker
+    if _chunker is None:
+        _chunker = Chunker()
+    return _chunker
+
+
+def chunk_file(cache, filepath, chunk_size=1000, overlap=200):
+    """Chunk texts of a file through the ConversionCache; native files are never converted."""
+    chunker = get_chunker()
+
+    def make_chunks(digest):
+        if is_native(filepath):
+            return chunker.chunk_text(read_text(filepath), chunk_size, overlap)
+        return chunker.chunk_document(cache.get_document(filepath, digest), chunk_size, overlap)
+
+    return cache.get_chunks(filepath, chunk_size, overlap, make_chunks, version=CHUNKING_VERSION)
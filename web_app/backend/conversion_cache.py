@@ -0,0 +1,130 @@
+"""
+On-disk cache of docling conversions, keyed by the SHA-256 of the document's content.
+For each converted file it stores the DoclingDocument (JSON), its markdown export and the
+chunk lists produced with each chunking configuration, so a document is converted once
+until its content changes.
+
+Layout (cache_dir, next to documentos/):
+    <hash>.json                         DoclingDocument
+    <hash>.md                           markdown export
+    <hash>.chunks.<version>.<size>_<overlap>.json chunk texts
+"""
+
+import os
+import json
+import hashlib
+import tempfile
+import threading
+
+from docling_core.types.doc import DoclingDocument
+
+
+def file_hash(filepath):
+    digest = hashlib.sha256()
+    with open(filepath, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _write_atomic(path, text):
+    """
+    Writes through a unique temp file in the same directory: ingestion worker processes may
+    write the same entry at once (identical content under two names), and each replace must
+    publish a complete file.
+    """
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix=os.path.basename(path) + ".", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            f.write(text)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+class ConversionCache:
+    def __init__(self, cache_dir, convert):
+        """convert: callable(filepath) -> DoclingDocument (the actual docling conversion)."""
+        self.cache_dir = cache_dir
+        os.makedirs(cache_dir, exist_ok=True)
+        self._convert = convert
+        # (path, size, mtime) -> content hash, so unchanged files are not re-read
+        self._hashes = {}
+        self._locks = {}
+        self._locks_lock = threading.Lock()
+        self.conversions = 0
+
+    def _lock_for(self, digest):
+        with self._locks_lock:
+            return self._locks.setdefault(digest, threading.Lock())
+
+    def _path(self, digest, suffix):
+        return os.path.join(self.cache_dir, f"{digest}{suffix}")
+
+    def content_hash(self, filepath):
+        stat = os.stat(filepath)
+        key = (os.path.abspath(filepath), stat.st_size, stat.st_mtime_ns)
+        digest = self._hashes.get(key)
+        if digest is None:
+            digest = self._hashes[key] = file_hash(filepath)
+        return digest
+
+    def has_document(self, digest):
+        return os.path.exists(self._path(digest, ".json"))
+
+    def get_document(self, filepath, digest=None):
+        """DoclingDocument for the file, converting it only if this content was never seen."""
+        digest = digest or self.content_hash(filepath)
+        doc_path = self._path(digest, ".json")
+        with self._lock_for(digest):
+            if os.path.exists(doc_path):
+                try:
+                    return DoclingDocument.load_from_json(doc_path)
+                except Exception as e:
+                    print(f"Conversion cache: unreadable entry for {os.path.basename(filepath)} ({e}), converting again")
+
+            print(f"Converting {os.path.basename(filepath)} with Docling...")
+            doc = self._convert(filepath)
+            self.conversions += 1
+            _write_atomic(doc_path, json.dumps(doc.export_to_dict(), ensure_ascii=False))
+            return doc
+
+    def get_markdown(self, filepath):
+        digest = self.content_hash(filepath)
+        md_path = self._path(digest, ".md")
+        if os.path.exists(md_path):
+            with open(md_path, "r", encoding="utf-8") as f:
+                return f.read()
+        markdown = self.get_document(filepath, digest).export_to_markdown()
+        _write_atomic(md_path, markdown)
+        return markdown
+
+    def get_chunks(self, filepath, chunk_size, overlap, make_chunks, version=None):
+        """
+        Chunk texts for the given chunking parameters.
+        make_chunks: callable(content hash) -> list of str, used on a cache miss.
+        version: chunker version, part of the cache key.
+        """
+        digest = self.content_hash(filepath)
+        variant = f"{version}.{chunk_size}_{overlap}" if version else f"{chunk_size}_{overlap}"
+        chunks_path = self._path(digest, f".chunks.{variant}.json")
+        if os.path.exists(chunks_path):
+            try:
+                with open(chunks_path, "r", encoding="utf-8") as f:
+                    return json.load(f)
+            except (OSError, ValueError) as e:
+                print(f"Conversion cache: unreadable chunks for {os.path.basename(filepath)} ({e}), chunking again")
+        chunks = make_chunks(digest)
+        _write_atomic(chunks_path, json.dumps(chunks, ensure_ascii=False))
+        return chunks
+
+    def prune(self, keep_hashes):
+        """Removes cache files of contents no longer present in the document library."""
+        removed = 0
+        for name in os.listdir(self.cache_dir):
+            if name.split(".", 1)[0] not in keep_hashes:
+                os.remove(os.path.join(self.cache_dir, name))
+                removed += 1
+        return removed
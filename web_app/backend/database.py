@@ -3,7 +3,7 @@ Database models and configuration for the chatbot application.
 Uses SQLite with SQLAlchemy ORM.
 """
 
-from sqlalchemy import create_engine, Column, Integer, String, DateTime, Boolean, Text, ForeignKey, JSON
+from sqlalchemy import create_engine, Column, Integer, Float, String, DateTime, Boolean, Text, ForeignKey, JSON, Index
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker, relationship
 from datetime import datetime
@@ -75,6 +75,15 @@ class Interaction(Base):
     # Relationships
     patient = relationship("Patient", back_populates="interactions", foreign_keys=[patient_id])
     messages = relationship("Message", back_populates="interaction", cascade="all, delete-orphan", order_by="Message.order")
+    summaries = relationship("InteractionSummary", cascade="all, delete-orphan")
+    
+    # Composite indexes for the keyset-paginated listing (newest first, optionally filtered)
+    __table_args__ = (
+        Index("ix_interactions_timestamp_id", "timestamp", "id"),
+        Index("ix_interactions_patient_timestamp", "patient_id", "timestamp", "id"),
+        Index("ix_interactions_chatbot_model_timestamp", "chatbot_model", "timestamp", "id"),
+        Index("ix_interactions_patient_model_timestamp", "patient_model", "timestamp", "id"),
+    )
 
 
 class Message(Base):
@@ -100,9 +109,74 @@ class Message(Base):
     interaction = relationship("Interaction", back_populates="messages")
 
 
+class SentimentCacheEntry(Base):
+    """Cached sentiment scores keyed by hash(model + prompt version + message text)"""
+    __tablename__ = "sentiment_cache"
+    
+    key = Column(String, primary_key=True)  # sha256 hex digest
+    model = Column(String, nullable=False)
+    prompt_version = Column(String, nullable=False, index=True)
+    sentiment = Column(JSON, nullable=False)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    last_used_at = Column(DateTime, default=datetime.utcnow, index=True)
+
+
+class InteractionSummary(Base):
+    """Cached analysis summary of one interaction, per message set and summarizer model"""
+    __tablename__ = "interaction_summaries"
+    
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    interaction_id = Column(Integer, ForeignKey('interactions.id'), nullable=False, index=True)
+    messages_hash = Column(String, nullable=False)  # sha256 of the (role, content) sequence
+    model = Column(String, nullable=False)
+    prompt_version = Column(String, nullable=False, index=True)
+    summary = Column(Text, nullable=False)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    
+    __table_args__ = (
+        Index("ix_interaction_summaries_lookup", "interaction_id", "messages_hash", "model", unique=True),
+    )
+
+
+class IngestionJob(Base):
+    """Background document ingestion started by /api/upload_document"""
+    __tablename__ = "ingestion_jobs"
+    
+    id = Column(String, primary_key=True)  # uuid hex
+    status = Column(String, nullable=False, default="queued", index=True)  # queued, running, finished
+    chunk_size = Column(Integer, nullable=False)
+    overlap = Column(Integer, nullable=False)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    updated_at = Column(DateTime, default=datetime.utcnow)
+    finished_at = Column(DateTime, nullable=True)
+    
+    files = relationship("IngestionJobFile", back_populates="job", cascade="all, delete-orphan", order_by="IngestionJobFile.id")
+
+
+class IngestionJobFile(Base):
+    """One file of an ingestion job and the pipeline stage it reached"""
+    __tablename__ = "ingestion_job_files"
+    
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    job_id = Column(String, ForeignKey('ingestion_jobs.id'), nullable=False, index=True)
+    filename = Column(String, nullable=False)
+    filepath = Column(String, nullable=False)
+    state = Column(String, nullable=False, default="queued")  # queued, converting, chunking, embedding, done, failed
+    chunks = Column(Integer, nullable=True)
+    seconds = Column(Float, nullable=True)
+    error = Column(Text, nullable=True)
+    updated_at = Column(DateTime, default=datetime.utcnow)
+    
+    job = relationship("IngestionJob", back_populates="files")
+
+
 def init_db():
     """Initialize the database, creating all tables"""
     Base.metadata.create_all(bind=engine)
+    # create_all only adds indexes together with new tables; add missing ones to existing tables
+    for table in Base.metadata.tables.values():
+        for index in table.indexes:
+            index.create(bind=engine, checkfirst=True)
     print("✅ Database initialized successfully")
 
 
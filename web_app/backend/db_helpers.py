@@ -2,12 +2,12 @@
 Database helper functions for CRUD operations.
 """
 
-from sqlalchemy.orm import Session
-from sqlalchemy import desc, func
-from database import Patient, Interaction, Message
+from sqlalchemy.orm import Session, joinedload, selectinload
+from sqlalchemy import desc, func, or_, and_
+from database import Patient, Interaction, Message, InteractionSummary
 from typing import List, Dict, Any, Optional
 from datetime import datetime
-import json
+import base64
 
 
 # ========== PATIENT OPERATIONS ==========
@@ -70,15 +70,35 @@ def patient_to_dict(patient: Patient) -> Dict[str, Any]:
 
 # ========== INTERACTION OPERATIONS ==========
 
-def save_interaction(db: Session, interaction_data: Dict[str, Any]) -> Dict[str, str]:
+class MessageCountMismatch(ValueError):
+    """Delta save whose known_message_count does not match the stored messages"""
+    pass
+
+
+def _same_message(message: Message, msg_data: Dict[str, Any]) -> bool:
+    return (
+        message.role == msg_data.get('role')
+        and message.content == msg_data.get('content')
+        and message.thought == msg_data.get('thought')
+    )
+
+
+def save_interaction(db: Session, interaction_data: Dict[str, Any]) -> Dict[str, Any]:
     """
     Save a new interaction or update an existing one.
-    Returns dict with status and filename.
+    Updates are append-only: stored messages that are unchanged keep their rows, ids and
+    sentiment, and only the new tail is inserted. With 'known_message_count', 'messages'
+    holds just the messages after that count (raises MessageCountMismatch if the stored
+    count differs).
+    Any change to the messages drops the interaction's cached analysis summaries.
+    Returns dict with status, filename and message_count.
     """
     config = interaction_data.get('config', {})
     messages_data = interaction_data.get('messages', [])
     existing_filename = interaction_data.get('filename')
     title = interaction_data.get('title')
+    known_message_count = interaction_data.get('known_message_count')
+    first_new_order = 0
     
     # Find patient_id (Common for create and update)
     patient_name = config.get('patient_name')
@@ -109,8 +129,38 @@ def save_interaction(db: Session, interaction_data: Dict[str, Any]) -> Dict[str,
         # Update patient link
         interaction.patient_id = patient_id
         
-        # Clear existing messages to replace them
-        db.query(Message).filter(Message.interaction_id == interaction.id).delete(synchronize_session=False)
+        existing_messages = db.query(Message).filter(
+            Message.interaction_id == interaction.id
+        ).order_by(Message.order).all()
+        
+        if known_message_count is not None:
+            # Delta save: the client only sent the new tail
+            if known_message_count != len(existing_messages):
+                raise MessageCountMismatch(
+                    f"Interaction {filename} has {len(existing_messages)} messages, client expected {known_message_count}"
+                )
+            first_new_order = known_message_count
+        else:
+            # Full save: keep the unchanged prefix, replace only what differs
+            kept = 0
+            for message, msg_data in zip(existing_messages, messages_data):
+                if not _same_message(message, msg_data):
+                    break
+                # Keep server-side sentiment unless the client sends a new one
+                if msg_data.get('sentiment') and msg_data.get('sentiment') != message.sentiment:
+                    message.sentiment = msg_data.get('sentiment')
+                kept += 1
+            
+            for message in existing_messages[kept:]:
+                db.delete(message)
+            first_new_order = kept
+            messages_data = messages_data[kept:]
+        
+        # Cached analysis summaries describe the previous message set
+        if messages_data or first_new_order < len(existing_messages):
+            db.query(InteractionSummary).filter(
+                InteractionSummary.interaction_id == interaction.id
+            ).delete(synchronize_session=False)
         
     else:
         # Create new
@@ -157,8 +207,8 @@ def save_interaction(db: Session, interaction_data: Dict[str, Any]) -> Dict[str,
     
     db.flush() # Ensure ID exists
 
-    # Create/Re-create messages
-    for i, msg_data in enumerate(messages_data):
+    # Insert new messages (only the tail when updating)
+    for i, msg_data in enumerate(messages_data, start=first_new_order):
         message = Message(
             interaction_id=interaction.id,
             order=i,
@@ -180,7 +230,7 @@ def save_interaction(db: Session, interaction_data: Dict[str, Any]) -> Dict[str,
             patient.last_interaction_id = interaction.id
             db.commit()
     
-    return {'status': 'success', 'filename': filename}
+    return {'status': 'success', 'filename': filename, 'message_count': first_new_order + len(messages_data)}
 
 
 def get_all_interactions(db: Session) -> List[Dict[str, Any]]:
@@ -188,25 +238,114 @@ def get_all_interactions(db: Session) -> List[Dict[str, Any]]:
     Get all interactions summary (compatible with JSON format).
     Returns list sorted by timestamp (newest first).
     """
-    interactions = db.query(Interaction).order_by(desc(Interaction.timestamp)).all()
+    # Column projection with the patient name joined in: one query regardless of row count
+    rows = db.query(
+        Interaction.filename,
+        Interaction.timestamp,
+        Interaction.chatbot_model,
+        Interaction.patient_model,
+        Interaction.title,
+        Patient.nombre
+    ).outerjoin(Patient, Interaction.patient_id == Patient.id).order_by(desc(Interaction.timestamp)).all()
     
-    result = []
-    for interaction in interactions:
-        result.append({
-            'filename': interaction.filename,
-            'timestamp': interaction.timestamp.isoformat(),
-            'chatbot_model': interaction.chatbot_model or 'N/A',
-            'patient_model': interaction.patient_model or 'N/A',
-            'patient_name': interaction.patient.nombre if interaction.patient else 'Desconocido',
-            'title': interaction.title
-        })
+    return [_summary_row_to_dict(row) for row in rows]
+
+
+def _summary_row_to_dict(row) -> Dict[str, Any]:
+    """Listing entry from a (filename, timestamp, chatbot_model, patient_model, title, patient_name, ...) row"""
+    filename, timestamp, chatbot_model, patient_model, title, patient_name = row[:6]
+    return {
+        'filename': filename,
+        'timestamp': timestamp.isoformat(),
+        'chatbot_model': chatbot_model or 'N/A',
+        'patient_model': patient_model or 'N/A',
+        'patient_name': patient_name if patient_name else 'Desconocido',
+        'title': title
+    }
+
+
+def encode_interaction_cursor(timestamp: datetime, interaction_id: int) -> str:
+    """Opaque keyset cursor for (timestamp, id)"""
+    raw = f"{timestamp.isoformat()}|{interaction_id}"
+    return base64.urlsafe_b64encode(raw.encode("utf-8")).decode("ascii")
+
+
+def decode_interaction_cursor(cursor: str):
+    """Inverse of encode_interaction_cursor. Raises ValueError on malformed cursors."""
+    try:
+        raw = base64.urlsafe_b64decode(cursor.encode("ascii")).decode("utf-8")
+        timestamp_str, id_str = raw.rsplit("|", 1)
+        return datetime.fromisoformat(timestamp_str), int(id_str)
+    except Exception:
+        raise ValueError(f"Invalid cursor: {cursor}")
+
+
+def get_interactions_page(db: Session, limit: int = 50, cursor: Optional[str] = None,
+                          patient_id: Optional[str] = None, patient_name: Optional[str] = None,
+                          chatbot_model: Optional[str] = None, patient_model: Optional[str] = None,
+                          date_from: Optional[datetime] = None, date_to: Optional[datetime] = None) -> Dict[str, Any]:
+    """
+    Keyset-paginated listing ordered by (timestamp, id), newest first.
+    Returns {'items': [...], 'next_cursor': str|None}; pass next_cursor back to get the following page.
+    Cost per page does not depend on how many interactions are stored.
+    """
+    query = db.query(
+        Interaction.filename,
+        Interaction.timestamp,
+        Interaction.chatbot_model,
+        Interaction.patient_model,
+        Interaction.title,
+        Patient.nombre,
+        Interaction.id
+    ).outerjoin(Patient, Interaction.patient_id == Patient.id)
+    
+    if patient_id:
+        query = query.filter(Interaction.patient_id == patient_id)
+    if patient_name:
+        query = query.filter(Patient.nombre == patient_name)
+    if chatbot_model:
+        query = query.filter(Interaction.chatbot_model == chatbot_model)
+    if patient_model:
+        query = query.filter(Interaction.patient_model == patient_model)
+    if date_from:
+        query = query.filter(Interaction.timestamp >= date_from)
+    if date_to:
+        query = query.filter(Interaction.timestamp <= date_to)
+    
+    if cursor:
+        cursor_timestamp, cursor_id = decode_interaction_cursor(cursor)
+        query = query.filter(or_(
+            Interaction.timestamp < cursor_timestamp,
+            and_(Interaction.timestamp == cursor_timestamp, Interaction.id < cursor_id)
+        ))
+    
+    # One extra row tells us whether there is a next page
+    rows = query.order_by(desc(Interaction.timestamp), desc(Interaction.id)).limit(limit + 1).all()
+    
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        last = rows[-1]
+        next_cursor = encode_interaction_cursor(last.timestamp, last.id)
     
-    return result
+    return {'items': [_summary_row_to_dict(row) for row in rows], 'next_cursor': next_cursor}
+
+
+def get_interaction_facets(db: Session) -> Dict[str, List[str]]:
+    """Distinct values for the listing filters (patient names and models)"""
+    patient_names = db.query(Patient.nombre).join(Interaction, Interaction.patient_id == Patient.id).distinct().all()
+    chatbot_models = db.query(Interaction.chatbot_model).filter(Interaction.chatbot_model.isnot(None)).distinct().all()
+    patient_models = db.query(Interaction.patient_model).filter(Interaction.patient_model.isnot(None)).distinct().all()
+    return {
+        'patient_names': sorted(r[0] for r in patient_names if r[0]),
+        'chatbot_models': sorted(r[0] for r in chatbot_models if r[0]),
+        'patient_models': sorted(r[0] for r in patient_models if r[0]),
+    }
 
 
 def get_interaction_by_filename(db: Session, filename: str) -> Optional[Dict[str, Any]]:
     """Get full interaction details by filename (for compatibility)"""
-    interaction = db.query(Interaction).filter(Interaction.filename == filename).first()
+    interaction = db.query(Interaction).options(*_detail_load_options()).filter(Interaction.filename == filename).first()
     
     if not interaction:
         return None
@@ -238,6 +377,14 @@ def update_interaction_title(db: Session, filename: str, title: str) -> bool:
     return False
 
 
+def _detail_load_options():
+    """
+    Eager loading for interaction_to_dict: patient joined in the same query and all
+    messages fetched in one extra IN query, instead of two lazy loads per interaction.
+    """
+    return (joinedload(Interaction.patient), selectinload(Interaction.messages))
+
+
 def interaction_to_dict(interaction: Interaction) -> Dict[str, Any]:
     """Convert Interaction model to dictionary (JSON compatible)"""
     if not interaction:
@@ -297,7 +444,7 @@ def interaction_to_dict(interaction: Interaction) -> Dict[str, Any]:
 
 def get_interactions_by_filenames(db: Session, filenames: List[str]) -> List[Dict[str, Any]]:
     """Get multiple interactions by their filenames (for analysis)"""
-    interactions = db.query(Interaction).filter(
+    interactions = db.query(Interaction).options(*_detail_load_options()).filter(
         Interaction.filename.in_(filenames)
     ).all()
     
@@ -308,7 +455,7 @@ def get_interactions_by_filenames(db: Session, filenames: List[str]) -> List[Dic
 
 def search_interactions_by_patient(db: Session, patient_id: str) -> List[Dict[str, Any]]:
     """Get all interactions for a specific patient"""
-    interactions = db.query(Interaction).filter(
+    interactions = db.query(Interaction).options(*_detail_load_options()).filter(
         Interaction.patient_id == patient_id
     ).order_by(desc(Interaction.timestamp)).all()
     
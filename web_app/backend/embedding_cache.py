@@ -0,0 +1,132 @@
+"""
+On-disk embedding cache for the RAG collection.
+Vectors are stored in a small SQLite file as raw float32 (or float16) arrays, keyed by
+hash(model name + normalized text), and CachedEmbeddingFunction consults it before calling
+the model, both when indexing chunks and when embedding queries.
+"""
+
+import os
+import hashlib
+import sqlite3
+import threading
+import unicodedata
+
+import numpy as np
+from chromadb.api.types import EmbeddingFunction, Documents, Embeddings
+
+# float16 halves the size on disk at a small precision cost
+DEFAULT_DTYPE = os.getenv("EMBEDDING_CACHE_DTYPE", "float32")
+
+
+def normalize_text(text):
+    """NFC, trimmed, whitespace runs collapsed: formatting-only differences share an entry."""
+    return " ".join(unicodedata.normalize("NFC", text or "").split())
+
+
+class EmbeddingCache:
+    def __init__(self, path, dtype=None):
+        self.path = path
+        self.dtype = np.dtype(dtype or DEFAULT_DTYPE)
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings ("
+            "key TEXT PRIMARY KEY, dtype TEXT NOT NULL, vector BLOB NOT NULL)"
+        )
+        self._conn.commit()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def make_key(model_name, text):
+        return hashlib.sha256(f"{model_name}\n{normalize_text(text)}".encode("utf-8")).hexdigest()
+
+    def get_many(self, keys):
+        """{key: float32 vector} for the keys present in the cache"""
+        found = {}
+        unique = list(dict.fromkeys(keys))
+        with self._lock:
+            # SQLite limits the number of bound parameters per statement
+            for start in range(0, len(unique), 500):
+                batch = unique[start:start + 500]
+                rows = self._conn.execute(
+                    f"SELECT key, dtype, vector FROM embeddings WHERE key IN ({','.join('?' * len(batch))})",
+                    batch
+                ).fetchall()
+                for key, dtype, blob in rows:
+                    found[key] = np.frombuffer(blob, dtype=np.dtype(dtype)).astype(np.float32)
+        return found
+
+    def put_many(self, items):
+        """items: [(key, vector), ...]"""
+        rows = [(key, self.dtype.name, np.asarray(vector, dtype=self.dtype).tobytes()) for key, vector in items]
+        with self._lock:
+            self._conn.executemany("INSERT OR REPLACE INTO embeddings (key, dtype, vector) VALUES (?, ?, ?)", rows)
+            self._conn.commit()
+
+    def record(self, hits, misses):
+        with self._lock:
+            self.hits += hits
+            self.misses += misses
+
+    def stats(self):
+        with self._lock:
+            entries = self._conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+            hits, misses = self.hits, self.misses
+        lookups = hits + misses
+        return {
+            "path": self.path,
+            "dtype": self.dtype.name,
+            "entries": entries,
+            "size_bytes": os.path.getsize(self.path) if os.path.exists(self.path) else 0,
+            "hits": hits,
+            "misses": misses,
+            "hit_rate": round(hits / lookups, 3) if lookups else 0.0,
+        }
+
+
+class CachedEmbeddingFunction(EmbeddingFunction[Documents]):
+    """
+    Chroma embedding function that serves known texts from EmbeddingCache and only sends
+    the misses to the wrapped function. Reports the wrapped function's name and config,
+    so existing collections keep matching their stored configuration.
+    """
+
+    def __init__(self, inner, model_name, cache):
+        self.inner = inner
+        self.model_name = model_name
+        self.cache = cache
+
+    def __call__(self, input: Documents) -> Embeddings:
+        texts = list(input)
+        keys = [EmbeddingCache.make_key(self.model_name, text) for text in texts]
+        found = self.cache.get_many(keys)
+
+        missing = {}
+        for key, text in zip(keys, texts):
+            if key not in found and key not in missing:
+                missing[key] = text
+        if missing:
+            vectors = self.inner(list(missing.values()))
+            computed = list(zip(missing.keys(), vectors))
+            self.cache.put_many(computed)
+            found.update((key, np.asarray(vector, dtype=np.float32)) for key, vector in computed)
+
+        self.cache.record(hits=len(texts) - len(missing), misses=len(missing))
+        return [found[key] for key in keys]
+
+    def name(self):
+        return self.inner.name()
+
+    def get_config(self):
+        return self.inner.get_config()
+
+    def is_legacy(self):
+        return self.inner.is_legacy()
+
+    def default_space(self):
+        return self.inner.default_space()
+
+    def supported_spaces(self):
+        return self.inner.supported_spaces()
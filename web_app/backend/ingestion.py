@@ -0,0 +1,205 @@
+"""
+Document ingestion pipeline for the RAG collection.
+1. Conversion, then chunking: docling and HybridChunker run in a process pool (CPU bound),
+   one task per document and stage, through the shared on-disk conversion cache
+   (.txt/.md files skip conversion and are chunked natively, see chunking.py).
+2. Embedding: chunks from several documents are embedded together in batches.
+3. Storage: one bulk collection.add per batch, with precomputed embeddings, plus the BM25 index.
+"""
+
+import os
+import time
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from concurrent.futures.process import BrokenProcessPool
+
+from conversion_cache import ConversionCache
+from chunking import CHUNKING_VERSION, chunk_file, is_native
+
+DEFAULT_WORKERS = int(os.getenv("INGEST_WORKERS", str(min(4, os.cpu_count() or 1))))
+# Chunks embedded (and written to Chroma) per batch
+DEFAULT_EMBED_BATCH_SIZE = int(os.getenv("INGEST_EMBED_BATCH_SIZE", "128"))
+
+
+# Per worker process: one DocumentConverter (loads its models once) and cache handle
+_worker_cache = None
+
+
+def _get_worker_cache(cache_dir):
+    global _worker_cache
+    if _worker_cache is None or _worker_cache.cache_dir != cache_dir:
+        from docling.document_converter import DocumentConverter
+        converter = DocumentConverter()
+        _worker_cache = ConversionCache(cache_dir, lambda filepath: converter.convert(filepath).document)
+    return _worker_cache
+
+
+def convert_file(filepath, cache_dir):
+    """Stage 1a (worker process): docling conversion, stored in the cache. Returns the content hash."""
+    cache = _get_worker_cache(cache_dir)
+    content_hash = cache.content_hash(filepath)
+    # Plain text / markdown is chunked natively, without conversion
+    if not is_native(filepath) and not cache.has_document(content_hash):
+        cache.get_document(filepath, content_hash)
+    return content_hash
+
+
+def chunk_converted_file(filepath, chunk_size, overlap, cache_dir):
+    """Stage 1b (worker process): chunk texts from the cached conversion."""
+    return chunk_file(_get_worker_cache(cache_dir), filepath, chunk_size, overlap)
+
+
+class IngestionPipeline:
+    def __init__(self, rag_manager, workers=None, embed_batch_size=None):
+        self.rag_manager = rag_manager
+        self.workers = workers or DEFAULT_WORKERS
+        self.embed_batch_size = embed_batch_size or DEFAULT_EMBED_BATCH_SIZE
+        self._executor = None
+        self._executor_lock = threading.Lock()
+        # Chroma writes from concurrent ingestions are serialized
+        self._write_lock = threading.Lock()
+
+    def _get_executor(self):
+        if self._executor is None:
+            with self._executor_lock:
+                if self._executor is None:
+                    # spawn: workers must not inherit the parent's embedding model / threads
+                    self._executor = ProcessPoolExecutor(
+                        max_workers=self.workers,
+                        mp_context=multiprocessing.get_context("spawn")
+                    )
+        return self._executor
+
+    def ingest(self, files, chunk_size=1000, overlap=200, on_stage=None):
+        """
+        Converts, chunks, embeds and stores files = [(filename, filepath), ...].
+        Existing chunks of each file are replaced. Returns a per-document report
+        ({filename, status, chunks, seconds}) in the order documents finished.
+        on_stage(filename, state, **info) is called on every transition:
+        converting -> chunking -> embedding -> done, or failed (with error).
+        """
+        if not files:
+            return []
+        started = time.perf_counter()
+        cache_dir = self.rag_manager.conversions.cache_dir
+        notify = on_stage or (lambda filename, state, **info: None)
+
+        paths = dict(files)
+        file_started = {}
+        content_hashes = {}
+        futures = {}
+        report = []
+
+        def fail(filename, error):
+            print(f"Error processing document {filename} with Docling: {error}")
+            notify(filename, "failed", error=str(error))
+            report.append({"filename": filename, "status": "error", "error": str(error), "chunks": 0, "seconds": None})
+
+        def submit(stage, filename, fn, *args):
+            # A pool that broke under earlier tasks is replaced once; other errors only fail this file
+            for attempt in range(2):
+                executor = self._get_executor()
+                try:
+                    futures[executor.submit(fn, *args)] = (stage, filename, executor)
+                    return
+                except BrokenProcessPool as e:
+                    self._discard_executor(executor)
+                    if attempt:
+                        fail(filename, e)
+                except Exception as e:
+                    fail(filename, e)
+                    return
+
+        for filename, filepath in files:
+            file_started[filename] = time.perf_counter()
+            notify(filename, "converting")
+            submit("convert", filename, convert_file, filepath, cache_dir)
+
+        pending = []  # chunked documents waiting for the next embedding batch
+        pending_chunks = 0
+        while futures:
+            done, _ = wait(futures, return_when=FIRST_COMPLETED)
+            for future in done:
+                stage, filename, executor = futures.pop(future)
+                try:
+                    result = future.result()
+                except Exception as e:
+                    if isinstance(e, BrokenProcessPool):
+                        # A worker died (e.g. out of memory): later submits get a fresh pool
+                        self._discard_executor(executor)
+                    fail(filename, e)
+                    continue
+
+                if stage == "convert":
+                    content_hashes[filename] = result
+                    notify(filename, "chunking")
+                    submit("chunk", filename, chunk_converted_file, paths[filename], chunk_size, overlap, cache_dir)
+                    continue
+
+                pending.append((filename, content_hashes[filename], result, time.perf_counter() - file_started[filename]))
+                pending_chunks += len(result)
+                if pending_chunks >= self.embed_batch_size:
+                    report.extend(self._store(pending, chunk_size, overlap, notify))
+                    pending = []
+                    pending_chunks = 0
+        if pending:
+            report.extend(self._store(pending, chunk_size, overlap, notify))
+
+        print(f"Ingested {len(files)} documents in {time.perf_counter() - started:.1f}s ({self.workers} workers)")
+        return report
+
+    def _store(self, documents, chunk_size, overlap, notify):
+        """Stages 2 and 3: embed all chunks of the given documents and add them in one call."""
+        ids, texts, metadatas = [], [], []
+        for filename, content_hash, chunks, _ in documents:
+            notify(filename, "embedding", chunks=len(chunks))
+            for i, text in enumerate(chunks):
+                ids.append(f"{filename}_{i}")
+                texts.append(text)
+                metadatas.append({
+                    "filename": filename,
+                    "chunk_index": i,
+                    "content_hash": content_hash,
+                    "chunk_size": chunk_size,
+                    "overlap": overlap,
+                    "chunker": CHUNKING_VERSION
+                })
+
+        status = "success"
+        error = None
+        try:
+            embeddings = self.rag_manager.embedding_function(texts) if texts else []
+            with self._write_lock:
+                # Replace any previous chunks of these documents
+                filenames = [doc[0] for doc in documents]
+                self.rag_manager.collection.delete(where={"filename": {"$in": filenames}})
+                self.rag_manager.lexical_index.delete_filenames(filenames)
+                if texts:
+                    self.rag_manager.collection.add(ids=ids, documents=texts, metadatas=metadatas, embeddings=embeddings)
+                    self.rag_manager.lexical_index.add(ids, texts, metadatas)
+                self.rag_manager.query_cache.invalidate_filenames(filenames)
+        except Exception as e:
+            print(f"Error storing {len(documents)} documents in the vector database: {e}")
+            status, error = "error", str(e)
+
+        entries = []
+        for filename, _, chunks, seconds in documents:
+            entry = {"filename": filename, "status": status, "chunks": len(chunks), "seconds": round(seconds, 3)}
+            if error:
+                entry["error"] = error
+                notify(filename, "failed", error=error)
+            else:
+                notify(filename, "done", chunks=len(chunks), seconds=entry["seconds"])
+            entries.append(entry)
+        return entries
+
+    def _discard_executor(self, executor):
+        with self._executor_lock:
+            if self._executor is executor:
+                self._executor = None
+        executor.shutdown(wait=False, cancel_futures=True)
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
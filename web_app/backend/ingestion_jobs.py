@@ -0,0 +1,175 @@
+"""
+Persistent background queue for document ingestion (/api/upload_document).
+Jobs and the pipeline stage reached by each file are stored in SQLite, so progress can be
+polled (/api/jobs/{id}) and unfinished jobs are picked up again after a restart. Resumed
+files restart from the conversion/chunk caches, so finished stages are not recomputed.
+"""
+
+import os
+import uuid
+import queue
+import threading
+import traceback
+from datetime import datetime
+
+from database import IngestionJob, IngestionJobFile
+
+FINAL_STATES = ("done", "failed")
+
+
+def job_to_dict(job):
+    files = [
+        {
+            "filename": f.filename,
+            "state": f.state,
+            "chunks": f.chunks,
+            "seconds": f.seconds,
+            "error": f.error,
+        }
+        for f in job.files
+    ]
+    return {
+        "job_id": job.id,
+        "status": job.status,
+        "chunk_size": job.chunk_size,
+        "overlap": job.overlap,
+        "created_at": job.created_at.isoformat() if job.created_at else None,
+        "finished_at": job.finished_at.isoformat() if job.finished_at else None,
+        "total": len(files),
+        "done": sum(1 for f in files if f["state"] == "done"),
+        "failed": sum(1 for f in files if f["state"] == "failed"),
+        "files": files,
+    }
+
+
+class IngestionJobQueue:
+    def __init__(self, get_rag_manager, session_factory):
+        """get_rag_manager: callable returning the RAGManager (loaded on first job, not at startup)."""
+        self.get_rag_manager = get_rag_manager
+        self.session_factory = session_factory
+        self._queue = queue.Queue()
+        self._thread = None
+        self._thread_lock = threading.Lock()
+
+    def _ensure_worker(self):
+        with self._thread_lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._worker, name="ingestion-jobs", daemon=True)
+                self._thread.start()
+
+    def create(self, files, chunk_size=1000, overlap=200):
+        """Persists a job for files = [(filename, filepath), ...] and queues it. Returns the job dict."""
+        db = self.session_factory()
+        try:
+            job = IngestionJob(id=uuid.uuid4().hex, status="queued", chunk_size=chunk_size, overlap=overlap)
+            job.files = [IngestionJobFile(filename=filename, filepath=filepath, state="queued") for filename, filepath in files]
+            db.add(job)
+            db.commit()
+            result = job_to_dict(job)
+        finally:
+            db.close()
+        self._queue.put(result["job_id"])
+        self._ensure_worker()
+        return result
+
+    def get(self, job_id):
+        db = self.session_factory()
+        try:
+            job = db.query(IngestionJob).filter(IngestionJob.id == job_id).first()
+            return job_to_dict(job) if job else None
+        finally:
+            db.close()
+
+    def resume(self):
+        """Queues again every job left unfinished by a previous run."""
+        db = self.session_factory()
+        try:
+            job_ids = [job_id for (job_id,) in db.query(IngestionJob.id).filter(
+                IngestionJob.status != "finished"
+            ).order_by(IngestionJob.created_at).all()]
+        finally:
+            db.close()
+        for job_id in job_ids:
+            self._queue.put(job_id)
+        if job_ids:
+            print(f"Ingestion jobs: resuming {len(job_ids)} unfinished jobs")
+            self._ensure_worker()
+        return len(job_ids)
+
+    def _worker(self):
+        while True:
+            job_id = self._queue.get()
+            try:
+                self._run(job_id)
+            except Exception as e:
+                print(f"Error in ingestion job {job_id}: {e}")
+                traceback.print_exc()
+                self._finish(job_id, error=str(e))
+
+    def _run(self, job_id):
+        db = self.session_factory()
+        try:
+            job = db.query(IngestionJob).filter(IngestionJob.id == job_id).first()
+            if not job or job.status == "finished":
+                return
+            job.status = "running"
+            job.updated_at = datetime.utcnow()
+            chunk_size, overlap = job.chunk_size, job.overlap
+            files = []
+            for f in job.files:
+                if f.state in FINAL_STATES:
+                    continue
+                if not os.path.exists(f.filepath):
+                    f.state, f.error = "failed", "El archivo ya no existe."
+                    continue
+                files.append((f.filename, f.filepath))
+            db.commit()
+        finally:
+            db.close()
+
+        print(f"--- Ingestion job {job_id}: {len(files)} files ---")
+        self.get_rag_manager().add_documents(
+            files, chunk_size=chunk_size, overlap=overlap,
+            on_stage=lambda filename, state, **info: self._set_file_state(job_id, filename, state, **info)
+        )
+        self._finish(job_id)
+
+    def _set_file_state(self, job_id, filename, state, chunks=None, seconds=None, error=None):
+        db = self.session_factory()
+        try:
+            job_file = db.query(IngestionJobFile).filter(
+                IngestionJobFile.job_id == job_id,
+                IngestionJobFile.filename == filename
+            ).first()
+            if job_file:
+                job_file.state = state
+                job_file.updated_at = datetime.utcnow()
+                if chunks is not None:
+                    job_file.chunks = chunks
+                if seconds is not None:
+                    job_file.seconds = seconds
+                if error is not None:
+                    job_file.error = error
+                db.commit()
+        except Exception as e:
+            db.rollback()
+            print(f"Error updating ingestion job {job_id}: {e}")
+        finally:
+            db.close()
+
+    def _finish(self, job_id, error=None):
+        """Marks the job finished; files that never reached a final state are failed."""
+        db = self.session_factory()
+        try:
+            job = db.query(IngestionJob).filter(IngestionJob.id == job_id).first()
+            if not job:
+                return
+            for f in job.files:
+                if f.state not in FINAL_STATES:
+                    f.state = "failed"
+                    f.error = error or "La ingesta terminó sin procesar este archivo."
+            job.status = "finished"
+            job.finished_at = job.updated_at = datetime.utcnow()
+            db.commit()
+        finally:
+            db.close()
@@ -0,0 +1,140 @@
+"""
+BM25 lexical index over the RAG chunks, kept next to chroma_db (lexical_index.sqlite3).
+Dense MiniLM retrieval misses exact terms such as drug names; this index finds them and
+RAGManager.query fuses both rankings. Term frequencies per chunk are persisted in SQLite
+and the inverted index is rebuilt in memory on load, so searches never touch the disk.
+"""
+
+import os
+import re
+import json
+import math
+import heapq
+import sqlite3
+import threading
+import unicodedata
+from collections import Counter
+
+BM25_K1 = 1.5
+BM25_B = 0.75
+# Reciprocal-rank fusion constant (Cormack et al.): damps the weight of the top ranks
+RRF_K = 60
+
+_TOKEN_RE = re.compile(r"\w+")
+# Frequent Spanish/English function words carry no signal for retrieval
+STOPWORDS = frozenset("""
+a al algo ante como con contra cual cuando de del desde donde durante e el ella ellas ellos en entre era es esa ese eso esta este esto
+fue ha han hay la las le les lo los mas me mi mis muy ni no nos o otra otro para pero por que se si sin sobre son su sus tambien
+te tiene tu un una uno unos unas y ya yo
+an and are as at be by for from in is it of on or that the this to was with
+""".split())
+
+
+def tokenize(text):
+    """Lowercased, accent-folded word tokens ("Micofenolato" and "micofenolató" match)."""
+    folded = unicodedata.normalize("NFKD", (text or "").lower())
+    folded = "".join(ch for ch in folded if not unicodedata.combining(ch))
+    return [token for token in _TOKEN_RE.findall(folded) if token not in STOPWORDS and len(token) > 1]
+
+
+def reciprocal_rank_fusion(rankings, k=RRF_K):
+    """Fuses several rankings (lists of ids, best first) into [(id, fused score), ...], best first."""
+    scores = {}
+    for ranking in rankings:
+        for rank, item_id in enumerate(ranking):
+            scores[item_id] = scores.get(item_id, 0.0) + 1.0 / (k + rank + 1)
+    return sorted(scores.items(), key=lambda item: item[1], reverse=True)
+
+
+class LexicalIndex:
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS chunks ("
+            "id TEXT PRIMARY KEY, filename TEXT NOT NULL, length INTEGER NOT NULL, terms TEXT NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS ix_chunks_filename ON chunks (filename)")
+        self._conn.commit()
+        self._lock = threading.Lock()
+
+        # In memory: term -> {chunk id: tf}, chunk id -> (filename, length, terms)
+        self._postings = {}
+        self._chunks = {}
+        self._total_length = 0
+        for chunk_id, filename, length, terms in self._conn.execute("SELECT id, filename, length, terms FROM chunks"):
+            self._index(chunk_id, filename, length, json.loads(terms))
+
+    def __len__(self):
+        return len(self._chunks)
+
+    def _index(self, chunk_id, filename, length, terms):
+        self._chunks[chunk_id] = (filename, length, tuple(terms))
+        self._total_length += length
+        for term, tf in terms.items():
+            self._postings.setdefault(term, {})[chunk_id] = tf
+
+    def _unindex(self, chunk_id):
+        _, length, terms = self._chunks.pop(chunk_id)
+        self._total_length -= length
+        for term in terms:
+            postings = self._postings[term]
+            del postings[chunk_id]
+            if not postings:
+                del self._postings[term]
+
+    def add(self, ids, texts, metadatas):
+        """Indexes chunks (replacing chunks with the same ids)."""
+        rows = []
+        with self._lock:
+            for chunk_id, text, meta in zip(ids, texts, metadatas):
+                tokens = tokenize(text)
+                terms = dict(Counter(tokens))
+                if chunk_id in self._chunks:
+                    self._unindex(chunk_id)
+                self._index(chunk_id, meta.get("filename"), len(tokens), terms)
+                rows.append((chunk_id, meta.get("filename"), len(tokens), json.dumps(terms, ensure_ascii=False)))
+            self._conn.executemany("INSERT OR REPLACE INTO chunks (id, filename, length, terms) VALUES (?, ?, ?, ?)", rows)
+            self._conn.commit()
+
+    def delete_filenames(self, filenames):
+        filenames = set(filenames)
+        with self._lock:
+            removed = [chunk_id for chunk_id, (filename, _, _) in self._chunks.items() if filename in filenames]
+            for chunk_id in removed:
+                self._unindex(chunk_id)
+            if removed:
+                self._conn.executemany("DELETE FROM chunks WHERE filename = ?", [(f,) for f in filenames])
+                self._conn.commit()
+            return len(removed)
+
+    def clear(self):
+        with self._lock:
+            self._postings = {}
+            self._chunks = {}
+            self._total_length = 0
+            self._conn.execute("DELETE FROM chunks")
+            self._conn.commit()
+
+    def search(self, query_text, n_results=10, filter_filenames=None):
+        """[(chunk id, BM25 score), ...] best first, restricted to filter_filenames if given."""
+        allowed = set(filter_filenames) if filter_filenames else None
+        scores = {}
+        with self._lock:
+            total = len(self._chunks)
+            if not total:
+                return []
+            avg_length = self._total_length / total or 1.0
+            for term in set(tokenize(query_text)):
+                postings = self._postings.get(term)
+                if not postings:
+                    continue
+                idf = math.log(1 + (total - len(postings) + 0.5) / (len(postings) + 0.5))
+                for chunk_id, tf in postings.items():
+                    filename, length, _ = self._chunks[chunk_id]
+                    if allowed is not None and filename not in allowed:
+                        continue
+                    norm = tf + BM25_K1 * (1 - BM25_B + BM25_B * length / avg_length)
+                    scores[chunk_id] = scores.get(chunk_id, 0.0) + idf * tf * (BM25_K1 + 1) / norm
+        return heapq.nlargest(n_results, scores.items(), key=lambda item: item[1])
@@ -0,0 +1,207 @@
+"""
+Shared HTTP transport for the LLM server (LM Studio / OpenAI-compatible API).
+Keeps a pooled keep-alive session so consecutive calls reuse TCP connections.
+LLMHttpClient (requests) serves the blocking code paths; AsyncLLMHttpClient (httpx)
+serves the async endpoints, where cancelling a call closes its connection.
+"""
+
+import os
+import asyncio
+import threading
+import contextlib
+import httpx
+import requests
+from requests.adapters import HTTPAdapter
+
+# Configuration defaults (can be overridden with environment variables)
+DEFAULT_POOL_SIZE = int(os.getenv("LLM_POOL_SIZE", "10"))
+DEFAULT_CONNECT_TIMEOUT = float(os.getenv("LLM_CONNECT_TIMEOUT", "10"))
+# Generous read timeout to allow for model loading on the first call
+DEFAULT_READ_TIMEOUT = float(os.getenv("LLM_READ_TIMEOUT", "1200"))
+
+
+class LLMHttpClient:
+    """
+    Thread-safe pooled client. One instance is shared by every orchestrator
+    call (generation, sentiment, model listing).
+    """
+
+    def __init__(self, pool_size=None, connect_timeout=None, read_timeout=None):
+        self.pool_size = pool_size or DEFAULT_POOL_SIZE
+        self.timeout = (
+            connect_timeout or DEFAULT_CONNECT_TIMEOUT,
+            read_timeout or DEFAULT_READ_TIMEOUT,
+        )
+
+        # pool_maxsize is the number of keep-alive connections kept per host
+        self._adapter = HTTPAdapter(pool_connections=4, pool_maxsize=self.pool_size)
+        self.session = requests.Session()
+        self.session.mount("http://", self._adapter)
+        self.session.mount("https://", self._adapter)
+        self.session.headers.update({"Connection": "keep-alive"})
+
+        self._lock = threading.Lock()
+        self._total_requests = 0
+        self._failed_requests = 0
+
+    def _request(self, method, url, timeout=None, **kwargs):
+        with self._lock:
+            self._total_requests += 1
+        try:
+            return self.session.request(method, url, timeout=timeout or self.timeout, **kwargs)
+        except Exception:
+            with self._lock:
+                self._failed_requests += 1
+            raise
+
+    def post(self, url, timeout=None, **kwargs):
+        return self._request("POST", url, timeout=timeout, **kwargs)
+
+    def get(self, url, timeout=None, **kwargs):
+        return self._request("GET", url, timeout=timeout, **kwargs)
+
+    def stats(self):
+        """
+        Returns pool usage counters. 'connections_opened' counts new TCP
+        connections, so reuse_rate = 1 - connections_opened / requests.
+        """
+        hosts = []
+        pools = self._adapter.poolmanager.pools
+        for key in pools.keys():
+            pool = pools.get(key)
+            if pool is None:
+                continue
+            num_requests = getattr(pool, "num_requests", 0)
+            num_connections = getattr(pool, "num_connections", 0)
+            hosts.append({
+                "host": f"{pool.scheme}://{pool.host}:{pool.port}",
+                "requests": num_requests,
+                "connections_opened": num_connections,
+                "reuse_rate": round(1 - num_connections / num_requests, 3) if num_requests else 0.0,
+            })
+
+        with self._lock:
+            total_requests = self._total_requests
+            failed_requests = self._failed_requests
+
+        return {
+            "pool_size": self.pool_size,
+            "connect_timeout": self.timeout[0],
+            "read_timeout": self.timeout[1],
+            "total_requests": total_requests,
+            "failed_requests": failed_requests,
+            "hosts": hosts,
+        }
+
+    def close(self):
+        self.session.close()
+
+
+class AsyncLLMHttpClient:
+    """
+    Pooled asyncio client used by the async endpoints. Awaiting a generation does not hold
+    a server thread, and cancelling the awaiting task (client disconnect) closes the
+    connection, which makes LM Studio stop generating. Must be used from one event loop.
+    """
+
+    def __init__(self, pool_size=None, connect_timeout=None, read_timeout=None):
+        self.pool_size = pool_size or DEFAULT_POOL_SIZE
+        self.timeout = (
+            connect_timeout or DEFAULT_CONNECT_TIMEOUT,
+            read_timeout or DEFAULT_READ_TIMEOUT,
+        )
+        self._client = None
+        self._total_requests = 0
+        self._failed_requests = 0
+        self._cancelled_requests = 0
+        self._in_flight = 0
+
+    def _get_client(self):
+        # Created on first use, inside the running event loop
+        if self._client is None:
+            self._client = httpx.AsyncClient(
+                timeout=httpx.Timeout(self.timeout[1], connect=self.timeout[0]),
+                limits=httpx.Limits(max_connections=self.pool_size, max_keepalive_connections=self.pool_size),
+                headers={"Connection": "keep-alive"},
+            )
+        return self._client
+
+    @staticmethod
+    def _timeout(timeout):
+        if timeout is None:
+            return httpx.USE_CLIENT_DEFAULT
+        connect_timeout, read_timeout = timeout
+        return httpx.Timeout(read_timeout, connect=connect_timeout)
+
+    @contextlib.contextmanager
+    def _track(self):
+        self._total_requests += 1
+        self._in_flight += 1
+        try:
+            yield
+        except asyncio.CancelledError:
+            self._cancelled_requests += 1
+            raise
+        except Exception:
+            self._failed_requests += 1
+            raise
+        finally:
+            self._in_flight -= 1
+
+    async def _request(self, method, url, timeout=None, **kwargs):
+        with self._track():
+            return await self._get_client().request(method, url, timeout=self._timeout(timeout), **kwargs)
+
+    async def post(self, url, timeout=None, **kwargs):
+        return await self._request("POST", url, timeout=timeout, **kwargs)
+
+    async def get(self, url, timeout=None, **kwargs):
+        return await self._request("GET", url, timeout=timeout, **kwargs)
+
+    @contextlib.asynccontextmanager
+    async def stream(self, method, url, timeout=None, **kwargs):
+        """Streaming request: the body is read with response.aiter_lines() inside the block."""
+        with self._track():
+            async with self._get_client().stream(method, url, timeout=self._timeout(timeout), **kwargs) as response:
+                yield response
+
+    def stats(self):
+        return {
+            "pool_size": self.pool_size,
+            "connect_timeout": self.timeout[0],
+            "read_timeout": self.timeout[1],
+            "total_requests": self._total_requests,
+            "failed_requests": self._failed_requests,
+            "cancelled_requests": self._cancelled_requests,
+            "in_flight": self._in_flight,
+        }
+
+    async def aclose(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+
+_shared_client = None
+_shared_async_client = None
+_shared_client_lock = threading.Lock()
+
+
+def get_shared_client():
+    """Returns the process-wide client, creating it on first use."""
+    global _shared_client
+    if _shared_client is None:
+        with _shared_client_lock:
+            if _shared_client is None:
+                _shared_client = LLMHttpClient()
+    return _shared_client
+
+
+def get_shared_async_client():
+    """Returns the process-wide async client, creating it on first use."""
+    global _shared_async_client
+    if _shared_async_client is None:
+        with _shared_client_lock:
+            if _shared_async_client is None:
+                _shared_async_client = AsyncLLMHttpClient()
+    return _shared_async_client
@@ -1,16 +1,28 @@
-from fastapi import FastAPI, HTTPException, UploadFile, File, Depends
+from fastapi import FastAPI, HTTPException, UploadFile, File, Depends, Request
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import StreamingResponse, Response
+from fastapi.concurrency import run_in_threadpool
 from pydantic import BaseModel
 from typing import List, Dict, Any, Optional
 import json
 import os
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
 import shutil
 import re
 from datetime import datetime
-from orchestrator import DualLLMOrchestrator
-from rag_manager import RAGManager
+from orchestrator import DualLLMOrchestrator, SENTIMENT_SYSTEM_PROMPT, SENTIMENT_BATCH_SYSTEM_PROMPT, ANALYSIS_SUMMARY_SYSTEM_PROMPT, validate_sentiment_mode
+from sentiment_cache import SentimentCache, prompt_version
+from summary_cache import SummaryCache
+from rag_service import RAGService
+from rag_context import DEFAULT_CHAT_TOKENS, DEFAULT_ANALYSIS_CHAT_TOKENS
+import chunking
+from ingestion_jobs import IngestionJobQueue
+from batch_simulator import BatchSimulator, build_simulation_record
+from analysis_context import AnalysisContextBuilder
 from sqlalchemy.orm import Session
-from database import get_db, init_db
+from database import get_db, init_db, SessionLocal
 import db_helpers
 import traceback
 
@@ -35,8 +47,78 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-orchestrator = DualLLMOrchestrator()
-rag_manager = RAGManager()
+sentiment_cache = SentimentCache(SessionLocal, prompt_version(SENTIMENT_SYSTEM_PROMPT, SENTIMENT_BATCH_SYSTEM_PROMPT))
+sentiment_cache.invalidate_stale()
+summary_cache = SummaryCache(SessionLocal, prompt_version(ANALYSIS_SUMMARY_SYSTEM_PROMPT))
+summary_cache.invalidate_stale()
+orchestrator = DualLLMOrchestrator(sentiment_cache=sentiment_cache, summary_cache=summary_cache)
+# chromadb/docling/embedding model are loaded lazily (or warmed up after startup), see rag_service.py
+rag_service = RAGService()
+ingestion_jobs = IngestionJobQueue(rag_service.get, SessionLocal)
+
+
+# Multi-call flows (map-reduce analysis, simulations, batch sentiment) use the blocking client
+# and can run for minutes: they get their own pool, so they never hold the threads that serve
+# interactive requests (chat RAG retrieval runs on the default threadpool)
+long_flow_executor = ThreadPoolExecutor(
+    max_workers=int(os.getenv("LLM_LONG_FLOW_WORKERS", "4")), thread_name_prefix="llm-long-flow"
+)
+DISCONNECT_POLL_SECONDS = 0.5
+
+
+@app.on_event("startup")
+def start_background_services():
+    rag_service.warm_up_in_background()
+    ingestion_jobs.resume()
+
+@app.on_event("shutdown")
+async def close_llm_clients():
+    await orchestrator.async_http.aclose()
+    long_flow_executor.shutdown(wait=False, cancel_futures=True)
+
+async def run_long_flow(request: Request, fn, *args):
+    """
+    Runs a multi-call LLM flow on the long flow pool. A flow still queued when the client
+    disconnects is dropped (ClientDisconnected). A running flow cannot be interrupted (its LLM
+    calls are blocking) and is awaited to the end, so its DB session is not closed under it.
+    """
+    future = long_flow_executor.submit(functools.partial(fn, *args))
+    waiter = asyncio.wrap_future(future)
+    while not waiter.done():
+        await asyncio.wait({waiter}, timeout=DISCONNECT_POLL_SECONDS)
+        if waiter.done() or not await request.is_disconnected():
+            continue
+        if future.cancel():
+            print(f"Client disconnected, dropping queued flow ({request.url.path})")
+            raise ClientDisconnected()
+        print(f"Client disconnected, letting the running flow finish ({request.url.path})")
+        break
+    return await waiter
+
+class ClientDisconnected(Exception):
+    pass
+
+async def cancel_on_disconnect(request: Request, awaitable):
+    """
+    Awaits an async LLM call while watching the connection: if the client goes away first,
+    the call is cancelled (its request to LM Studio is closed) and ClientDisconnected is raised.
+    """
+    task = asyncio.ensure_future(awaitable)
+    try:
+        while True:
+            done, _ = await asyncio.wait({task}, timeout=DISCONNECT_POLL_SECONDS)
+            if done:
+                return task.result()
+            if await request.is_disconnected():
+                print(f"Client disconnected, cancelling LLM call ({request.url.path})")
+                raise ClientDisconnected()
+    finally:
+        if not task.done():
+            task.cancel()
+
+def client_closed_response():
+    # 499: client closed request (nobody reads it, but it shows up in the access log)
+    return Response(status_code=499)
 
 class ChatRequest(BaseModel):
     message: str
@@ -52,6 +134,7 @@ class ChatRequest(BaseModel):
     presence_penalty: Optional[float] = 0.1
     frequency_penalty: Optional[float] = 0.2
     rag_documents: Optional[List[str]] = []
+    rag_token_budget: Optional[int] = None  # tokens of document excerpts in the prompt
 
 class ChatResponse(BaseModel):
     response: str
@@ -109,25 +192,43 @@ class AnalysisChatRequest(BaseModel):
     frequency_penalty: Optional[float] = 0.0
 
 @app.get("/api/models")
-def get_models():
-    return {"models": orchestrator.list_models()}
+async def get_models():
+    return {"models": await orchestrator.alist_models()}
+
+@app.get("/api/llm_pool_stats")
+def get_llm_pool_stats():
+    """Connection pool usage of the shared LLM HTTP client"""
+    return orchestrator.pool_stats()
+
+def format_rag_excerpts(excerpts) -> str:
+    return "".join(
+        f"--- Excerpt {i+1} ({e['metadata'].get('filename')}, relevance {e['relevance']:.2f}) ---\n{e['document']}\n"
+        for i, e in enumerate(excerpts)
+    )
+
+def build_chat_rag_context(req: ChatRequest) -> str:
+    """RAG retrieval for the psychologist chat (shared by /api/chat and /api/chat_stream)"""
+    context_text = ""
+    if req.rag_documents:
+        print(f"Performing RAG search in documents: {req.rag_documents}")
+        excerpts = rag_service.get().retrieve_context(
+            req.message, req.rag_token_budget or DEFAULT_CHAT_TOKENS,
+            filter_filenames=req.rag_documents, estimate_tokens=orchestrator.estimate_tokens
+        )
+        if excerpts:
+            context_text = "\n\n=== RELEVANT CONTEXT FROM DOCUMENTS ===\n"
+            context_text += format_rag_excerpts(excerpts)
+            context_text += "=======================================\n"
+            print(f"RAG Context: {len(excerpts)} excerpts, ~{sum(e['tokens'] for e in excerpts)} tokens")
+    return context_text
 
 @app.post("/api/chat", response_model=ChatResponse)
-def chat_endpoint(req: ChatRequest):
+async def chat_endpoint(req: ChatRequest, request: Request):
     try:
         # RAG Retrieval
-        context_text = ""
-        if req.rag_documents:
-            print(f"Performing RAG search in documents: {req.rag_documents}")
-            retrieved_docs = rag_manager.query(req.message, n_results=3, filter_filenames=req.rag_documents)
-            if retrieved_docs:
-                context_text = "\n\n=== RELEVANT CONTEXT FROM DOCUMENTS ===\n"
-                for i, doc in enumerate(retrieved_docs):
-                    context_text += f"--- Excerpt {i+1} ---\n{doc}\n"
-                context_text += "=======================================\n"
-                print(f"RAG Context length: {len(context_text)}")
-
-        result = orchestrator.chat_psychologist(
+        context_text = await run_in_threadpool(build_chat_rag_context, req)
+
+        result = await cancel_on_disconnect(request, orchestrator.achat_psychologist(
             req.chatbot_model,
             req.history,
             req.message,
@@ -139,16 +240,73 @@ def chat_endpoint(req: ChatRequest):
             req.presence_penalty,
             req.frequency_penalty,
             context=context_text 
-        )
+        ))
         return ChatResponse(response=result['content'], thought=result['thought'])
+    except ClientDisconnected:
+        return client_closed_response()
     except Exception as e:
         print(f"Error in chat_endpoint: {e}")
         raise HTTPException(status_code=500, detail=str(e))
 
+def sse_event(event: str, data: Dict[str, Any]) -> str:
+    """Formats a Server-Sent Event"""
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+@app.post("/api/chat_stream")
+async def chat_stream_endpoint(req: ChatRequest, request: Request):
+    """
+    Streaming variant of /api/chat (Server-Sent Events).
+    Events: 'thought' and 'token' carry {"text": ...} deltas; 'reset' means the tokens shown so far
+    were reasoning (they are re-sent as 'thought'); the final 'done' event carries the same
+    {response, thought} shape as ChatResponse; 'error' carries {"detail": ...}.
+    """
+    try:
+        context_text = await run_in_threadpool(build_chat_rag_context, req)
+    except Exception as e:
+        print(f"Error in chat_stream_endpoint: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+    async def event_stream():
+        events = orchestrator.astream_chat_psychologist(
+            req.chatbot_model,
+            req.history,
+            req.message,
+            req.psychologist_system_prompt,
+            req.temperature,
+            req.top_p,
+            req.top_k,
+            req.max_tokens,
+            req.presence_penalty,
+            req.frequency_penalty,
+            context=context_text
+        )
+        try:
+            async for event, data in events:
+                if await request.is_disconnected():
+                    print("Client disconnected, stopping chat stream")
+                    break
+                if event == "done":
+                    final = ChatResponse(response=data['content'], thought=data['thought'])
+                    yield sse_event("done", final.dict())
+                else:
+                    yield sse_event(event, {"text": data})
+        except Exception as e:
+            print(f"Error in chat_stream_endpoint: {e}")
+            yield sse_event("error", {"detail": str(e)})
+        finally:
+            # Closes the LLM connection, so generation stops when the client goes away
+            await events.aclose()
+
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
 @app.post("/api/suggest", response_model=SuggestionResponse)
-def suggest_endpoint(req: SuggestionRequest):
+async def suggest_endpoint(req: SuggestionRequest, request: Request):
     try:
-        suggestion_data = orchestrator.generate_suggestion_only(
+        suggestion_data = await cancel_on_disconnect(request, orchestrator.agenerate_suggestion_only(
             req.patient_model,
             req.history,
             req.user_message,
@@ -160,11 +318,13 @@ def suggest_endpoint(req: SuggestionRequest):
             req.max_tokens,
             req.presence_penalty,
             req.frequency_penalty
-        )
+        ))
         return SuggestionResponse(
             suggested_reply=suggestion_data['content'],
             thought=suggestion_data['thought']
         )
+    except ClientDisconnected:
+        return client_closed_response()
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
@@ -222,10 +382,12 @@ def save_prompts(prompts: Dict[str, str]):
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.post("/api/generate_profile")
-def generate_profile(request: GenerateProfileRequest):
+async def generate_profile(request: GenerateProfileRequest, http_request: Request):
     try:
-        profile = orchestrator.generate_patient_profile(request.model, request.guidance)
+        profile = await cancel_on_disconnect(http_request, orchestrator.agenerate_patient_profile(request.model, request.guidance))
         return profile
+    except ClientDisconnected:
+        return client_closed_response()
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
@@ -233,12 +395,16 @@ DIALOGOS_DIR = os.path.join(BASE_DIR, "dialogos")
 if not os.path.exists(DIALOGOS_DIR):
     os.makedirs(DIALOGOS_DIR)
 
+batch_simulator = BatchSimulator(orchestrator, SessionLocal, dialogos_dir=DIALOGOS_DIR)
+
 class SaveInteractionRequest(BaseModel):
     timestamp: str
     config: Dict[str, Any]
     messages: List[Dict[str, Any]]
     filename: Optional[str] = None
     title: Optional[str] = None
+    # Delta save: number of messages the server already has; 'messages' then holds only the new ones
+    known_message_count: Optional[int] = None
 
 @app.post("/api/save_interaction")
 def save_interaction(data: SaveInteractionRequest, db: Session = Depends(get_db)):
@@ -246,15 +412,53 @@ def save_interaction(data: SaveInteractionRequest, db: Session = Depends(get_db)
     try:
         result = db_helpers.save_interaction(db, data.dict())
         return result
+    except db_helpers.MessageCountMismatch as e:
+        db.rollback()
+        raise HTTPException(status_code=409, detail=str(e))
     except Exception as e:
         print(f"Error saving interaction: {e}")
         traceback.print_exc()
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.get("/api/interactions")
-def get_interactions(db: Session = Depends(get_db)):
-    """Get all interactions from database"""
-    return db_helpers.get_all_interactions(db)
+def get_interactions(
+    limit: Optional[int] = None,
+    cursor: Optional[str] = None,
+    patient_id: Optional[str] = None,
+    patient_name: Optional[str] = None,
+    chatbot_model: Optional[str] = None,
+    patient_model: Optional[str] = None,
+    date_from: Optional[datetime] = None,
+    date_to: Optional[datetime] = None,
+    db: Session = Depends(get_db)
+):
+    """
+    Get interactions from database, newest first.
+    With 'limit', 'cursor' or any filter returns a keyset page {items, next_cursor};
+    without it returns the full list, as before.
+    """
+    filters = [patient_id, patient_name, chatbot_model, patient_model, date_from, date_to]
+    if limit is None and cursor is None and not any(filters):
+        return db_helpers.get_all_interactions(db)
+    try:
+        return db_helpers.get_interactions_page(
+            db,
+            limit=max(1, min(limit or 50, 500)),
+            cursor=cursor,
+            patient_id=patient_id,
+            patient_name=patient_name,
+            chatbot_model=chatbot_model,
+            patient_model=patient_model,
+            date_from=date_from,
+            date_to=date_to
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+@app.get("/api/interaction_facets")
+def get_interaction_facets(db: Session = Depends(get_db)):
+    """Distinct patient names and models, for the history filters"""
+    return db_helpers.get_interaction_facets(db)
 
 @app.get("/api/interactions/{filename}")
 def get_interaction_detail(filename: str, db: Session = Depends(get_db)):
@@ -298,6 +502,8 @@ class AnalyzeRequest(BaseModel):
     max_tokens: Optional[int] = 2000
     presence_penalty: Optional[float] = 0.1
     frequency_penalty: Optional[float] = 0.2
+    # "auto" (full transcripts when they fit) or "summary" (cached per-interaction summaries)
+    context_mode: Optional[str] = "auto"
 
 class GenerateInteractionRequest(BaseModel):
     patient_profile: Dict
@@ -308,6 +514,7 @@ class GenerateInteractionRequest(BaseModel):
     turns: Optional[int] = 10
     psychologist_temperature: Optional[float] = 0.7
     patient_temperature: Optional[float] = 0.7
+    sentiment_mode: Optional[str] = "background"  # "background" or "deferred"
 
 class AnalysisChatRequest(BaseModel):
     message: str
@@ -322,29 +529,75 @@ class AnalysisChatRequest(BaseModel):
     max_tokens: Optional[int] = 2000
     presence_penalty: Optional[float] = 0.1
     frequency_penalty: Optional[float] = 0.2
+    # "full" transcripts, cached per-interaction "summary", or "auto" (summaries only when transcripts do not fit)
+    context_mode: Optional[str] = "auto"
+    rag_token_budget: Optional[int] = None  # tokens of document excerpts in the prompt
 
 DOCUMENTS_DIR = os.path.join(BASE_DIR, "documentos")
 if not os.path.exists(DOCUMENTS_DIR):
     os.makedirs(DOCUMENTS_DIR)
 
 @app.post("/api/upload_document")
-async def upload_document(files: List[UploadFile] = File(...), chunk_size: int = 1000, overlap: int = 200):
+def upload_document(files: List[UploadFile] = File(...), chunk_size: int = 1000, overlap: int = 200):
+    """
+    Saves the files and queues their indexing as a background job.
+    Returns immediately with the job id (progress in /api/jobs/{job_id}).
+    """
+    try:
+        chunking.validate(chunk_size, overlap)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     saved_filenames = []
     try:
+        to_index = []
         for file in files:
             filepath = os.path.join(DOCUMENTS_DIR, file.filename)
             with open(filepath, "wb") as buffer:
                 shutil.copyfileobj(file.file, buffer)
             saved_filenames.append(file.filename)
+            to_index.append((file.filename, filepath))
             
-            # Index the document
-            rag_manager.add_document(file.filename, filepath, chunk_size=chunk_size, overlap=overlap)
-            
-        return {"status": "success", "filenames": saved_filenames}
+        job = ingestion_jobs.create(to_index, chunk_size=chunk_size, overlap=overlap)
+        return {"status": "queued", "filenames": saved_filenames, "job_id": job["job_id"]}
     except Exception as e:
         print(f"Error uploading document: {e}")
         raise HTTPException(status_code=500, detail=str(e))
 
+@app.get("/api/jobs/{job_id}")
+def get_ingestion_job(job_id: str):
+    job = ingestion_jobs.get(job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job
+
+@app.get("/api/jobs/{job_id}/events")
+async def stream_ingestion_job(job_id: str):
+    """SSE stream of job progress: 'progress' on every change, then 'done'"""
+    job = await asyncio.to_thread(ingestion_jobs.get, job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail="Job not found")
+
+    async def event_stream():
+        last = None
+        while True:
+            current = await asyncio.to_thread(ingestion_jobs.get, job_id)
+            if current is None:
+                yield sse_event("error", {"message": "Job not found"})
+                return
+            if current != last:
+                yield sse_event("progress", current)
+                last = current
+            if current["status"] == "finished":
+                yield sse_event("done", current)
+                return
+            await asyncio.sleep(0.5)
+
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
 @app.get("/api/documents")
 def get_documents():
     if not os.path.exists(DOCUMENTS_DIR):
@@ -361,7 +614,7 @@ def delete_document(filename: str):
     try:
         os.remove(filepath)
         # Also remove from vector db
-        rag_manager.delete_document(filename)
+        rag_service.get().delete_document(filename)
         return {"status": "success", "message": "Document deleted"}
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
@@ -369,28 +622,48 @@ def delete_document(filename: str):
 class ReindexRequest(BaseModel):
     chunk_size: int = 1000
     overlap: int = 200
+    # Rebuild the whole collection instead of reindexing only what changed
+    force: bool = False
 
 @app.post("/api/reindex_documents")
 def reindex_documents(req: ReindexRequest):
     try:
-        # Clear existing collection
-        rag_manager.clear_collection()
-        
-        files = []
-        # Re-index all files in DOCUMENTS_DIR
-        if os.path.exists(DOCUMENTS_DIR):
-            files = [f for f in os.listdir(DOCUMENTS_DIR) if os.path.isfile(os.path.join(DOCUMENTS_DIR, f))]
-            for filename in files:
-                filepath = os.path.join(DOCUMENTS_DIR, filename)
-                rag_manager.add_document(filename, filepath, chunk_size=req.chunk_size, overlap=req.overlap)
+        chunking.validate(req.chunk_size, req.overlap)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    try:
+        # Incremental: unchanged documents are skipped, orphaned chunks removed
+        report = rag_service.get().reindex(DOCUMENTS_DIR, chunk_size=req.chunk_size, overlap=req.overlap, force=req.force)
+        counts = {}
+        for entry in report:
+            counts[entry["action"]] = counts.get(entry["action"], 0) + 1
+        print(f"Reindex: {counts}")
         
-        return {"status": "success", "message": f"Se re-indexaron {len(files)} documentos."}
+        reindexed = counts.get("converted", 0) + counts.get("rechunked", 0)
+        message = f"Se re-indexaron {reindexed} documentos ({counts.get('skipped', 0)} sin cambios"
+        if counts.get("removed"):
+            message += f", {counts['removed']} eliminados del índice"
+        if counts.get("error"):
+            message += f", {counts['error']} con errores"
+        message += ")."
+        return {"status": "success", "message": message, "documents": report}
     except Exception as e:
         print(f"Error re-indexing: {e}")
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.post("/api/generate_interaction")
-def generate_interaction(req: GenerateInteractionRequest, db: Session = Depends(get_db)):
+async def generate_interaction(req: GenerateInteractionRequest, request: Request, db: Session = Depends(get_db)):
+    try:
+        validate_sentiment_mode(req.sentiment_mode or "background")
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    # A whole simulated conversation (many LLM calls): runs on the long flow pool
+    try:
+        return await run_long_flow(request, run_generate_interaction, req, db)
+    except ClientDisconnected:
+        return client_closed_response()
+
+def run_generate_interaction(req: GenerateInteractionRequest, db: Session):
     try:
         print(f"Received interaction generation request for patient: {req.patient_profile.get('nombre')} with {req.turns} turns.")
         messages = orchestrator.simulate_interaction(
@@ -400,12 +673,12 @@ def generate_interaction(req: GenerateInteractionRequest, db: Session = Depends(
             req.patient_system_prompt,
             turns=req.turns,
             psychologist_temperature=req.psychologist_temperature,
-            patient_temperature=req.patient_temperature
+            patient_temperature=req.patient_temperature,
+            sentiment_mode=req.sentiment_mode
         )
         
         # Save interaction
         now = datetime.now()
-        timestamp_iso = now.isoformat()
         timestamp_safe = now.strftime("%Y-%m-%d_%H-%M-%S")
         patient_name = req.patient_profile.get('nombre', 'Unknown')
         # Sanitize filename: remove invalid chars for Windows/Linux filesystems
@@ -417,21 +690,14 @@ def generate_interaction(req: GenerateInteractionRequest, db: Session = Depends(
         # However, db_helpers.save_interaction generates its own filename based on timestamp. 
         # To reuse the logic and keep consistency, let's construct the data object and pass it to db_helpers.
         
-        data = {
-            "timestamp": timestamp_iso,
-            "config": {
-                "chatbot_model": req.chatbot_model,
-                "patient_model": req.patient_model,
-                "psychologist_system_prompt": req.psychologist_system_prompt,
-                "patient_system_prompt": req.patient_system_prompt,
-                "patient_name": req.patient_profile.get('nombre', 'Unknown'),
-                "mode": "autonomous",
-                # Pass params so they get saved to DB columns too
-                "psychologist_temperature": req.psychologist_temperature,
-                "patient_temperature": req.patient_temperature,
-            },
-            "messages": messages
-        }
+        data = build_simulation_record(req.patient_profile, {
+            "chatbot_model": req.chatbot_model,
+            "patient_model": req.patient_model,
+            "psychologist_system_prompt": req.psychologist_system_prompt,
+            "patient_system_prompt": req.patient_system_prompt,
+            "psychologist_temperature": req.psychologist_temperature,
+            "patient_temperature": req.patient_temperature,
+        }, messages, timestamp=now)
         
         # Save to DB
         # This will create a filename like interaction_TIMESTAMP.json in the DB record
@@ -450,116 +716,97 @@ def generate_interaction(req: GenerateInteractionRequest, db: Session = Depends(
         print(f"Error generating interaction: {e}")
         raise HTTPException(status_code=500, detail=str(e))
 
-@app.post("/api/analyze_interactions")
-def analyze_interactions_endpoint(req: AnalyzeRequest, db: Session = Depends(get_db)):
-    try:
-        # 1. Load content of all selected files from database
-        interactions_content = []
-        patient_models = set()
-        patient_prompts = set()
-        
-        # Get interactions from database
-        # Try to find in DB first
-        db_interactions = db_helpers.get_interactions_by_filenames(db, req.filenames)
-        
-        # Helper to find interaction in DB list
-        def find_in_db(fname):
-            for i in db_interactions:
-                if i.get('filename') == fname:
-                    return i
-            return None
-
-        print(f"DEBUG: Processing {len(req.filenames)} filenames: {req.filenames}")
-        print(f"DEBUG: Filenames type: {type(req.filenames)}")
-        if len(req.filenames) > 0:
-            print(f"DEBUG: First filename repr: {repr(req.filenames[0])}")
-        
-        for fname in req.filenames:
-            data = find_in_db(fname)
-            print(f"DEBUG: find_in_db('{fname}') returned: {'FOUND' if data else 'NONE'}")
-            
-            # Fallback 1: Direct DB lookup for single file (Paranoid check)
-            if not data:
-                print(f"DEBUG: Attempting direct DB lookup for {fname}")
-                direct_data = db_helpers.get_interaction_by_filename(db, fname)
-                if direct_data:
-                    data = direct_data
-                    print(f"DEBUG: Found {fname} via direct DB lookup.")
-
-            # Fallback 2: If not in DB, try loading from disk (JSON file)
-            if not data:
-                fpath = os.path.join(DIALOGOS_DIR, fname)
-                print(f"DEBUG: Checking disk for {fname} at {fpath}")
-                if os.path.exists(fpath):
-                    try:
-                        with open(fpath, 'r', encoding='utf-8') as f:
-                            data = json.load(f)
-                            print(f"DEBUG: Found {fname} on disk.")
-                    except Exception as e:
-                        print(f"Error reading interaction file {fname}: {e}")
-                else:
-                    print(f"DEBUG: {fname} NOT FOUND on disk.")
-            
-            if data:
-                # Extract relevant info for analysis
-                timestamp = data.get('timestamp', 'Unknown Date')
-                config = data.get('config', {})
-                
-                if 'patient_model' in config:
-                    patient_models.add(config['patient_model'])
-                if 'patient_system_prompt' in config:
-                    patient_prompts.add(config['patient_system_prompt'])
-                messages = data.get('messages', [])
-                
-                # Extract patient name from config
-                patient_name = config.get('patient_name', 'Unknown Patient')
-                
-                # Format conversation
-                conversation_text = f"--- Interaction Date: {timestamp} | Patient: {patient_name} ---\n"
-                for msg in messages:
-                    role = msg.get('role', 'unknown')
-                    content = msg.get('content', '')
-                    conversation_text += f"{role.upper()}: {content}\n"
-                
-                interactions_content.append(conversation_text)
-            else:
-                 print(f"Warning: Interaction {fname} not found in DB or disk.")
-        
-        if not interactions_content and not req.document_filenames: # Modified condition
-            return {"analysis": "No se encontraron interacciones o documentos válidos para analizar."}
-            
+class BatchPatient(BaseModel):
+    patient_profile: Dict
+    patient_system_prompt: str
 
+class BatchPromptConfig(BaseModel):
+    psychologist_system_prompt: str
+    chatbot_model: str
+    patient_model: str
+    psychologist_temperature: Optional[float] = 0.7
+    patient_temperature: Optional[float] = 0.7
 
+class BatchGenerateRequest(BaseModel):
+    patients: List[BatchPatient]
+    configs: List[BatchPromptConfig]
+    turns: Optional[int] = 10
+    max_concurrency_per_model: Optional[int] = None
+    sentiment_mode: Optional[str] = "background"
 
+@app.post("/api/batch_generate_interactions")
+def batch_generate_interactions(req: BatchGenerateRequest):
+    """
+    Runs every patient x prompt configuration concurrently in the background.
+    Each interaction is saved as soon as it finishes; poll the returned batch_id for progress.
+    """
+    if not req.patients or not req.configs:
+        raise HTTPException(status_code=400, detail="Se requiere al menos un paciente y una configuración.")
+    jobs = BatchSimulator.expand_jobs(
+        [p.dict() for p in req.patients],
+        [c.dict() for c in req.configs]
+    )
+    try:
+        batch = batch_simulator.submit(
+            jobs,
+            turns=req.turns,
+            max_concurrency_per_model=req.max_concurrency_per_model,
+            sentiment_mode=req.sentiment_mode
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return batch.to_dict()
 
+@app.get("/api/batch_generate_interactions/{batch_id}")
+def get_batch_generation(batch_id: str):
+    batch = batch_simulator.get(batch_id)
+    if not batch:
+        raise HTTPException(status_code=404, detail="Batch not found")
+    return batch.to_dict()
 
+@app.post("/api/analyze_interactions")
+async def analyze_interactions_endpoint(req: AnalyzeRequest, request: Request, db: Session = Depends(get_db)):
+    # Map-reduce over the selected interactions (many LLM calls): runs on the long flow pool
+    try:
+        return await run_long_flow(request, run_analyze_interactions, req, db)
+    except ClientDisconnected:
+        return client_closed_response()
 
+def run_analyze_interactions(req: AnalyzeRequest, db: Session):
+    try:
+        # 1. Load content of all selected interactions (single query, disk fallback)
+        context = AnalysisContextBuilder(db, DIALOGOS_DIR).build_analysis_context(req.filenames)
+        interactions_content = context["parts"]
+        patient_models = context["patient_models"]
+        patient_prompts = context["patient_prompts"]
 
+        if not interactions_content and not req.document_filenames: # Modified condition
+            return {"analysis": "No se encontraron interacciones o documentos válidos para analizar."}
 
-            
-        full_context = "\n\n".join(interactions_content)
+        # Context parts (one per interaction / document): the orchestrator map-reduces
+        # them when they do not fit the model's context window
+        context_parts = list(interactions_content)
 
         # 2. Append Documents Content if any
         if req.document_filenames:
-            full_context += "\n\n=== REFERENCE DOCUMENTS ===\n"
             for doc_name in req.document_filenames:
                 doc_path = os.path.join(DOCUMENTS_DIR, doc_name)
                 if os.path.exists(doc_path):
                     try:
-                        # Use docling via rag_manager to get text
-                        conv_result = rag_manager.doc_converter.convert(doc_path)
-                        content = conv_result.document.export_to_markdown()
+                        # Use docling via the RAG manager to get text (cached per file content)
+                        content = rag_service.get().get_markdown(doc_path)
                         
-                        full_context += f"\n--- Document: {doc_name} ---\n{content}\n"
+                        context_parts.append(f"=== REFERENCE DOCUMENT ===\n--- Document: {doc_name} ---\n{content}\n")
                     except Exception as e:
                         print(f"Error reading document {doc_name}: {e}")
-                        full_context += f"\n--- Document: {doc_name} (Error reading content) ---\n"
+                        context_parts.append(f"=== REFERENCE DOCUMENT ===\n--- Document: {doc_name} (Error reading content) ---\n")
         
         # 3. Call Orchestrator to analyze
         analysis = orchestrator.analyze_interactions(
             req.model, 
-            full_context, 
+            context_parts, 
             req.prompt,
+            use_summaries=req.context_mode == "summary",
             temperature=req.temperature,
             top_p=req.top_p,
             top_k=req.top_k,
@@ -579,48 +826,53 @@ def analyze_interactions_endpoint(req: AnalyzeRequest, db: Session = Depends(get
         print(f"Error analyzing interactions: {e}")
         raise HTTPException(status_code=500, detail=str(e))
 
+def build_analysis_chat_context(req: AnalysisChatRequest, db: Session) -> str:
+    """Interactions (summarized when they do not fit) + RAG excerpts for /api/analysis_chat"""
+    # 1. Get Interactions Content from database (single query)
+    builder = AnalysisContextBuilder(db)
+    interactions = builder.load(req.interaction_filenames)
+    interactions_text = builder.format_chat_context(interactions)
+    if interactions and req.context_mode != "full":
+        # Room left for transcripts: answer, system prompt, conversation and RAG chunks
+        reserved = req.max_tokens + orchestrator.estimate_tokens(
+            (req.system_prompt or "") + req.message + "".join(m.get('content', '') for m in req.history)
+        ) + (2000 if req.document_filenames else 0)
+        if req.context_mode == "summary" or orchestrator.estimate_tokens(interactions_text) > orchestrator.context_budget(req.model, reserved):
+            summaries = orchestrator.summarize_parts(req.model, builder.analysis_parts(interactions))
+            interactions_text = builder.format_chat_context(interactions, summaries)
+    
+    # 2. Get RAG Content
+    rag_text = ""
+    if req.document_filenames:
+        # We query the RAG system with the user's message
+        # But we filter by the selected documents
+        excerpts = rag_service.get().retrieve_context(
+            req.message, req.rag_token_budget or DEFAULT_ANALYSIS_CHAT_TOKENS,
+            filter_filenames=req.document_filenames, estimate_tokens=orchestrator.estimate_tokens
+        )
+        if excerpts:
+            rag_text = format_rag_excerpts(excerpts)
+        else:
+            rag_text = "No relevant document chunks found for this query."
+    
+    # 3. Combine Context
+    full_context = ""
+    if interactions_text:
+        full_context += f"--- SELECTED INTERACTIONS ---\n{interactions_text}\n"
+    if rag_text:
+        full_context += f"\n--- RELEVANT DOCUMENT CHUNKS (RAG) ---\n{rag_text}\n"
+        
+    if not full_context:
+        full_context = "No context selected."
+    return full_context
+
 @app.post("/api/analysis_chat")
-def analysis_chat_endpoint(req: AnalysisChatRequest, db: Session = Depends(get_db)):
+async def analysis_chat_endpoint(req: AnalysisChatRequest, request: Request, db: Session = Depends(get_db)):
     try:
-        # 1. Get Interactions Content from database
-        interactions_text = ""
-        
-        # Get interactions from database
-        interactions = db_helpers.get_interactions_by_filenames(db, req.interaction_filenames)
-        
-        for data in interactions:
-            timestamp = data.get('timestamp', 'Unknown')
-            patient = data.get('config', {}).get('patient_name', 'Unknown')
-            # Find filename from all interactions
-            all_ints = db_helpers.get_all_interactions(db)
-            filename = next((i['filename'] for i in all_ints if i['timestamp'] == timestamp), 'unknown')
-            interactions_text += f"\n--- Interaction: {filename} ({timestamp}, Patient: {patient}) ---\n"
-            for msg in data.get('messages', []):
-                interactions_text += f"{msg.get('role', 'unknown').upper()}: {msg.get('content', '')}\n"
-        
-        # 2. Get RAG Content
-        rag_text = ""
-        if req.document_filenames:
-            # We query the RAG system with the user's message
-            # But we filter by the selected documents
-            docs = rag_manager.query(req.message, n_results=5, filter_filenames=req.document_filenames)
-            if docs:
-                rag_text = "\n".join(docs)
-            else:
-                rag_text = "No relevant document chunks found for this query."
-        
-        # 3. Combine Context
-        full_context = ""
-        if interactions_text:
-            full_context += f"--- SELECTED INTERACTIONS ---\n{interactions_text}\n"
-        if rag_text:
-            full_context += f"\n--- RELEVANT DOCUMENT CHUNKS (RAG) ---\n{rag_text}\n"
-            
-        if not full_context:
-            full_context = "No context selected."
-            
-        # 4. Call Orchestrator
-        response = orchestrator.chat_analysis(
+        # DB, summaries and RAG are blocking work (default threadpool); the chat call itself is async
+        full_context = await run_in_threadpool(build_analysis_chat_context, req, db)
+
+        response = await cancel_on_disconnect(request, orchestrator.achat_analysis(
             req.model, 
             req.history + [{"role": "user", "content": req.message}], 
             req.system_prompt, 
@@ -631,10 +883,12 @@ def analysis_chat_endpoint(req: AnalysisChatRequest, db: Session = Depends(get_d
             max_tokens=req.max_tokens,
             presence_penalty=req.presence_penalty,
             frequency_penalty=req.frequency_penalty
-        )
+        ))
         
         return {"response": response}
         
+    except ClientDisconnected:
+        return client_closed_response()
     except Exception as e:
         print(f"Error in analysis chat: {e}")
         raise HTTPException(status_code=500, detail=str(e))
@@ -644,25 +898,65 @@ class AnalyzeSentimentRequest(BaseModel):
     model: Optional[str] = None
 
 @app.post("/api/analyze_sentiment")
-def analyze_sentiment_endpoint(req: AnalyzeSentimentRequest):
+async def analyze_sentiment_endpoint(req: AnalyzeSentimentRequest, request: Request):
     try:
         # Use a model from the request or fallback (Orchestrator handles default)
-        result = orchestrator.analyze_sentiment(req.message, req.model)
+        result = await cancel_on_disconnect(request, orchestrator.aanalyze_sentiment(req.message, req.model))
         return result if result else {}
+    except ClientDisconnected:
+        return client_closed_response()
     except Exception as e:
         print(f"Error in sentiment endpoint: {e}")
         raise HTTPException(status_code=500, detail=str(e))
 
+@app.get("/api/sentiment_cache_stats")
+def get_sentiment_cache_stats():
+    """Hit/miss counters and size of the sentiment cache"""
+    return sentiment_cache.stats()
+
+@app.get("/api/embedding_cache_stats")
+def get_embedding_cache_stats():
+    """Hit/miss counters and size of the RAG embedding cache"""
+    if not rag_service.ready:
+        # Stats are not worth loading the RAG stack for
+        return {"loaded": False}
+    return rag_service.get().embedding_cache.stats()
+
+@app.get("/api/rag_query_cache_stats")
+def get_rag_query_cache_stats():
+    """Hit rate and size of the RAG retrieval result cache"""
+    if not rag_service.ready:
+        return {"loaded": False}
+    return rag_service.get().query_cache.stats()
+
+@app.get("/api/ready")
+def get_readiness():
+    """Which subsystems are loaded; the RAG stack warms up in the background after startup"""
+    status = rag_service.status()
+    status["subsystems"] = {"database": {"state": "ready"}, **status["subsystems"]}
+    return status
+
+@app.get("/api/summary_cache_stats")
+def get_summary_cache_stats():
+    """Hit/miss counters and size of the per-interaction analysis summary cache"""
+    return summary_cache.stats()
+
 class BatchAnalyzeRequest(BaseModel):
     filenames: List[str]
     model: Optional[str] = None
 
 @app.post("/api/batch_analyze_sentiment")
-def batch_analyze_sentiment_endpoint(req: BatchAnalyzeRequest, db: Session = Depends(get_db)):
+async def batch_analyze_sentiment_endpoint(req: BatchAnalyzeRequest, request: Request, db: Session = Depends(get_db)):
     """
     Analyzes sentiment for ALL user messages in the specified interactions
     that do not yet have sentiment analysis.
     """
+    try:
+        return await run_long_flow(request, run_batch_analyze_sentiment, req, db)
+    except ClientDisconnected:
+        return client_closed_response()
+
+def run_batch_analyze_sentiment(req: BatchAnalyzeRequest, db: Session):
     results = {
         "processed": 0,
         "analyzed": 0,
@@ -680,29 +974,41 @@ def batch_analyze_sentiment_endpoint(req: BatchAnalyzeRequest, db: Session = Dep
         
         interactions = db.query(Interaction).filter(Interaction.filename.in_(req.filenames)).all()
         
+        # Collect unscored patient messages, grouped by the model that will score them
+        pending_by_model = {}
+        messages_by_id = {}
         for interaction in interactions:
             results["processed"] += 1
             chatbot_model = interaction.chatbot_model or "mental_llama3.1-8b-mix-sft"
             target_model = req.model if req.model else chatbot_model
             
-            updated = False
             for msg in interaction.messages:
                 if msg.role == 'user' and not msg.sentiment:
-                    # Analyze!
-                    print(f"Analyzing sentiment for msg {msg.id} in {interaction.filename}...")
-                    try:
-                        sentiment = orchestrator.analyze_sentiment(msg.content, model=target_model)
-                        if sentiment:
-                            msg.sentiment = sentiment
-                            results["analyzed"] += 1
-                            updated = True
-                    except Exception as e:
-                        print(f"Error analyzing msg {msg.id}: {e}")
-                        results["errors"] += 1
-                        results["details"].append(f"Error in {interaction.filename}: {str(e)}")
+                    pending_by_model.setdefault(target_model, []).append((msg.id, msg.content))
+                    messages_by_id[msg.id] = (msg, interaction.filename)
+        
+        # Several messages per LLM call; unparseable batches fall back to one call per message
+        for target_model, items in pending_by_model.items():
+            print(f"Analyzing sentiment for {len(items)} messages with {target_model}...")
+            try:
+                scored = orchestrator.analyze_sentiment_batch(items, model=target_model)
+            except Exception as e:
+                print(f"Error analyzing batch with {target_model}: {e}")
+                results["errors"] += len(items)
+                results["details"].append(f"Error with model {target_model}: {str(e)}")
+                continue
             
-            if updated:
-                db.commit()
+            for msg_id, sentiment in scored.items():
+                msg, filename = messages_by_id[msg_id]
+                if sentiment:
+                    msg.sentiment = sentiment
+                    results["analyzed"] += 1
+                else:
+                    results["errors"] += 1
+                    results["details"].append(f"Error in {filename}: could not analyze message {msg_id}")
+        
+        if results["analyzed"]:
+            db.commit()
                 
         return results
 
@@ -1,140 +1,205 @@
-import requests
 import json
 import re
-import html
 import os
 import ast
+import time
+import threading
+import contextlib
+from concurrent.futures import ThreadPoolExecutor
+from llm_client import get_shared_client, get_shared_async_client
+from thought_parser import extract_thought_and_response, ThoughtStreamParser
 
 # Configuration defaults (can be overridden)
 DEFAULT_API_URL = "http://127.0.0.1:1234/v1/chat/completions"
 DEFAULT_MODEL_CHATBOT = "mental_llama3.1-8b-mix-sft" # Psychologist
 DEFAULT_MODEL_PATIENT = "openai/gpt-oss-20b" # Patient Helper
+SENTIMENT_WORKERS = int(os.getenv("SENTIMENT_WORKERS", "4"))
+# When simulate_interaction scores patient sentiment
+SENTIMENT_MODES = ("background", "deferred")
+# Batched sentiment scoring: prompt size per call and output tokens reserved per message
+SENTIMENT_BATCH_TOKEN_BUDGET = int(os.getenv("SENTIMENT_BATCH_TOKEN_BUDGET", "2000"))
+SENTIMENT_BATCH_MAX_MESSAGES = int(os.getenv("SENTIMENT_BATCH_MAX_MESSAGES", "20"))
+SENTIMENT_TOKENS_PER_RESULT = 70
+# Map-reduce analysis: context length used when the server does not report one,
+# parallel summary calls and output tokens per summary
+ANALYSIS_CONTEXT_TOKENS = int(os.getenv("ANALYSIS_CONTEXT_TOKENS", "4096"))
+# Seconds before asking the server again for a context length it did not report
+CONTEXT_LENGTH_RETRY_SECONDS = float(os.getenv("CONTEXT_LENGTH_RETRY_SECONDS", "300"))
+ANALYSIS_MAP_WORKERS = int(os.getenv("ANALYSIS_MAP_WORKERS", "4"))
+ANALYSIS_SUMMARY_TOKENS = int(os.getenv("ANALYSIS_SUMMARY_TOKENS", "400"))
+# Conservative estimate (Spanish transcripts run ~3-4 characters per token)
+ANALYSIS_CHARS_PER_TOKEN = 3
+# Room for chat template tokens and the instructions wrapped around the context
+ANALYSIS_PROMPT_OVERHEAD_TOKENS = 200
+
+ANALYSIS_SUMMARY_SYSTEM_PROMPT = (
+    "Sos un supervisor clínico experto en trasplante renal y salud conductual.\n"
+    "Vas a recibir un fragmento de contexto para un análisis posterior: la transcripción (o parte de ella) de una sesión "
+    "simulada entre un Psicólogo (IA) y un Paciente (IA), un documento de referencia, o resúmenes previos.\n"
+    "Resumilo de forma fiel y concisa conservando lo clínicamente relevante: temas tratados, estrategias del psicólogo, "
+    "reacciones y coherencia del paciente, barreras y facilitadores de la adherencia, y cualquier problema de calidad. "
+    "Mantené la fecha y el nombre del paciente si aparecen. No agregues información que no esté en el texto."
+)
+
+SENTIMENT_PARAMETERS_PROMPT = (
+    "en una escala del 0 al 10 (donde 0 es nada/muy bajo y 10 es máximo/muy alto).\n"
+    "También evalúa la valencia emocional de -5 (muy negativa) a +5 (muy positiva).\n\n"
+    "Parámetros a evaluar:\n"
+    "- valencia: -5 a +5\n"
+    "- intensidad: 0 a 10 (intensidad de la emoción expresada)\n"
+    "- frustracion: 0 a 10\n"
+    "- hostilidad: 0 a 10\n"
+    "- desesperanza: 0 a 10\n"
+    "- autoeficacia: 0 a 10 (creencia en su propia capacidad de manejar su salud)\n\n"
+)
+
+SENTIMENT_SYSTEM_PROMPT = (
+    "Eres un experto en psicometría y análisis de sentimiento clínico. "
+    "Tu tarea es analizar el siguiente mensaje de un paciente renal y puntuar los siguientes parámetros "
+    + SENTIMENT_PARAMETERS_PROMPT +
+    "Salida OBLIGATORIA: Un único objeto JSON con estas claves. Sin explicaciones ni texto extra."
+)
+
+SENTIMENT_BATCH_SYSTEM_PROMPT = (
+    "Eres un experto en psicometría y análisis de sentimiento clínico. "
+    "Tu tarea es analizar CADA UNO de los siguientes mensajes de un paciente renal (cada uno precedido por su [id=...]) "
+    "y puntuar por separado los siguientes parámetros "
+    + SENTIMENT_PARAMETERS_PROMPT +
+    "Salida OBLIGATORIA: Un único array JSON con un objeto por mensaje, cada uno con la clave \"id\" (el id del mensaje) "
+    "y estas claves. Sin explicaciones ni texto extra."
+)
+
+# Patient profiles are always generated with this model
+PROFILE_MODEL = "openai/gpt-oss-20b"
+
+def validate_sentiment_mode(sentiment_mode):
+    if sentiment_mode not in SENTIMENT_MODES:
+        raise ValueError(f"sentiment_mode debe ser uno de: {', '.join(SENTIMENT_MODES)}.")
+
 
 class DualLLMOrchestrator:
-    def __init__(self, api_url=None):
+    def __init__(self, api_url=None, http_client=None, sentiment_cache=None, summary_cache=None, async_http_client=None):
         self.api_url = api_url or os.getenv("LLM_API_URL", DEFAULT_API_URL)
+        # Optional persistent cache for sentiment scores (see sentiment_cache.py)
+        self.sentiment_cache = sentiment_cache
+        # Optional persistent cache for per-interaction analysis summaries (see summary_cache.py)
+        self.summary_cache = summary_cache
+        # Pooled keep-alive transport shared by every generation path
+        self.http = http_client or get_shared_client()
+        # asyncio transport for the async endpoints (a*-prefixed methods)
+        self.async_http = async_http_client or get_shared_async_client()
+        # Worker pool for sentiment scoring, created on first use
+        self._sentiment_executor = None
+        self._sentiment_executor_lock = threading.Lock()
+        # model -> (context window, expiry or None), see get_context_length
+        self._context_lengths = {}
+
+    def pool_stats(self):
+        stats = self.http.stats()
+        stats["async"] = self.async_http.stats()
+        return stats
+
+    @staticmethod
+    def _llm_payload(model, messages, temperature=0.7, max_tokens=2000, top_p=0.9, top_k=40, presence_penalty=0.1, frequency_penalty=0.2, stream=False):
+        payload = {
+            "model": model,
+            "messages": messages,
+            "temperature": temperature,
+            "max_tokens": max_tokens,
+            "top_p": top_p,
+            "top_k": top_k,
+            "presence_penalty": presence_penalty,
+            "frequency_penalty": frequency_penalty
+        }
+        if stream:
+            payload["stream"] = True
+        return payload
+
+    @staticmethod
+    def _llm_error_message(error, response):
+        """Error text with the server's error details when there is a response (requests or httpx)."""
+        error_msg = str(error)
+        if response is not None:
+            try:
+                error_detail = response.json()
+                if 'error' in error_detail:
+                    error_msg += f" Details: {json.dumps(error_detail['error'])}"
+                else:
+                    error_msg += f" Response: {response.text}"
+            except:
+                error_msg += f" Response: {response.text}"
+        return error_msg
+
+    @staticmethod
+    def _parse_stream_line(line):
+        """
+        One line of an OpenAI-compatible SSE body ('data: {...}').
+        Returns (finished, content delta or None).
+        """
+        if not line or not line.startswith("data:"):
+            return False, None
+        data = line[len("data:"):].strip()
+        if data == "[DONE]":
+            return True, None
+        try:
+            chunk = json.loads(data)
+        except json.JSONDecodeError:
+            return False, None
+        choices = chunk.get("choices") or [{}]
+        return False, (choices[0].get("delta") or {}).get("content")
 
     def _call_llm(self, model, messages, temperature=0.7, max_tokens=2000, top_p=0.9, top_k=40, presence_penalty=0.1, frequency_penalty=0.2):
+        response = None
         try:
-            payload = {
-                "model": model,
-                "messages": messages,
-                "temperature": temperature,
-                "max_tokens": max_tokens,
-                "top_p": top_p,
-                "top_k": top_k,
-                "presence_penalty": presence_penalty,
-                "frequency_penalty": frequency_penalty
-            }
-            # Increased timeout to allow for model loading
-            response = requests.post(self.api_url, json=payload, timeout=1200)
+            payload = self._llm_payload(model, messages, temperature, max_tokens, top_p, top_k, presence_penalty, frequency_penalty)
+            # Connect/read timeouts come from the shared client (read timeout allows for model loading)
+            response = self.http.post(self.api_url, json=payload)
             response.raise_for_status()
             data = response.json()
             return data["choices"][0]["message"]["content"]
         except Exception as e:
-            error_msg = str(e)
-            if 'response' in locals() and response is not None:
-                try:
-                    error_detail = response.json()
-                    if 'error' in error_detail:
-                        error_msg += f" Details: {json.dumps(error_detail['error'])}"
-                    else:
-                        error_msg += f" Response: {response.text}"
-                except:
-                    error_msg += f" Response: {response.text}"
-            
+            error_msg = self._llm_error_message(e, response)
+            print(f"Error calling LLM {model}: {error_msg}")
+            raise Exception(f"LLM Call Failed: {error_msg}")
+
+    async def _acall_llm(self, model, messages, temperature=0.7, max_tokens=2000, top_p=0.9, top_k=40, presence_penalty=0.1, frequency_penalty=0.2):
+        """Async _call_llm. Cancelling the awaiting task aborts the request."""
+        response = None
+        try:
+            payload = self._llm_payload(model, messages, temperature, max_tokens, top_p, top_k, presence_penalty, frequency_penalty)
+            response = await self.async_http.post(self.api_url, json=payload)
+            response.raise_for_status()
+            data = response.json()
+            return data["choices"][0]["message"]["content"]
+        except Exception as e:
+            error_msg = self._llm_error_message(e, response)
             print(f"Error calling LLM {model}: {error_msg}")
             raise Exception(f"LLM Call Failed: {error_msg}")
 
+    async def _astream_llm(self, model, messages, temperature=0.7, max_tokens=2000, top_p=0.9, top_k=40, presence_penalty=0.1, frequency_penalty=0.2):
+        """
+        Calls the LLM with stream=True and yields content deltas as they arrive
+        (OpenAI-compatible 'data: {...}' server-sent events). Closing the generator closes the
+        connection, so generation stops.
+        """
+        payload = self._llm_payload(model, messages, temperature, max_tokens, top_p, top_k, presence_penalty, frequency_penalty, stream=True)
+        async with self.async_http.stream("POST", self.api_url, json=payload) as response:
+            if response.status_code >= 400:
+                body = (await response.aread()).decode("utf-8", errors="replace")
+                raise Exception(f"LLM Call Failed: {response.status_code} Response: {body}")
+            async for line in response.aiter_lines():
+                finished, delta = self._parse_stream_line(line)
+                if finished:
+                    break
+                if delta:
+                    yield delta
+
     def _extract_thought_and_response(self, text: str) -> dict:
         """
         Extracts thinking blocks and cleaning artifacts. 
         Returns a dict: {'thought': str|None, 'content': str}
         """
-        if not text:
-             return {"thought": None, "content": ""}
-             
-        text = html.unescape(text) # Handle encoded tags
-        thought = None
-        cleaned_text = text
-
-        # 1. Try standard <think> blocks first (Most reliable, handling optional spaces)
-        think_match = re.search(r"<\s*think\s*>(.*?)<\s*/\s*think\s*>", text, flags=re.DOTALL | re.IGNORECASE)
-        if think_match:
-            thought = think_match.group(1).strip()
-            # Remove the think block from the text
-            cleaned_text = re.sub(r"<\s*think\s*>.*?<\s*/\s*think\s*>", "", cleaned_text, flags=re.DOTALL | re.IGNORECASE)
-        
-        # 2. If no <think>, try <thought> blocks
-        if not thought:
-            thought_match = re.search(r"<thought>(.*?)</thought>", text, flags=re.DOTALL)
-            if thought_match:
-                thought = thought_match.group(1).strip()
-                cleaned_text = re.sub(r"<thought>.*?</thought>", "", cleaned_text, flags=re.DOTALL)
-                
-            # 3. If still no thought, check for unclosed/malformed tags
-            elif "<thought>" in text: # Unclosed <thought>
-                parts = text.split("<thought>", 1)
-                if len(parts) > 1:
-                    thought = parts[1].strip()
-                    cleaned_text = parts[0].strip()
-            
-            elif "<think>" in text: # Unclosed <think> (start only)
-                parts = text.split("<think>", 1)
-                if len(parts) > 1:
-                    thought = parts[1].strip()
-                    cleaned_text = parts[0].strip()
-            
-            elif "</think>" in text: # Unclosed </think> (end only, missing start)
-                 split_match = re.split(r"</think>", text, flags=re.DOTALL, maxsplit=1)
-                 if len(split_match) > 1:
-                     thought = split_match[0].strip()
-                     cleaned_text = split_match[1]
-
-        # 4. Fallback: Check for "Thought:" headers if still no thought
-        if not thought:
-             # Look for "Thought:" or "Reasoning:" at the very beginning
-             header_match = re.match(r"^(?:Thought|Reasoning|Pensamiento|Análisis):", cleaned_text, flags=re.IGNORECASE | re.MULTILINE)
-             if header_match:
-                 # It starts with a header. We assume the thought goes until "Response:" or end of first paragraph/block
-                 split_match = re.split(r"(?:^|\n)(?:Response|Answer|Respuesta|Contestación):", cleaned_text, flags=re.IGNORECASE)
-                 if len(split_match) > 1:
-                     thought = re.sub(r"^(?:Thought|Reasoning|Pensamiento|Análisis):\s*", "", split_match[0], flags=re.IGNORECASE | re.MULTILINE).strip()
-                     cleaned_text = split_match[-1]
-                 else:
-                     # If no explicit "Response:", maybe it's just one block? checking for double newline separator
-                     parts = re.split(r"\n\s*\n", cleaned_text, maxsplit=1)
-                     if len(parts) > 1:
-                         thought = re.sub(r"^(?:Thought|Reasoning|Pensamiento|Análisis):\s*", "", parts[0], flags=re.IGNORECASE | re.MULTILINE).strip()
-                         cleaned_text = parts[1]
-
-        # 5. Cleanup artifacts
-        # Remove empty thinking artifacts left over
-        cleaned_text = re.sub(r"<think>.*$", "", cleaned_text, flags=re.DOTALL)
-
-        # Remove other common reasoning markers
-        cleaned_text = re.sub(r"<\|thought\|>.*?(<\|/thought\|>|$)", "", cleaned_text, flags=re.DOTALL)
-        cleaned_text = re.sub(r"<reasoning>.*?(</reasoning>|$)", "", cleaned_text, flags=re.DOTALL)
-        
-        # Remove <|channel|>... tags
-        cleaned_text = re.sub(r"<\|.*?\|>.*?(?=\b[A-ZÁÉÍÓÚÑ]|$)", "", cleaned_text, flags=re.DOTALL) 
-        cleaned_text = re.sub(r"<\|.*?\|>", "", cleaned_text)
-        
-        # Remove <｜begin of sentence｜>Human:
-        cleaned_text = re.sub(r"<｜.*?｜>Human:", "", cleaned_text, flags=re.IGNORECASE)
-        cleaned_text = re.sub(r"<｜.*?｜>", "", cleaned_text)
-
-        # Final check: Is content empty but we have a thought?
-        final_content = cleaned_text.strip()
-        if not final_content and thought:
-            # Heuristic: The model might have been cut off or put everything in thought
-            final_content = "[El modelo generó un pensamiento interno pero no completó la respuesta externa.]"
-            
-        # FORCE DISPLAY: If no thought found, provide a placeholder so UI shows the box
-        if not thought:
-            thought = "[No se detectó razonamiento interno explícito en esta respuesta]"
-
-        return {"thought": thought, "content": final_content}
+        return extract_thought_and_response(text)
 
     def _optimize_system_prompt(self, base_prompt, model_name):
         """
@@ -199,10 +264,24 @@ class DualLLMOrchestrator:
 
         return optimized_prompt
 
-    def get_patient_suggestion(self, patient_model, history, psychologist_message, system_prompt=None, temperature=0.7, top_p=0.9, top_k=40, max_tokens=600, presence_penalty=0.1, frequency_penalty=0.2):
+    async def aget_patient_suggestion(self, patient_model, history, psychologist_message, system_prompt=None, temperature=0.7, top_p=0.9, top_k=40, max_tokens=600, presence_penalty=0.1, frequency_penalty=0.2):
         """
         Generates a suggested reply for the patient (user) based on the psychologist's message.
         """
+        messages = self._build_patient_messages(patient_model, history, psychologist_message, system_prompt)
+        return await self._acall_llm(
+            patient_model,
+            messages,
+            temperature=temperature,
+            top_p=top_p,
+            top_k=top_k,
+            max_tokens=max_tokens,
+            presence_penalty=presence_penalty,
+            frequency_penalty=frequency_penalty
+        )
+
+    def _build_patient_messages(self, patient_model, history, psychologist_message, system_prompt=None):
+        """Messages for the patient model (roles inverted, latest 'new day' event reinforced)."""
         default_prompt = (
             "Sos el PACIENTE, receptor de trasplante de riñón.\n"
             "HABLÁS SIEMPRE en primera persona, como si realmente fueras el paciente.\n"
@@ -302,21 +381,11 @@ class DualLLMOrchestrator:
         print(f"=== END DEBUG ===\n")
         import sys
         sys.stdout.flush()  # Force output to appear immediately
+        return messages
 
-        return self._call_llm(
-            patient_model, 
-            messages, 
-            temperature=temperature,
-            top_p=top_p,
-            top_k=top_k,
-            max_tokens=max_tokens,
-            presence_penalty=presence_penalty,
-            frequency_penalty=frequency_penalty
-        )
-
-    def chat_psychologist(self, chatbot_model, history, user_message, psychologist_system_prompt=None, temperature=0.7, top_p=0.9, top_k=40, max_tokens=600, presence_penalty=0.1, frequency_penalty=0.2, context=None):
+    def _build_psychologist_messages(self, chatbot_model, history, user_message, psychologist_system_prompt=None, context=None):
         """
-        Step 1: Chatbot (Psychologist) responds.
+        Builds the message list for the Psychologist (shared by blocking and streaming chat).
         """
         default_psico_prompt = (
             "Sos un asistente especializado en salud conductual y trasplante renal.\n"
@@ -364,29 +433,65 @@ class DualLLMOrchestrator:
 
         print(f"--- Calling Psychologist ({chatbot_model}) ---")
         print(f"System Prompt: {actual_psico_prompt[:100]}...")
+        return messages
 
-        raw_response = self._call_llm(
-            chatbot_model, 
-            messages, 
-            temperature=temperature, 
+    async def achat_psychologist(self, chatbot_model, history, user_message, psychologist_system_prompt=None, temperature=0.7, top_p=0.9, top_k=40, max_tokens=600, presence_penalty=0.1, frequency_penalty=0.2, context=None):
+        """
+        Step 1: Chatbot (Psychologist) responds.
+        """
+        messages = self._build_psychologist_messages(chatbot_model, history, user_message, psychologist_system_prompt, context)
+        raw_response = await self._acall_llm(
+            chatbot_model,
+            messages,
+            temperature=temperature,
             max_tokens=max_tokens,
             top_p=top_p,
             top_k=top_k,
             presence_penalty=presence_penalty,
             frequency_penalty=frequency_penalty
         )
-        
         return self._extract_thought_and_response(raw_response)
 
-    def generate_suggestion_only(self, patient_model, history, user_message, psychologist_response, patient_system_prompt=None, temperature=0.7, top_p=0.9, top_k=40, max_tokens=600, presence_penalty=0.1, frequency_penalty=0.2):
+    async def astream_chat_psychologist(self, chatbot_model, history, user_message, psychologist_system_prompt=None, temperature=0.7, top_p=0.9, top_k=40, max_tokens=600, presence_penalty=0.1, frequency_penalty=0.2, context=None):
+        """
+        Streaming variant of achat_psychologist.
+        Yields (event, data) tuples: ('thought', text), ('token', text) and ('reset', '') while
+        generating, then ('done', {'thought': ..., 'content': ...}) with the same result as achat_psychologist.
+        """
+        messages = self._build_psychologist_messages(chatbot_model, history, user_message, psychologist_system_prompt, context)
+
+        parser = ThoughtStreamParser()
+        stream = self._astream_llm(
+            chatbot_model,
+            messages,
+            temperature=temperature,
+            max_tokens=max_tokens,
+            top_p=top_p,
+            top_k=top_k,
+            presence_penalty=presence_penalty,
+            frequency_penalty=frequency_penalty
+        )
+        try:
+            async for delta in stream:
+                for event in parser.feed(delta):
+                    yield event
+        finally:
+            # Closes the LLM connection right away if the consumer stops early
+            await stream.aclose()
+        for event in parser.flush():
+            yield event
+
+        yield ("done", parser.finish())
+
+    async def agenerate_suggestion_only(self, patient_model, history, user_message, psychologist_response, patient_system_prompt=None, temperature=0.7, top_p=0.9, top_k=40, max_tokens=600, presence_penalty=0.1, frequency_penalty=0.2):
         """
         Step 2: Patient Helper suggests next reply.
         """
         updated_history = history + [{"role": "user", "content": user_message}]
-        
-        suggested_reply_data = self._extract_thought_and_response(self.get_patient_suggestion(
-            patient_model, 
-            updated_history, 
+
+        return self._clean_suggestion(await self.aget_patient_suggestion(
+            patient_model,
+            updated_history,
             psychologist_response,
             system_prompt=patient_system_prompt,
             temperature=temperature,
@@ -396,6 +501,10 @@ class DualLLMOrchestrator:
             presence_penalty=presence_penalty,
             frequency_penalty=frequency_penalty
         ))
+
+    def _clean_suggestion(self, raw_response):
+        """Thought/content split of a patient suggestion, without leaked instructions."""
+        suggested_reply_data = self._extract_thought_and_response(raw_response)
         suggested_reply = suggested_reply_data['content']
 
         # Clean any exposed instructions from the response
@@ -419,25 +528,21 @@ class DualLLMOrchestrator:
         suggested_reply_data['content'] = suggested_reply
         return suggested_reply_data
 
-    def list_models(self):
+    async def alist_models(self):
+        """Models loaded in LM Studio (GET /v1/models), or the defaults if unavailable."""
         try:
-            # LM Studio usually has a GET /v1/models endpoint
             url = self.api_url.replace("/chat/completions", "/models")
-            response = requests.get(url, timeout=20)
+            response = await self.async_http.get(url, timeout=(self.async_http.timeout[0], 20))
             if response.status_code == 200:
-                data = response.json()
-                models = [m["id"] for m in data["data"]]
+                models = [m["id"] for m in response.json()["data"]]
                 if models:
                     return models
-        except:
+        except Exception:
             pass
         return [DEFAULT_MODEL_CHATBOT, DEFAULT_MODEL_PATIENT]
 
-    def generate_patient_profile(self, model, guidance=None):
-        """
-        Generates a random patient profile using the LLM.
-        Returns a dictionary with the patient's details.
-        """
+    def _profile_messages(self, guidance=None):
+        """Prompt for agenerate_patient_profile."""
         system_prompt = (
             "You are a helpful assistant that generates synthetic medical data. "
             "Output ONLY valid JSON. Do not include any explanations, markdown formatting, or conversational text. "
@@ -471,84 +576,252 @@ class DualLLMOrchestrator:
             "}"
         )
 
-        messages = [
+        return [
             {"role": "system", "content": system_prompt},
             {"role": "user", "content": user_prompt}
         ]
-        
+
+    async def agenerate_patient_profile(self, model, guidance=None):
+        """
+        Generates a random patient profile using the LLM (always PROFILE_MODEL).
+        Returns a dictionary with the patient's details.
+        """
         try:
-            # Force use of the specific model if requested by user logic, or fallback to default
-            # target_model = model if model else DEFAULT_MODEL_PATIENT
-            target_model = "openai/gpt-oss-20b" # Force specific model for profile generation
-            print(f"Generating profile with model: {target_model}")
-            
-            # Use a slightly lower temperature for more deterministic formatting
-            response_text = self._call_llm(target_model, messages, temperature=0.8, max_tokens=1000)
-            print(f"Raw profile response: {response_text[:200]}...") 
-            
-            # 1. Clean think tags
-            response_data = self._extract_thought_and_response(response_text)
-            response_text = response_data['content']
-            
-            # 2. Remove markdown code blocks if present
-            response_text = re.sub(r'```json\s*', '', response_text)
-            response_text = re.sub(r'```\s*', '', response_text)
+            print(f"Generating profile with model: {PROFILE_MODEL}")
+            response_text = await self._acall_llm(PROFILE_MODEL, self._profile_messages(guidance), temperature=0.8, max_tokens=1000)
+            return self._parse_profile(response_text)
+        except Exception as e:
+            print(f"Error generating profile: {e}")
+            raise e
 
-            # 3. Extract JSON using find/rfind (robust against pre/post text)
-            start = response_text.find('{')
-            end = response_text.rfind('}') + 1
-            
-            data = None
-            
-            if start != -1 and end != -1:
-                json_str = response_text[start:end]
-                try:
-                    data = json.loads(json_str)
-                except json.JSONDecodeError:
-                    print("JSON decode error. Trying ast.literal_eval fallback...")
-                    try:
-                        # ast.literal_eval can handle Python dict syntax (single quotes, etc.)
-                        data = ast.literal_eval(json_str)
-                    except Exception as e:
-                        print(f"ast.literal_eval failed: {e}")
-                        # Last ditch effort: try to fix common quote issues
-                        try:
-                            fixed_str = json_str.replace("'", '"')
-                            data = json.loads(fixed_str)
-                        except:
-                            pass
-
-            if not data:
-                 # Try parsing the whole text if substring failed
+    def _parse_profile(self, response_text):
+        """Profile dict (all values as strings) from the model's JSON-ish answer."""
+        print(f"Raw profile response: {response_text[:200]}...") 
+        
+        # 1. Clean think tags
+        response_data = self._extract_thought_and_response(response_text)
+        response_text = response_data['content']
+        
+        # 2. Remove markdown code blocks if present
+        response_text = re.sub(r'```json\s*', '', response_text)
+        response_text = re.sub(r'```\s*', '', response_text)
+
+        # 3. Extract JSON using find/rfind (robust against pre/post text)
+        start = response_text.find('{')
+        end = response_text.rfind('}') + 1
+        
+        data = None
+        
+        if start != -1 and end != -1:
+            json_str = response_text[start:end]
+            try:
+                data = json.loads(json_str)
+            except json.JSONDecodeError:
+                print("JSON decode error. Trying ast.literal_eval fallback...")
                 try:
-                    data = json.loads(response_text)
-                except:
+                    # ast.literal_eval can handle Python dict syntax (single quotes, etc.)
+                    data = ast.literal_eval(json_str)
+                except Exception as e:
+                    print(f"ast.literal_eval failed: {e}")
+                    # Last ditch effort: try to fix common quote issues
                     try:
-                        data = ast.literal_eval(response_text)
+                        fixed_str = json_str.replace("'", '"')
+                        data = json.loads(fixed_str)
                     except:
                         pass
 
-            if data and isinstance(data, dict):
-                # Ensure all values are strings
-                for key, value in data.items():
-                    if isinstance(value, list):
-                        data[key] = ", ".join(map(str, value))
-                    elif isinstance(value, dict):
-                        data[key] = json.dumps(value, ensure_ascii=False)
-                    elif not isinstance(value, str):
-                        data[key] = str(value)
-                return data
-            else:
-                raise ValueError("Could not parse valid JSON or Dictionary from response")
+        if not data:
+             # Try parsing the whole text if substring failed
+            try:
+                data = json.loads(response_text)
+            except:
+                try:
+                    data = ast.literal_eval(response_text)
+                except:
+                    pass
 
+        if data and isinstance(data, dict):
+            # Ensure all values are strings
+            for key, value in data.items():
+                if isinstance(value, list):
+                    data[key] = ", ".join(map(str, value))
+                elif isinstance(value, dict):
+                    data[key] = json.dumps(value, ensure_ascii=False)
+                elif not isinstance(value, str):
+                    data[key] = str(value)
+            return data
+        else:
+            raise ValueError("Could not parse valid JSON or Dictionary from response")
+
+    def get_context_length(self, model):
+        """
+        Context window of a model, as reported by LM Studio's REST API
+        (loaded length first, then the model maximum). Falls back to
+        ANALYSIS_CONTEXT_TOKENS when the server does not expose it (cached for
+        CONTEXT_LENGTH_RETRY_SECONDS, then asked again).
+        """
+        cached = self._context_lengths.get(model)
+        if cached and (cached[1] is None or cached[1] > time.monotonic()):
+            return cached[0]
+        context_length = None
+        try:
+            url = self.api_url.replace("/v1/chat/completions", f"/api/v0/models/{model}")
+            response = self.http.get(url, timeout=(self.http.timeout[0], 20))
+            if response.status_code == 200:
+                info = response.json()
+                context_length = info.get("loaded_context_length") or info.get("max_context_length")
         except Exception as e:
-            print(f"Error generating profile: {e}")
-            print(f"Error generating profile: {e}")
-            raise e
+            print(f"Could not read context length for {model}: {e}")
+        if not context_length:
+            # Backends without this API: do not pay a failing round trip on every analysis
+            self._context_lengths[model] = (ANALYSIS_CONTEXT_TOKENS, time.monotonic() + CONTEXT_LENGTH_RETRY_SECONDS)
+            return ANALYSIS_CONTEXT_TOKENS
+        self._context_lengths[model] = (int(context_length), None)
+        return int(context_length)
+
+    @staticmethod
+    def estimate_tokens(text):
+        return len(text or "") // ANALYSIS_CHARS_PER_TOKEN + 1
+
+    def _split_for_budget(self, text, token_budget):
+        """Splits text on line boundaries into chunks of at most token_budget (estimated) tokens."""
+        max_chars = max(1, token_budget * ANALYSIS_CHARS_PER_TOKEN)
+        chunks = []
+        current = ""
+        for line in text.splitlines(keepends=True):
+            while len(line) > max_chars:
+                if current:
+                    chunks.append(current)
+                    current = ""
+                chunks.append(line[:max_chars])
+                line = line[max_chars:]
+            if current and len(current) + len(line) > max_chars:
+                chunks.append(current)
+                current = ""
+            current += line
+        if current:
+            chunks.append(current)
+        return chunks
+
+    def _group_for_budget(self, texts, token_budget):
+        """Packs consecutive texts into groups whose joined size fits token_budget."""
+        groups = []
+        current = []
+        current_tokens = 0
+        for text in texts:
+            tokens = self.estimate_tokens(text)
+            if current and current_tokens + tokens > token_budget:
+                groups.append(current)
+                current = []
+                current_tokens = 0
+            current.append(text)
+            current_tokens += tokens
+        if current:
+            groups.append(current)
+        return groups
+
+    def summarize_for_analysis(self, model, text):
+        """Map step: condensed summary of one interaction, chunk or group of summaries."""
+        messages = [
+            {"role": "system", "content": ANALYSIS_SUMMARY_SYSTEM_PROMPT},
+            {"role": "user", "content": text}
+        ]
+        return self._extract_thought_and_response(self._call_llm(
+            model,
+            messages,
+            temperature=0.2,
+            max_tokens=ANALYSIS_SUMMARY_TOKENS
+        ))['content'].strip()
+
+    def _summarize_all(self, model, texts):
+        """Runs summarize_for_analysis over texts in parallel, keeping their order."""
+        if len(texts) == 1:
+            return [self.summarize_for_analysis(model, texts[0])]
+        with ThreadPoolExecutor(max_workers=max(1, min(ANALYSIS_MAP_WORKERS, len(texts))), thread_name_prefix="analysis-map") as executor:
+            return list(executor.map(lambda text: self.summarize_for_analysis(model, text), texts))
 
-    def analyze_interactions(self, model, interactions_text, system_prompt=None, **kwargs):
+    def _map_budget(self, model):
+        """Input tokens available to one summary call."""
+        return max(256, self.get_context_length(model) - ANALYSIS_SUMMARY_TOKENS
+                   - self.estimate_tokens(ANALYSIS_SUMMARY_SYSTEM_PROMPT) - ANALYSIS_PROMPT_OVERHEAD_TOKENS)
+
+    def context_budget(self, model, reserved_tokens=0):
+        """Input tokens left in the model's context window after reserved_tokens."""
+        return max(256, self.get_context_length(model) - reserved_tokens - ANALYSIS_PROMPT_OVERHEAD_TOKENS)
+
+    def summarize_parts(self, model, parts):
+        """
+        Map step: one summary per context part. A part is a text or a dict with
+        'text' and 'summary_key' ((interaction_id, messages_hash)); keyed parts are
+        served from / stored in the summary cache. Parts longer than the map window
+        are summarized chunk by chunk. All summary calls run in parallel.
+        """
+        parts = [part if isinstance(part, dict) else {"text": part} for part in parts]
+        map_budget = self._map_budget(model)
+        summaries = [None] * len(parts)
+
+        chunks = []
+        owners = []
+        for index, part in enumerate(parts):
+            key = part.get("summary_key")
+            if key and self.summary_cache:
+                cached = self.summary_cache.get(key[0], key[1], model)
+                if cached is not None:
+                    summaries[index] = cached
+                    continue
+            text = part["text"]
+            if self.estimate_tokens(text) <= map_budget:
+                pieces = [text]
+            else:
+                pieces = self._split_for_budget(text, map_budget)
+                header = text.splitlines()[0] if text.strip() else ""
+                # Keep the interaction header on every chunk so summaries stay attributable
+                pieces = [
+                    piece if i == 0 else f"{header} (continuación {i + 1}/{len(pieces)})\n{piece}"
+                    for i, piece in enumerate(pieces)
+                ]
+            chunks.extend(pieces)
+            owners.extend([index] * len(pieces))
+
+        if chunks:
+            print(f"--- Summarizing {len(parts) - summaries.count(None)} cached + {len(chunks)} chunks with {model} ---")
+            results = {}
+            for index, summary in zip(owners, self._summarize_all(model, chunks)):
+                results.setdefault(index, []).append(summary)
+            for index, chunk_summaries in results.items():
+                summaries[index] = "\n\n".join(chunk_summaries)
+                key = parts[index].get("summary_key")
+                if key and self.summary_cache:
+                    self.summary_cache.put(key[0], key[1], model, summaries[index])
+        return summaries
+
+    def map_reduce_context(self, model, parts, token_budget):
+        """
+        Reduces the context parts (one per interaction or document) until they fit
+        token_budget: every part is summarized (see summarize_parts) and summaries that
+        still do not fit are grouped and summarized again.
+        Returns the list of summaries for the final analysis.
+        """
+        print(f"--- Map-reduce analysis with {model}: {len(parts)} parts, budget {token_budget} tokens ---")
+        summaries = self.summarize_parts(model, parts)
+
+        map_budget = self._map_budget(model)
+        while sum(self.estimate_tokens(s) for s in summaries) > token_budget and len(summaries) > 1:
+            groups = self._group_for_budget(summaries, map_budget)
+            if len(groups) == len(summaries):
+                # No two summaries fit together in the map window: nothing left to merge
+                break
+            print(f"--- Reducing {len(summaries)} summaries in {len(groups)} groups ---")
+            summaries = self._summarize_all(model, ["\n\n".join(group) for group in groups])
+        return summaries
+
+    def analyze_interactions(self, model, interactions_text, system_prompt=None, use_summaries=False, **kwargs):
         """
         Analyzes a set of interactions using the specified LLM.
+        interactions_text is the full context, or a list of context parts (one per
+        interaction / document, see summarize_parts). When it does not fit the model's context window it is
+        map-reduced into summaries instead of being truncated. use_summaries forces
+        the (cached) summaries even when the transcripts would fit.
         """
         if not system_prompt:
             system_prompt = (
@@ -561,15 +834,24 @@ class DualLLMOrchestrator:
                 "3. EVALUACIÓN DEL PACIENTE: ¿Fue realista? ¿Mantuvo la coherencia con su perfil?\n"
                 "4. CONCLUSIONES Y RECOMENDACIONES: ¿Qué se podría mejorar en el prompt o configuración?"
             )
-        
-        # Truncate context if it's too long. 
-        # User has a 4096 token limit (~16k chars). We'll limit input to ~12k chars to leave room for response.
-        MAX_CHARS = 12000
-        if len(interactions_text) > MAX_CHARS:
-            print(f"Warning: Context too long ({len(interactions_text)} chars). Truncating to {MAX_CHARS} chars.")
-            interactions_text = interactions_text[:MAX_CHARS] + "\n\n[...TRUNCATED DUE TO LENGTH...]"
 
-        user_prompt = f"Aquí está el contexto para el análisis (transcripciones de interacciones y documentos de referencia si los hay):\n\n{interactions_text}\n\nPor favor, genera el análisis clínico."
+        parts = [interactions_text] if isinstance(interactions_text, str) else list(interactions_text)
+        parts = [part if isinstance(part, dict) else {"text": part} for part in parts]
+        parts = [part for part in parts if part["text"] and part["text"].strip()]
+
+        # Input budget: context window minus the reserved answer, system prompt and template overhead
+        max_tokens = kwargs.get("max_tokens", 2000)
+        token_budget = self.context_budget(model, max_tokens + self.estimate_tokens(system_prompt))
+
+        context = "\n\n".join(part["text"] for part in parts)
+        if use_summaries or self.estimate_tokens(context) > token_budget:
+            summaries = self.map_reduce_context(model, parts, token_budget)
+            context = (
+                "Resúmenes de las interacciones seleccionadas:\n\n"
+                + "\n\n".join(summaries)
+            )
+
+        user_prompt = f"Aquí está el contexto para el análisis (transcripciones de interacciones y documentos de referencia si los hay):\n\n{context}\n\nPor favor, genera el análisis clínico."
         
         messages = [
             {"role": "system", "content": system_prompt},
@@ -584,10 +866,15 @@ class DualLLMOrchestrator:
             **kwargs
         ))['content']
 
-    def chat_analysis(self, model, history, system_prompt, context, **kwargs):
+    async def achat_analysis(self, model, history, system_prompt, context, **kwargs):
         """
         Chat with the analysis model, including context from interactions and RAG.
         """
+        messages = self._analysis_chat_messages(history, system_prompt, context)
+        print(f"--- Chat Analysis with {model} ---")
+        return self._extract_thought_and_response(await self._acall_llm(model, messages, **kwargs))['content']
+
+    def _analysis_chat_messages(self, history, system_prompt, context):
         # Prepare messages
         # Check if placeholder exists
         if "{{CONTEXT}}" in system_prompt:
@@ -601,20 +888,23 @@ class DualLLMOrchestrator:
         # Append history
         for msg in history:
             messages.append({"role": msg['role'], "content": msg['content']})
-            
-        print(f"--- Chat Analysis with {model} ---")
-        return self._extract_thought_and_response(self._call_llm(
-            model,
-            messages,
-            **kwargs
-        ))['content']
+        return messages
 
     def simulate_interaction(self, chatbot_model, patient_model, psychologist_system_prompt, patient_system_prompt, turns=5, **kwargs):
         """
         Simulates an autonomous interaction between the Psychologist and the Patient.
+        Patient sentiment is scored on a worker pool concurrently with the next psychologist turn
+        (sentiment_mode="background", default) or in one parallel pass after the last turn
+        (sentiment_mode="deferred"). Every patient message gets its 'sentiment' before returning.
+        model_slot: optional callable(model) -> context manager held around every LLM call,
+        sentiment included (BatchSimulator uses it to cap concurrent calls per model).
         """
         history = []
         messages_log = []
+        sentiment_mode = kwargs.get('sentiment_mode') or 'background'
+        validate_sentiment_mode(sentiment_mode)
+        model_slot = kwargs.get('model_slot') or (lambda model: contextlib.nullcontext())
+        pending_sentiment = []  # (log entry, future)
         
         # Optimize prompts dynamically
         final_chatbot_prompt = self._optimize_system_prompt(psychologist_system_prompt, chatbot_model)
@@ -642,27 +932,29 @@ class DualLLMOrchestrator:
             
             patient_messages = [{"role": "system", "content": final_patient_prompt}] + patient_history_input
             
-            patient_response_data = self._extract_thought_and_response(self._call_llm(
-                patient_model,
-                patient_messages,
-                temperature=kwargs.get('patient_temperature', 0.7),
-                max_tokens=kwargs.get('patient_max_tokens', 600)
-            ))
+            with model_slot(patient_model):
+                patient_response_data = self._extract_thought_and_response(self._call_llm(
+                    patient_model,
+                    patient_messages,
+                    temperature=kwargs.get('patient_temperature', 0.7),
+                    max_tokens=kwargs.get('patient_max_tokens', 600)
+                ))
             
-            # Analyze Sentiment of the patient's clean response
-            sentiment_data = None
-            try:
-                sentiment_data = self.analyze_sentiment(patient_response_data['content'], model=chatbot_model)
-            except Exception as e:
-                print(f"Error analyzing sentiment in simulation: {e}")
-
-            # Add to log with thought and sentiment
-            messages_log.append({
+            # Add to log with thought; sentiment is filled in before returning
+            patient_log_entry = {
                 "role": "user", 
                 "content": patient_response_data['content'],
                 "thought": patient_response_data['thought'],
-                "sentiment": sentiment_data
-            })
+                "sentiment": None
+            }
+            messages_log.append(patient_log_entry)
+
+            # Analyze Sentiment of the patient's clean response off the critical path:
+            # it runs on the worker pool while the psychologist answers
+            if sentiment_mode == "deferred":
+                pending_sentiment.append((patient_log_entry, None))
+            else:
+                pending_sentiment.append((patient_log_entry, self._submit_sentiment(patient_response_data['content'], chatbot_model, model_slot)))
             
             # Add to history (standard format for next turn)
             history.append({"role": "user", "content": patient_response_data['content']})
@@ -672,12 +964,13 @@ class DualLLMOrchestrator:
             
             psico_messages = [{"role": "system", "content": final_chatbot_prompt}] + history
             
-            psychologist_response_data = self._extract_thought_and_response(self._call_llm(
-                chatbot_model,
-                psico_messages,
-                temperature=kwargs.get('psychologist_temperature', 0.7),
-                max_tokens=kwargs.get('psychologist_max_tokens', 600)
-            ))
+            with model_slot(chatbot_model):
+                psychologist_response_data = self._extract_thought_and_response(self._call_llm(
+                    chatbot_model,
+                    psico_messages,
+                    temperature=kwargs.get('psychologist_temperature', 0.7),
+                    max_tokens=kwargs.get('psychologist_max_tokens', 600)
+                ))
             
             last_psychologist_msg = psychologist_response_data['content']
             
@@ -689,9 +982,30 @@ class DualLLMOrchestrator:
             })
             
             history.append({"role": "assistant", "content": psychologist_response_data['content']})
+
+        # Deferred mode: score every patient message in one parallel pass after the conversation
+        if sentiment_mode == "deferred":
+            pending_sentiment = [(entry, self._submit_sentiment(entry['content'], chatbot_model, model_slot)) for entry, _ in pending_sentiment]
+
+        for entry, future in pending_sentiment:
+            try:
+                entry["sentiment"] = future.result()
+            except Exception as e:
+                print(f"Error analyzing sentiment in simulation: {e}")
             
         return messages_log
 
+    def _submit_sentiment(self, text, model, model_slot):
+        """Schedules analyze_sentiment on the shared sentiment worker pool (inside model_slot)."""
+        if self._sentiment_executor is None:
+            with self._sentiment_executor_lock:
+                if self._sentiment_executor is None:
+                    self._sentiment_executor = ThreadPoolExecutor(max_workers=SENTIMENT_WORKERS, thread_name_prefix="sentiment")
+        def score():
+            with model_slot(model):
+                return self.analyze_sentiment(text, model)
+        return self._sentiment_executor.submit(score)
+
     def analyze_sentiment(self, text, model=None):
         """
         Analyzes the sentiment/psychological parameters of a patient's message.
@@ -699,60 +1013,185 @@ class DualLLMOrchestrator:
         # Use a lightweight or standard model for this task. Defaults to chatbot model if not specified.
         # We can use the same model as the chatbot for consistency, or a smarter one if available.
         target_model = model if model else DEFAULT_MODEL_CHATBOT
-        
-        system_prompt = (
-            "Eres un experto en psicometría y análisis de sentimiento clínico. "
-            "Tu tarea es analizar el siguiente mensaje de un paciente renal y puntuar los siguientes parámetros "
-            "en una escala del 0 al 10 (donde 0 es nada/muy bajo y 10 es máximo/muy alto).\n"
-            "También evalúa la valencia emocional de -5 (muy negativa) a +5 (muy positiva).\n\n"
-            "Parámetros a evaluar:\n"
-            "- valencia: -5 a +5\n"
-            "- intensidad: 0 a 10 (intensidad de la emoción expresada)\n"
-            "- frustracion: 0 a 10\n"
-            "- hostilidad: 0 a 10\n"
-            "- desesperanza: 0 a 10\n"
-            "- autoeficacia: 0 a 10 (creencia en su propia capacidad de manejar su salud)\n\n"
-            "Salida OBLIGATORIA: Un único objeto JSON con estas claves. Sin explicaciones ni texto extra."
-        )
-        
-        user_prompt = f"Mensaje del paciente: \"{text}\""
-        
-        messages = [
-            {"role": "system", "content": system_prompt},
-            {"role": "user", "content": user_prompt}
+
+        if self.sentiment_cache:
+            cached = self.sentiment_cache.get(target_model, text)
+            if cached is not None:
+                return cached
+
+        result = self._score_sentiment(text, target_model)
+        if result and self.sentiment_cache:
+            self.sentiment_cache.put(target_model, text, result)
+        return result
+
+    @staticmethod
+    def _sentiment_messages(text):
+        return [
+            {"role": "system", "content": SENTIMENT_SYSTEM_PROMPT},
+            {"role": "user", "content": f"Mensaje del paciente: \"{text}\""}
         ]
-        
+
+    def _score_sentiment(self, text, target_model):
+        """Single-message sentiment call (no cache)."""
         try:
             response_text = self._call_llm(
                 target_model, 
-                messages, 
+                self._sentiment_messages(text), 
                 temperature=0.1, # Low temp for deterministic JSON
                 max_tokens=150
             )
+            return self._parse_sentiment(response_text)
+        except Exception as e:
+            print(f"Error in sentiment analysis: {e}")
+            return None
 
-
-            # Handle potential thinking blocks if the model puts them in (though prompts asks for JSON only)
-            extracted = self._extract_thought_and_response(response_text)
-            content = extracted['content']
-            
-            # Clean possible markdown
-            content = content.replace("```json", "").replace("```", "").strip()
-            
-            # Parse JSON
-            try:
-                data = json.loads(content)
-                return data
-            except json.JSONDecodeError:
-                # Fallback: try to finding JSON in text
-                match = re.search(r'\{.*\}', content, re.DOTALL)
-                if match:
-                    try:
-                        return json.loads(match.group(0))
-                    except:
-                        pass
-                print(f"Failed to parse sentiment JSON: {content}")
-                return None
-                
+    async def aanalyze_sentiment(self, text, model=None):
+        """Async analyze_sentiment (same cache)."""
+        target_model = model if model else DEFAULT_MODEL_CHATBOT
+        if self.sentiment_cache:
+            cached = self.sentiment_cache.get(target_model, text)
+            if cached is not None:
+                return cached
+        try:
+            response_text = await self._acall_llm(target_model, self._sentiment_messages(text), temperature=0.1, max_tokens=150)
+            result = self._parse_sentiment(response_text)
         except Exception as e:
             print(f"Error in sentiment analysis: {e}")
+            result = None
+        if result and self.sentiment_cache:
+            self.sentiment_cache.put(target_model, text, result)
+        return result
+
+    def _parse_sentiment(self, response_text):
+        """Sentiment dict from the model's answer, or None."""
+        # Handle potential thinking blocks if the model puts them in (though prompts asks for JSON only)
+        extracted = self._extract_thought_and_response(response_text)
+        content = extracted['content']
+        
+        # Clean possible markdown
+        content = content.replace("```json", "").replace("```", "").strip()
+        
+        # Parse JSON
+        try:
+            data = json.loads(content)
+            return data
+        except json.JSONDecodeError:
+            # Fallback: try to finding JSON in text
+            match = re.search(r'\{.*\}', content, re.DOTALL)
+            if match:
+                try:
+                    return json.loads(match.group(0))
+                except:
+                    pass
+            print(f"Failed to parse sentiment JSON: {content}")
+            return None
+
+    def _plan_sentiment_batches(self, items, token_budget=None):
+        """
+        Splits [(id, text), ...] into batches whose estimated prompt size (estimate_tokens, as
+        for the analysis budget) fits the token budget, capped at SENTIMENT_BATCH_MAX_MESSAGES
+        messages per batch.
+        """
+        token_budget = token_budget or SENTIMENT_BATCH_TOKEN_BUDGET
+        batches = []
+        current = []
+        current_tokens = 0
+        for item_id, text in items:
+            # + the "[id=...]" prefix and quotes of the listing line
+            tokens = self.estimate_tokens(text) + 10
+            if current and (current_tokens + tokens > token_budget or len(current) >= SENTIMENT_BATCH_MAX_MESSAGES):
+                batches.append(current)
+                current = []
+                current_tokens = 0
+            current.append((item_id, text))
+            current_tokens += tokens
+        if current:
+            batches.append(current)
+        return batches
+
+    def _score_sentiment_batch(self, batch, model):
+        """
+        Scores several messages in a single call. Returns {id: sentiment} for the ids
+        the model answered with a valid object (known "id" and a "valencia" score), or None if
+        the response could not be parsed; malformed items are left to the single-message fallback.
+        """
+        listing = "\n".join(f"[id={item_id}] \"{text}\"" for item_id, text in batch)
+        messages = [
+            {"role": "system", "content": SENTIMENT_BATCH_SYSTEM_PROMPT},
+            {"role": "user", "content": f"Mensajes del paciente:\n{listing}"}
+        ]
+        response_text = self._call_llm(
+            model,
+            messages,
+            temperature=0.1, # Low temp for deterministic JSON
+            max_tokens=SENTIMENT_TOKENS_PER_RESULT * len(batch) + 50
+        )
+        content = self._extract_thought_and_response(response_text)['content']
+        content = content.replace("```json", "").replace("```", "").strip()
+
+        data = None
+        try:
+            data = json.loads(content)
+        except json.JSONDecodeError:
+            match = re.search(r'\[.*\]', content, re.DOTALL)
+            if match:
+                try:
+                    data = json.loads(match.group(0))
+                except json.JSONDecodeError:
+                    pass
+        if not isinstance(data, list):
+            print(f"Failed to parse batch sentiment JSON: {content[:200]}")
             return None
+
+        expected_ids = {str(item_id): item_id for item_id, _ in batch}
+        results = {}
+        for entry in data:
+            if not isinstance(entry, dict) or str(entry.get("id")) not in expected_ids or "valencia" not in entry:
+                print(f"Skipping malformed batch sentiment item: {str(entry)[:200]}")
+                continue
+            item_id = expected_ids[str(entry["id"])]
+            if item_id not in results:
+                results[item_id] = {k: v for k, v in entry.items() if k != "id"}
+        return results
+
+    def analyze_sentiment_batch(self, items, model=None, token_budget=None):
+        """
+        Analyzes many patient messages with as few LLM calls as possible.
+        items: list of (id, text). Returns {id: sentiment or None}.
+        Messages missing from a batch answer (or whole batches that fail to parse)
+        are scored one at a time with analyze_sentiment.
+        """
+        target_model = model if model else DEFAULT_MODEL_CHATBOT
+        results = {}
+
+        # Only messages not in the cache go to the model
+        if self.sentiment_cache:
+            uncached = []
+            for item_id, text in items:
+                cached = self.sentiment_cache.get(target_model, text)
+                if cached is not None:
+                    results[item_id] = cached
+                else:
+                    uncached.append((item_id, text))
+            items = uncached
+
+        for batch in self._plan_sentiment_batches(items, token_budget):
+            scored = None
+            if len(batch) > 1:
+                try:
+                    scored = self._score_sentiment_batch(batch, target_model)
+                except Exception as e:
+                    print(f"Error in batch sentiment analysis: {e}")
+            scored = scored or {}
+            results.update(scored)
+            if self.sentiment_cache:
+                texts = dict(batch)
+                for item_id, sentiment in scored.items():
+                    self.sentiment_cache.put(target_model, texts[item_id], sentiment)
+
+            missing = [(item_id, text) for item_id, text in batch if item_id not in scored]
+            if missing and len(batch) > 1:
+                print(f"Batch sentiment: falling back to single scoring for {len(missing)}/{len(batch)} messages")
+            for item_id, text in missing:
+                results[item_id] = self.analyze_sentiment(text, model=target_model)
+        return results
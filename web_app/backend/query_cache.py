@@ -0,0 +1,88 @@
+"""
+In-memory LRU/TTL cache of RAG retrieval results.
+Chat and analysis chat retrieve on every turn, and simulated conversations reuse the same
+openings, so results are cached by (normalized query, document filter, n_results, mode).
+Entries are invalidated per document when its chunks change; unfiltered entries depend on
+every document and are dropped on any change.
+"""
+
+import os
+import time
+import threading
+from collections import OrderedDict
+
+from embedding_cache import normalize_text
+
+DEFAULT_MAX_ENTRIES = int(os.getenv("RAG_QUERY_CACHE_SIZE", "512"))
+DEFAULT_TTL_SECONDS = float(os.getenv("RAG_QUERY_CACHE_TTL", "600"))
+
+
+class QueryCache:
+    def __init__(self, max_entries=None, ttl_seconds=None):
+        self.max_entries = max_entries or DEFAULT_MAX_ENTRIES
+        self.ttl_seconds = ttl_seconds or DEFAULT_TTL_SECONDS
+        # key -> (expires_at, result)
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        # Bumped on every invalidation: results computed before it are not stored
+        self.generation = 0
+
+    @staticmethod
+    def make_key(query_text, filter_filenames, n_results, *options):
+        filenames = tuple(sorted(set(filter_filenames))) if filter_filenames else None
+        return (normalize_text(query_text).casefold(), filenames, n_results) + options
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] < time.monotonic():
+                if entry is not None:
+                    del self._entries[key]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return list(entry[1])
+
+    def put(self, key, result, generation=None):
+        """generation: value of self.generation read before computing the result."""
+        with self._lock:
+            if generation is not None and generation != self.generation:
+                return
+            self._entries[key] = (time.monotonic() + self.ttl_seconds, list(result))
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def invalidate_filenames(self, filenames):
+        """Drops entries that may include chunks of these documents."""
+        filenames = set(filenames)
+        with self._lock:
+            self.generation += 1
+            stale = [key for key in self._entries if key[1] is None or filenames.intersection(key[1])]
+            for key in stale:
+                del self._entries[key]
+            self.invalidations += len(stale)
+            return len(stale)
+
+    def clear(self):
+        with self._lock:
+            self.generation += 1
+            self.invalidations += len(self._entries)
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+                "ttl_seconds": self.ttl_seconds,
+                "hits": self.hits,
+                "misses": self.misses,
+                "invalidations": self.invalidations,
+                "hit_rate": round(self.hits / lookups, 3) if lookups else 0.0,
+            }
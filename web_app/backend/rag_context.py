@@ -0,0 +1,100 @@
+"""
+Selection of retrieved chunks for a prompt.
+Overlapping chunks often repeat the same text, so candidates are picked with maximal
+marginal relevance (relevance vs. similarity to what is already selected), near-duplicates
+are dropped, and the result is packed into a token budget.
+"""
+
+import os
+import re
+
+import numpy as np
+
+from orchestrator import ANALYSIS_CHARS_PER_TOKEN, DualLLMOrchestrator
+
+DEFAULT_CHAT_TOKENS = int(os.getenv("RAG_CHAT_CONTEXT_TOKENS", "800"))
+DEFAULT_ANALYSIS_CHAT_TOKENS = int(os.getenv("RAG_ANALYSIS_CONTEXT_TOKENS", "1500"))
+# Candidates retrieved before diversification
+DEFAULT_CANDIDATES = int(os.getenv("RAG_CONTEXT_CANDIDATES", "12"))
+# 1.0 = relevance only, 0.0 = diversity only
+MMR_LAMBDA = 0.7
+# Embedding cosine similarity / shared word trigrams above which a chunk is a near-duplicate
+DUPLICATE_SIMILARITY = 0.95
+DUPLICATE_SHINGLE_OVERLAP = 0.6
+
+_WORD_RE = re.compile(r"\w+")
+
+
+def _shingles(text):
+    words = _WORD_RE.findall((text or "").lower())
+    return {tuple(words[i:i + 3]) for i in range(max(1, len(words) - 2))}
+
+
+def _shingle_overlap(a, b):
+    """Share of the smaller chunk's trigrams found in the other one (containment)."""
+    if not a or not b:
+        return 0.0
+    return len(a & b) / min(len(a), len(b))
+
+
+def _truncate(text, token_budget):
+    max_chars = max(0, token_budget * ANALYSIS_CHARS_PER_TOKEN)
+    if len(text) <= max_chars:
+        return text
+    cut = text.rfind(" ", 0, max_chars)
+    return text[:cut if cut > 0 else max_chars] + " ..."
+
+
+def select_context(hits, embeddings, token_budget, mmr_lambda=MMR_LAMBDA, estimate=DualLLMOrchestrator.estimate_tokens):
+    """
+    hits: retrieval hits best first ({"id", "document", "metadata", "score", ...}).
+    embeddings: {id: vector} (hits without a vector are compared by text only).
+    Returns the selected hits in selection order, each with "relevance" (score scaled to
+    0-1) and "tokens". A first chunk larger than the whole budget is truncated to fit.
+    """
+    if not hits or token_budget <= 0:
+        return []
+    top_score = max(hit["score"] for hit in hits) or 1.0
+    candidates = []
+    for hit in hits:
+        vector = embeddings.get(hit["id"])
+        if vector is not None:
+            vector = np.asarray(vector, dtype=np.float32)
+            norm = np.linalg.norm(vector)
+            vector = vector / norm if norm else None
+        candidates.append((hit, hit["score"] / top_score, vector, _shingles(hit["document"])))
+
+    selected = []
+    used_tokens = 0
+    while candidates and used_tokens < token_budget:
+        best = None
+        for index, (hit, relevance, vector, shingles) in enumerate(candidates):
+            similarity = 0.0
+            duplicate = False
+            for _, _, other_vector, other_shingles in selected:
+                if vector is not None and other_vector is not None:
+                    cosine = float(vector @ other_vector)
+                    similarity = max(similarity, cosine)
+                    duplicate = duplicate or cosine >= DUPLICATE_SIMILARITY
+                duplicate = duplicate or _shingle_overlap(shingles, other_shingles) >= DUPLICATE_SHINGLE_OVERLAP
+            if duplicate:
+                continue
+            mmr = mmr_lambda * relevance - (1 - mmr_lambda) * similarity
+            if best is None or mmr > best[0]:
+                best = (mmr, index)
+        if best is None:
+            break
+
+        hit, relevance, vector, shingles = candidates.pop(best[1])
+        text = hit["document"]
+        tokens = estimate(text)
+        if used_tokens + tokens > token_budget:
+            if selected:
+                # Does not fit: a smaller, less relevant chunk still might
+                continue
+            text = _truncate(text, token_budget)
+            tokens = estimate(text)
+        used_tokens += tokens
+        selected.append(({**hit, "document": text, "relevance": round(relevance, 3), "tokens": tokens}, relevance, vector, shingles))
+
+    return [entry[0] for entry in selected]
@@ -2,71 +2,188 @@ import os
 import chromadb
 from chromadb.utils import embedding_functions
 from docling.document_converter import DocumentConverter
-from docling.chunking import HybridChunker
+from conversion_cache import ConversionCache
+from embedding_cache import EmbeddingCache, CachedEmbeddingFunction
+from lexical_index import LexicalIndex, reciprocal_rank_fusion
+from query_cache import QueryCache
+from rag_context import select_context, DEFAULT_CANDIDATES
+from ingestion import IngestionPipeline
+from chunking import CHUNKING_VERSION, chunk_file, is_native, read_text
+
+# Docling conversions are cached next to documentos/
+DEFAULT_CONVERSION_CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "documentos_cache")
+DEFAULT_EMBEDDING_CACHE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "embedding_cache", "embeddings.sqlite3")
+# Hybrid retrieval: each ranking (dense, BM25) contributes n_results * factor candidates to the fusion
+HYBRID_CANDIDATES_FACTOR = int(os.getenv("RAG_HYBRID_CANDIDATES_FACTOR", "4"))
 
 class RAGManager:
-    def __init__(self, persistence_directory="./chroma_db"):
+    def __init__(self, persistence_directory="./chroma_db", conversion_cache_dir=None, embedding_cache_path=None):
         self.client = chromadb.PersistentClient(path=persistence_directory)
         # Use a lightweight model for local embeddings
         self.embedding_model_name = "all-MiniLM-L6-v2"
-        self.embedding_function = embedding_functions.SentenceTransformerEmbeddingFunction(model_name=self.embedding_model_name)
+        # Embeddings (chunks and queries) are served from the on-disk cache when the text was seen before
+        self.embedding_cache = EmbeddingCache(embedding_cache_path or DEFAULT_EMBEDDING_CACHE_PATH)
+        self.embedding_function = CachedEmbeddingFunction(
+            embedding_functions.SentenceTransformerEmbeddingFunction(model_name=self.embedding_model_name),
+            self.embedding_model_name,
+            self.embedding_cache
+        )
         
         self.collection = self.client.get_or_create_collection(
             name="documents",
             embedding_function=self.embedding_function
         )
+        # BM25 index of the same chunks (exact terms: drug names, etc.), stored with the vectors
+        self.lexical_index = LexicalIndex(os.path.join(persistence_directory, "lexical_index.sqlite3"))
+        if not len(self.lexical_index) and self.collection.count():
+            self.rebuild_lexical_index()
+        # Retrieval results for repeated queries (chat turns); invalidated when documents change
+        self.query_cache = QueryCache()
         
         # Initialize Docling
         self.doc_converter = DocumentConverter()
+        # Every conversion (indexing, reindexing, analysis) goes through the content-hash cache
+        self.conversions = ConversionCache(
+            conversion_cache_dir or DEFAULT_CONVERSION_CACHE_DIR,
+            lambda filepath: self.doc_converter.convert(filepath).document
+        )
+        # Multi-document ingestion: process-pool conversion, batched embedding and writes
+        self.ingestion = IngestionPipeline(self)
+
+    def get_markdown(self, filepath):
+        """Markdown export of a document (converted once per content)"""
+        if is_native(filepath):
+            return read_text(filepath)
+        return self.conversions.get_markdown(filepath)
+
+    def chunk_file(self, filepath, chunk_size=1000, overlap=200):
+        """Chunk texts of a document for the given parameters (cached per content)"""
+        return chunk_file(self.conversions, filepath, chunk_size, overlap)
+
+    def add_documents(self, files, chunk_size=1000, overlap=200, on_stage=None):
+        """Indexes several documents [(filename, filepath), ...] through the ingestion pipeline"""
+        return self.ingestion.ingest(files, chunk_size=chunk_size, overlap=overlap, on_stage=on_stage)
 
     def add_document(self, filename, filepath, chunk_size=1000, overlap=200):
-        # Remove existing chunks for this file first to avoid duplicates if re-uploading
-        self.delete_document(filename)
+        """Indexes a single document through the ingestion pipeline; True if it succeeded"""
+        report = self.add_documents([(filename, filepath)], chunk_size=chunk_size, overlap=overlap)
+        return bool(report) and report[0]["status"] == "success"
 
-        try:
-            # Convert document using Docling
-            conv_result = self.doc_converter.convert(filepath)
-            doc = conv_result.document
-            
-            # Chunk the document
-            # We use HybridChunker with the requested chunk_size (max_tokens)
-            # Note: HybridChunker might not support 'overlap' directly in all versions, 
-            # but it handles semantic boundaries well.
-            chunker = HybridChunker(max_tokens=chunk_size)
-            chunk_iter = chunker.chunk(doc)
-            
-            chunks = []
-            metadatas = []
-            ids = []
-            
-            for i, chunk in enumerate(chunk_iter):
-                chunks.append(chunk.text)
-                meta = {
-                    "filename": filename,
-                    "chunk_index": i
-                }
-                metadatas.append(meta)
-                ids.append(f"{filename}_{i}")
+    def indexed_documents(self):
+        """{filename: metadata of its first chunk} for every document in the collection"""
+        indexed = {}
+        for meta in self.collection.get(include=["metadatas"])["metadatas"] or []:
+            if meta and meta.get("filename") not in indexed:
+                indexed[meta.get("filename")] = meta
+        return indexed
 
-            if chunks:
-                self.collection.add(
-                    documents=chunks,
-                    ids=ids,
-                    metadatas=metadatas
-                )
-            return True
+    def reindex(self, documents_dir, chunk_size=1000, overlap=200, force=False):
+        """
+        Incremental reindex of documents_dir. Documents whose content and chunking
+        parameters match the index are skipped; changed parameters re-chunk from the
+        cached conversion; only new or modified files are converted. Chunks of files
+        no longer on disk are removed. Returns a per-document report with timings.
+        """
+        if force:
+            self.clear_collection()
+        indexed = self.indexed_documents()
+        files = sorted(f for f in os.listdir(documents_dir) if os.path.isfile(os.path.join(documents_dir, f)))
 
-        except Exception as e:
-            print(f"Error processing document {filename} with Docling: {e}")
-            return False
+        report = []
+        live_hashes = set()
+        to_index = []
+        actions = {}
+        for filename in files:
+            filepath = os.path.join(documents_dir, filename)
+            content_hash = self.conversions.content_hash(filepath)
+            live_hashes.add(content_hash)
+            meta = indexed.get(filename)
+
+            if (meta and meta.get("content_hash") == content_hash and meta.get("chunk_size") == chunk_size
+                    and meta.get("overlap") == overlap and meta.get("chunker") == CHUNKING_VERSION):
+                report.append({"filename": filename, "action": "skipped", "seconds": 0.0})
+            else:
+                converted = is_native(filepath) or self.conversions.has_document(content_hash)
+                actions[filename] = "rechunked" if converted else "converted"
+                to_index.append((filename, filepath))
+
+        # Changed documents go through the parallel ingestion pipeline
+        for entry in self.add_documents(to_index, chunk_size=chunk_size, overlap=overlap):
+            action = actions[entry["filename"]] if entry["status"] == "success" else "error"
+            report.append({"filename": entry["filename"], "action": action, "seconds": entry["seconds"]})
+
+        for filename in sorted(set(indexed) - set(files)):
+            self.delete_document(filename)
+            report.append({"filename": filename, "action": "removed", "seconds": 0.0})
+
+        # Conversions of deleted or replaced files are no longer needed
+        self.conversions.prune(live_hashes)
+        return report
 
     def delete_document(self, filename):
         try:
             self.collection.delete(where={"filename": filename})
+            self.lexical_index.delete_filenames([filename])
+            self.query_cache.invalidate_filenames([filename])
         except Exception as e:
             print(f"Error deleting document {filename}: {e}")
 
-    def query(self, query_text, n_results=3, filter_filenames=None):
+    def rebuild_lexical_index(self):
+        """Fills the BM25 index from the chunks already in Chroma (collections indexed before it existed)"""
+        self.lexical_index.clear()
+        stored = self.collection.get(include=["documents", "metadatas"])
+        self.lexical_index.add(stored["ids"], stored["documents"], stored["metadatas"])
+        print(f"Lexical index rebuilt: {len(self.lexical_index)} chunks")
+
+    def query(self, query_text, n_results=3, filter_filenames=None, hybrid=True):
+        """
+        Chunk texts most relevant to query_text. Dense (embedding) and BM25 rankings are
+        fused with reciprocal-rank fusion; hybrid=False returns the dense ranking only.
+        Results are served from the query cache while the documents are unchanged.
+        """
+        hits = self.query_many([query_text], n_results=n_results, filter_filenames=filter_filenames, hybrid=hybrid)[0]
+        return [hit["document"] for hit in hits]
+
+    def query_many(self, query_texts, n_results=3, filter_filenames=None, hybrid=True):
+        """
+        Batched retrieval. Returns one list of hits per query, best first:
+        {"id", "document", "metadata", "distance", "score"}, where distance is the embedding
+        distance (None for chunks found only by BM25) and score the fused rank score.
+        Uncached queries are embedded in one call and searched in one Chroma query.
+        """
+        keys = [QueryCache.make_key(query_text, filter_filenames, n_results, hybrid) for query_text in query_texts]
+        results = [self.query_cache.get(key) for key in keys]
+        pending = [i for i, hits in enumerate(results) if hits is None]
+        if pending:
+            generation = self.query_cache.generation
+            searched = self._search_many([query_texts[i] for i in pending], n_results, filter_filenames, hybrid)
+            for i, hits in zip(pending, searched):
+                results[i] = hits
+                self.query_cache.put(keys[i], hits, generation)
+        return results
+
+    def retrieve_context(self, query_text, token_budget, filter_filenames=None, candidates=None, estimate_tokens=None):
+        """
+        Chunks for a prompt: the top candidates are diversified (MMR), near-duplicates are
+        dropped and the rest is packed into token_budget. Returns hits with "relevance" and "tokens".
+        """
+        n_results = candidates or DEFAULT_CANDIDATES
+        # Candidate embeddings are cached next to the hits and invalidated with them
+        key = QueryCache.make_key(query_text, filter_filenames, n_results, True, "embeddings")
+        generation = self.query_cache.generation
+        hits = self.query_many([query_text], n_results=n_results, filter_filenames=filter_filenames)[0]
+        if not hits:
+            return []
+        embeddings = dict(self.query_cache.get(key) or [])
+        if any(hit["id"] not in embeddings for hit in hits):
+            stored = self.collection.get(ids=[hit["id"] for hit in hits], include=["embeddings"])
+            embeddings = dict(zip(stored['ids'], stored['embeddings'] if stored['embeddings'] is not None else []))
+            self.query_cache.put(key, embeddings.items(), generation)
+        if estimate_tokens:
+            return select_context(hits, embeddings, token_budget, estimate=estimate_tokens)
+        return select_context(hits, embeddings, token_budget)
+
+    def _search_many(self, query_texts, n_results, filter_filenames, hybrid):
         where_filter = None
         if filter_filenames:
             if len(filter_filenames) == 1:
@@ -74,20 +191,52 @@ class RAGManager:
             else:
                 where_filter = {"filename": {"$in": filter_filenames}}
 
+        candidates = n_results * HYBRID_CANDIDATES_FACTOR if hybrid else n_results
         results = self.collection.query(
-            query_texts=[query_text],
-            n_results=n_results,
-            where=where_filter
+            query_embeddings=self.embedding_function(query_texts),
+            n_results=candidates,
+            where=where_filter,
+            include=["documents", "metadatas", "distances"]
         )
-        
-        # Flatten results
-        documents = results['documents'][0] if results['documents'] else []
-        return documents
+
+        chunks = {}  # id -> (document, metadata)
+        rankings = []
+        for i, query_text in enumerate(query_texts):
+            vector_ids = results['ids'][i]
+            for chunk_id, document, metadata in zip(vector_ids, results['documents'][i], results['metadatas'][i]):
+                chunks[chunk_id] = (document, metadata)
+            distances = dict(zip(vector_ids, results['distances'][i]))
+            ranked = [vector_ids]
+            if hybrid:
+                ranked.append([chunk_id for chunk_id, _ in self.lexical_index.search(query_text, candidates, filter_filenames)])
+            rankings.append((reciprocal_rank_fusion(ranked)[:n_results], distances))
+
+        # Chunks found only by BM25 are fetched by id
+        missing = list({chunk_id for fused, _ in rankings for chunk_id, _ in fused if chunk_id not in chunks})
+        if missing:
+            fetched = self.collection.get(ids=missing, include=["documents", "metadatas"])
+            chunks.update(zip(fetched['ids'], zip(fetched['documents'], fetched['metadatas'])))
+
+        return [
+            [
+                {
+                    "id": chunk_id,
+                    "document": chunks[chunk_id][0],
+                    "metadata": chunks[chunk_id][1],
+                    "distance": distances.get(chunk_id),
+                    "score": score,
+                }
+                for chunk_id, score in fused if chunk_id in chunks
+            ]
+            for fused, distances in rankings
+        ]
 
     def clear_collection(self):
         try:
             # Delete all items
             self.client.delete_collection("documents")
+            self.lexical_index.clear()
+            self.query_cache.clear()
             # Re-create
             self.collection = self.client.get_or_create_collection(
                 name="documents",
@@ -0,0 +1,87 @@
+"""
+Lazy access to the RAG stack. Importing chromadb/docling and loading the embedding model
+takes a long time, so RAGManager is built on first use or by a background warm-up thread
+started once the API is serving; endpoints that need it wait for it to be ready.
+"""
+
+import time
+import threading
+import traceback
+
+
+class RAGService:
+    def __init__(self, **rag_kwargs):
+        self.rag_kwargs = rag_kwargs
+        self._manager = None
+        self._error = None
+        self._lock = threading.Lock()
+        # Per-subsystem state: cold, loading, ready or error (+ seconds it took)
+        self._subsystems = {
+            "vector_store": {"state": "cold"},
+            "embedding_model": {"state": "cold"},
+            "document_converter": {"state": "cold"},
+        }
+
+    def _mark(self, name, state, started=None, error=None):
+        entry = {"state": state}
+        if started is not None:
+            entry["seconds"] = round(time.perf_counter() - started, 2)
+        if error:
+            entry["error"] = error
+        self._subsystems[name] = entry
+
+    def get(self):
+        """Returns the RAGManager, building it if needed (a failed load is retried). Blocks while it loads."""
+        if self._manager is not None:
+            return self._manager
+        with self._lock:
+            if self._manager is None:
+                self._load()
+        if self._manager is None:
+            raise RuntimeError(f"RAG no disponible: {self._error}")
+        return self._manager
+
+    def _load(self):
+        started = time.perf_counter()
+        for name in self._subsystems:
+            self._mark(name, "loading")
+        try:
+            # Heavy imports (chromadb, docling, sentence-transformers) happen here
+            from rag_manager import RAGManager
+            manager = RAGManager(**self.rag_kwargs)
+            self._mark("vector_store", "ready", started)
+            self._mark("document_converter", "ready", started)
+
+            # First inference loads the model weights; done now instead of on the first query
+            model_started = time.perf_counter()
+            manager.embedding_function.inner(["warm-up"])
+            self._mark("embedding_model", "ready", model_started)
+            self._manager = manager
+            self._error = None
+            print(f"RAG ready in {time.perf_counter() - started:.1f}s")
+        except Exception as e:
+            self._error = str(e)
+            for name, entry in self._subsystems.items():
+                if entry["state"] == "loading":
+                    self._mark(name, "error", started, error=str(e))
+            print(f"Error loading RAG: {e}")
+            traceback.print_exc()
+
+    def warm_up_in_background(self):
+        """Loads the RAG stack without blocking startup; failures are reported by status()."""
+        def warm_up():
+            with self._lock:
+                if self._manager is None:
+                    self._load()
+        threading.Thread(target=warm_up, name="rag-warmup", daemon=True).start()
+
+    @property
+    def ready(self):
+        return self._manager is not None
+
+    def status(self):
+        return {
+            "ready": self.ready,
+            "error": self._error,
+            "subsystems": {name: dict(entry) for name, entry in self._subsystems.items()},
+        }
@@ -0,0 +1,134 @@
+"""
+Persistent, content-addressed cache for sentiment scores (stored in the SQLite database).
+"""
+
+import os
+import hashlib
+import threading
+from datetime import datetime
+from sqlalchemy import select
+from database import SentimentCacheEntry
+
+DEFAULT_MAX_ENTRIES = int(os.getenv("SENTIMENT_CACHE_MAX_ENTRIES", "50000"))
+# Eviction runs every N writes instead of on every insert
+EVICTION_INTERVAL = 100
+
+
+def prompt_version(*prompts):
+    """Short hash identifying the sentiment prompts; changes whenever any prompt text changes."""
+    return hashlib.sha256("\n\x00\n".join(prompts).encode("utf-8")).hexdigest()[:16]
+
+
+class SentimentCache:
+    def __init__(self, session_factory, version, max_entries=None):
+        self.session_factory = session_factory
+        self.version = version
+        self.max_entries = max_entries or DEFAULT_MAX_ENTRIES
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._misses = 0
+        self._writes = 0
+
+    def make_key(self, model, text):
+        payload = f"{model}\n{self.version}\n{(text or '').strip()}"
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def get(self, model, text):
+        key = self.make_key(model, text)
+        db = self.session_factory()
+        try:
+            entry = db.query(SentimentCacheEntry).filter(SentimentCacheEntry.key == key).first()
+            if entry:
+                entry.last_used_at = datetime.utcnow()
+                db.commit()
+                sentiment = entry.sentiment
+            else:
+                sentiment = None
+        except Exception as e:
+            print(f"Error reading sentiment cache: {e}")
+            sentiment = None
+        finally:
+            db.close()
+
+        with self._lock:
+            if sentiment is not None:
+                self._hits += 1
+            else:
+                self._misses += 1
+        return sentiment
+
+    def put(self, model, text, sentiment):
+        if not sentiment:
+            return
+        key = self.make_key(model, text)
+        db = self.session_factory()
+        try:
+            now = datetime.utcnow()
+            db.merge(SentimentCacheEntry(
+                key=key,
+                model=model,
+                prompt_version=self.version,
+                sentiment=sentiment,
+                created_at=now,
+                last_used_at=now
+            ))
+            db.commit()
+        except Exception as e:
+            db.rollback()
+            print(f"Error writing sentiment cache: {e}")
+            return
+        finally:
+            db.close()
+
+        with self._lock:
+            self._writes += 1
+            evict = self._writes % EVICTION_INTERVAL == 0
+        if evict:
+            self.evict()
+
+    def evict(self):
+        """Drops the least recently used entries above max_entries."""
+        db = self.session_factory()
+        try:
+            count = db.query(SentimentCacheEntry).count()
+            excess = count - self.max_entries
+            if excess > 0:
+                oldest = select(SentimentCacheEntry.key).order_by(SentimentCacheEntry.last_used_at).limit(excess)
+                db.query(SentimentCacheEntry).filter(SentimentCacheEntry.key.in_(oldest)).delete(synchronize_session=False)
+                db.commit()
+                print(f"Sentiment cache: evicted {excess} entries")
+        except Exception as e:
+            db.rollback()
+            print(f"Error evicting sentiment cache: {e}")
+        finally:
+            db.close()
+
+    def invalidate_stale(self):
+        """Removes entries produced with a previous version of the sentiment prompt."""
+        db = self.session_factory()
+        try:
+            removed = db.query(SentimentCacheEntry).filter(SentimentCacheEntry.prompt_version != self.version).delete(synchronize_session=False)
+            db.commit()
+            if removed:
+                print(f"Sentiment cache: removed {removed} entries from an older prompt version")
+            return removed
+        finally:
+            db.close()
+
+    def stats(self):
+        db = self.session_factory()
+        try:
+            size = db.query(SentimentCacheEntry).count()
+        finally:
+            db.close()
+        with self._lock:
+            hits, misses = self._hits, self._misses
+        lookups = hits + misses
+        return {
+            "prompt_version": self.version,
+            "entries": size,
+            "max_entries": self.max_entries,
+            "hits": hits,
+            "misses": misses,
+            "hit_rate": round(hits / lookups, 3) if lookups else 0.0,
+        }
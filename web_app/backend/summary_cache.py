@@ -0,0 +1,106 @@
+"""
+Persistent per-interaction summary cache for the analysis endpoints (stored in the SQLite database).
+Entries are keyed by interaction id + hash of its header and messages + summarizer model, so a
+summary is only reused while the conversation and the header the model saw are unchanged.
+"""
+
+import hashlib
+import threading
+from datetime import datetime
+from database import InteractionSummary
+
+
+def messages_hash(messages, header=""):
+    """Hash of the header and (role, content) sequence a summary was produced from."""
+    digest = hashlib.sha256()
+    digest.update(f"{header}\x02".encode("utf-8"))
+    for msg in messages:
+        digest.update(f"{msg.get('role', '')}\x00{msg.get('content', '') or ''}\x01".encode("utf-8"))
+    return digest.hexdigest()
+
+
+class SummaryCache:
+    def __init__(self, session_factory, version):
+        self.session_factory = session_factory
+        # Hash of the summarizer prompt (see sentiment_cache.prompt_version)
+        self.version = version
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._misses = 0
+
+    def get(self, interaction_id, digest, model):
+        db = self.session_factory()
+        try:
+            entry = db.query(InteractionSummary).filter(
+                InteractionSummary.interaction_id == interaction_id,
+                InteractionSummary.messages_hash == digest,
+                InteractionSummary.model == model,
+                InteractionSummary.prompt_version == self.version
+            ).first()
+            summary = entry.summary if entry else None
+        except Exception as e:
+            print(f"Error reading summary cache: {e}")
+            summary = None
+        finally:
+            db.close()
+
+        with self._lock:
+            if summary is not None:
+                self._hits += 1
+            else:
+                self._misses += 1
+        return summary
+
+    def put(self, interaction_id, digest, model, summary):
+        if not summary:
+            return
+        db = self.session_factory()
+        try:
+            # Older summaries of the same interaction/model describe a previous message set
+            db.query(InteractionSummary).filter(
+                InteractionSummary.interaction_id == interaction_id,
+                InteractionSummary.model == model
+            ).delete(synchronize_session=False)
+            db.add(InteractionSummary(
+                interaction_id=interaction_id,
+                messages_hash=digest,
+                model=model,
+                prompt_version=self.version,
+                summary=summary,
+                created_at=datetime.utcnow()
+            ))
+            db.commit()
+        except Exception as e:
+            db.rollback()
+            print(f"Error writing summary cache: {e}")
+        finally:
+            db.close()
+
+    def invalidate_stale(self):
+        """Removes summaries produced with a previous version of the summarizer prompt."""
+        db = self.session_factory()
+        try:
+            removed = db.query(InteractionSummary).filter(InteractionSummary.prompt_version != self.version).delete(synchronize_session=False)
+            db.commit()
+            if removed:
+                print(f"Summary cache: removed {removed} entries from an older prompt version")
+            return removed
+        finally:
+            db.close()
+
+    def stats(self):
+        db = self.session_factory()
+        try:
+            size = db.query(InteractionSummary).count()
+        finally:
+            db.close()
+        with self._lock:
+            hits, misses = self._hits, self._misses
+        lookups = hits + misses
+        return {
+            "prompt_version": self.version,
+            "entries": size,
+            "hits": hits,
+            "misses": misses,
+            "hit_rate": round(hits / lookups, 3) if lookups else 0.0,
+        }
@@ -0,0 +1,367 @@
+"""
+Separation of internal reasoning ("thought") from the visible response.
+
+extract_thought_and_response() is the canonical parser, applied to a complete
+completion. ThoughtStreamParser is its incremental counterpart for streaming:
+it classifies chunks as they arrive into separate thought/content buffers so the
+patient-facing stream never shows reasoning, and its finish() result is exactly
+the canonical one.
+"""
+
+import html
+import re
+
+def extract_thought_and_response(text: str) -> dict:
+    """
+    Extracts thinking blocks and cleaning artifacts. 
+    Returns a dict: {'thought': str|None, 'content': str}
+    """
+    if not text:
+         return {"thought": None, "content": ""}
+         
+    text = html.unescape(text) # Handle encoded tags
+    thought = None
+    cleaned_text = text
+
+    # 1. Try standard <think> blocks first (Most reliable, handling optional spaces)
+    think_match = re.search(r"<\s*think\s*>(.*?)<\s*/\s*think\s*>", text, flags=re.DOTALL | re.IGNORECASE)
+    if think_match:
+        thought = think_match.group(1).strip()
+        # Remove the think block from the text
+        cleaned_text = re.sub(r"<\s*think\s*>.*?<\s*/\s*think\s*>", "", cleaned_text, flags=re.DOTALL | re.IGNORECASE)
+    
+    # 2. If no <think>, try <thought> blocks
+    if not thought:
+        thought_match = re.search(r"<thought>(.*?)</thought>", text, flags=re.DOTALL)
+        if thought_match:
+            thought = thought_match.group(1).strip()
+            cleaned_text = re.sub(r"<thought>.*?</thought>", "", cleaned_text, flags=re.DOTALL)
+            
+        # 3. If still no thought, check for unclosed/malformed tags
+        elif "<thought>" in text: # Unclosed <thought>
+            parts = text.split("<thought>", 1)
+            if len(parts) > 1:
+                thought = parts[1].strip()
+                cleaned_text = parts[0].strip()
+        
+        elif "<think>" in text: # Unclosed <think> (start only)
+            parts = text.split("<think>", 1)
+            if len(parts) > 1:
+                thought = parts[1].strip()
+                cleaned_text = parts[0].strip()
+        
+        elif "</think>" in text: # Unclosed </think> (end only, missing start)
+             split_match = re.split(r"</think>", text, flags=re.DOTALL, maxsplit=1)
+             if len(split_match) > 1:
+                 thought = split_match[0].strip()
+                 cleaned_text = split_match[1]
+
+    # 4. Fallback: Check for "Thought:" headers if still no thought
+    if not thought:
+         # Look for "Thought:" or "Reasoning:" at the very beginning
+         header_match = re.match(r"^(?:Thought|Reasoning|Pensamiento|Análisis):", cleaned_text, flags=re.IGNORECASE | re.MULTILINE)
+         if header_match:
+             # It starts with a header. We assume the thought goes until "Response:" or end of first paragraph/block
+             split_match = re.split(r"(?:^|\n)(?:Response|Answer|Respuesta|Contestación):", cleaned_text, flags=re.IGNORECASE)
+             if len(split_match) > 1:
+                 thought = re.sub(r"^(?:Thought|Reasoning|Pensamiento|Análisis):\s*", "", split_match[0], flags=re.IGNORECASE | re.MULTILINE).strip()
+                 cleaned_text = split_match[-1]
+             else:
+                 # If no explicit "Response:", maybe it's just one block? checking for double newline separator
+                 parts = re.split(r"\n\s*\n", cleaned_text, maxsplit=1)
+                 if len(parts) > 1:
+                     thought = re.sub(r"^(?:Thought|Reasoning|Pensamiento|Análisis):\s*", "", parts[0], flags=re.IGNORECASE | re.MULTILINE).strip()
+                     cleaned_text = parts[1]
+
+    # 5. Cleanup artifacts
+    # Remove empty thinking artifacts left over
+    cleaned_text = re.sub(r"<think>.*$", "", cleaned_text, flags=re.DOTALL)
+
+    # Remove other common reasoning markers
+    cleaned_text = re.sub(r"<\|thought\|>.*?(<\|/thought\|>|$)", "", cleaned_text, flags=re.DOTALL)
+    cleaned_text = re.sub(r"<reasoning>.*?(</reasoning>|$)", "", cleaned_text, flags=re.DOTALL)
+    
+    # Remove <|channel|>... tags
+    cleaned_text = re.sub(r"<\|.*?\|>.*?(?=\b[A-ZÁÉÍÓÚÑ]|$)", "", cleaned_text, flags=re.DOTALL) 
+    cleaned_text = re.sub(r"<\|.*?\|>", "", cleaned_text)
+    
+    # Remove <｜begin of sentence｜>Human:
+    cleaned_text = re.sub(r"<｜.*?｜>Human:", "", cleaned_text, flags=re.IGNORECASE)
+    cleaned_text = re.sub(r"<｜.*?｜>", "", cleaned_text)
+
+    # Final check: Is content empty but we have a thought?
+    final_content = cleaned_text.strip()
+    if not final_content and thought:
+        # Heuristic: The model might have been cut off or put everything in thought
+        final_content = "[El modelo generó un pensamiento interno pero no completó la respuesta externa.]"
+        
+    # FORCE DISPLAY: If no thought found, provide a placeholder so UI shows the box
+    if not thought:
+        thought = "[No se detectó razonamiento interno explícito en esta respuesta]"
+
+    return {"thought": thought, "content": final_content}
+
+
+# Markers recognised while streaming. Matching is anchored at a '<' in the buffer.
+THOUGHT_OPEN_PATTERNS = [
+    (re.compile(r"<\s*think\s*>", re.IGNORECASE), re.compile(r"<\s*/\s*think\s*>", re.IGNORECASE)),
+    (re.compile(r"<thought>"), re.compile(r"</thought>")),
+    (re.compile(r"<reasoning>"), re.compile(r"</reasoning>")),
+    (re.compile(r"<\|thought\|>"), re.compile(r"<\|/thought\|>")),
+]
+THOUGHT_CLOSE_WITHOUT_OPEN = re.compile(r"<\s*/\s*think\s*>", re.IGNORECASE)
+SPECIAL_TOKEN = re.compile(r"<\|(.*?)\|>|<｜.*?｜>")
+HEADER_START = re.compile(r"(?:Thought|Reasoning|Pensamiento|Análisis):\s*", re.IGNORECASE)
+HEADER_RESPONSE = re.compile(r"\n(?:Response|Answer|Respuesta|Contestación):\s*", re.IGNORECASE)
+HEADER_WORDS = ["thought:", "reasoning:", "pensamiento:", "análisis:"]
+RESPONSE_WORDS = ["response:", "answer:", "respuesta:", "contestación:"]
+# Longest marker we may have to wait for before deciding what a '<' starts
+MAX_MARKER_LENGTH = 40
+MAX_ENTITY_LENGTH = 10
+
+
+class ThoughtStreamParser:
+    """
+    Incremental state machine over streamed LLM output.
+
+    States:
+      - 'start': waiting to see whether the reply opens with a 'Thought:' style header
+      - 'content': visible text; tags switch to thought, special tokens are dropped
+      - 'thought': inside <think>/<thought>/<reasoning>/<|thought|> or a harmony
+        'analysis' channel, until its closing marker
+      - 'header_thought': after a 'Thought:' header, until a 'Response:' line
+
+    feed() returns a list of (event, text) tuples with event in 'thought', 'token'
+    or 'reset'. 'reset' means the content streamed so far was actually reasoning
+    (a '</think>' arrived without its opening tag) and has been moved to the thought
+    buffer; the moved text follows as a 'thought' event. flush() may also end with a
+    'reset' followed by the canonical thought and content, when the canonical parse
+    classifies streamed content as reasoning (header fallback).
+    """
+
+    def __init__(self):
+        self.state = "start"
+        self.pending = ""
+        self.escaped = ""
+        self.raw_parts = []
+        self.thought_buffer = []
+        self.content_buffer = []
+        self.close_pattern = None
+        self.argument_token = None
+        self.token_argument = None
+
+    @property
+    def thought_text(self):
+        return "".join(self.thought_buffer)
+
+    @property
+    def content_text(self):
+        return "".join(self.content_buffer)
+
+    def feed(self, chunk):
+        if not chunk:
+            return []
+        self.raw_parts.append(chunk)
+        self.escaped += chunk
+        # Decode HTML entities (&lt;think&gt;), keeping a possibly incomplete one for the next chunk
+        amp = self.escaped.rfind("&")
+        if amp != -1 and ";" not in self.escaped[amp:] and len(self.escaped) - amp < MAX_ENTITY_LENGTH:
+            ready, self.escaped = self.escaped[:amp], self.escaped[amp:]
+        else:
+            ready, self.escaped = self.escaped, ""
+        self.pending += html.unescape(ready)
+        events = []
+        self._process(events, final=False)
+        return events
+
+    def flush(self):
+        """Classifies whatever is still held back (end of stream)."""
+        events = []
+        self.pending += html.unescape(self.escaped)
+        self.escaped = ""
+        self._process(events, final=True)
+        if self.pending:
+            self._emit(events, "thought" if self.state in ("thought", "header_thought") else "token", self.pending)
+            self.pending = ""
+        self._reconcile(events)
+        return events
+
+    def _reconcile(self, events):
+        """
+        Corrects the stream when the canonical parse found reasoning in text already streamed
+        as content (e.g. a 'Thought:' header after an empty think block): 'reset', then the
+        canonical thought and content, so the answer bubble never keeps reasoning until 'done'.
+        """
+        final = self.finish()
+        thought = final["thought"] or ""
+        if not thought or thought.startswith("[") or thought.strip() in self.thought_text:
+            return
+        content = "" if final["content"].startswith("[") else final["content"]
+        if self.content_text.strip() == content.strip():
+            return
+        self.content_buffer = []
+        events.append(("reset", ""))
+        self._emit(events, "thought", thought)
+        self._emit(events, "token", content)
+
+    def finish(self):
+        """Final {'thought', 'content'} result, identical to extract_thought_and_response."""
+        return extract_thought_and_response("".join(self.raw_parts))
+
+    def _emit(self, events, event, text):
+        if not text:
+            return
+        if event == "thought":
+            self.thought_buffer.append(text)
+        else:
+            self.content_buffer.append(text)
+        if events and events[-1][0] == event:
+            events[-1] = (event, events[-1][1] + text)
+        else:
+            events.append((event, text))
+
+    def _process(self, events, final):
+        while self.pending:
+            if self.state == "start":
+                if not self._process_start(final):
+                    return
+            elif self.state == "content":
+                if not self._process_content(events, final):
+                    return
+            elif self.state == "thought":
+                if not self._process_thought(events, final):
+                    return
+            else:
+                if not self._process_header_thought(events, final):
+                    return
+
+    # Each _process_* returns True when it consumed something and the loop should continue
+
+    def _process_start(self, final):
+        match = HEADER_START.match(self.pending)
+        if match and (final or match.end() < len(self.pending)):
+            self.pending = self.pending[match.end():]
+            self.state = "header_thought"
+            return True
+        lowered = self.pending.lower()
+        if not final and any(word.startswith(lowered) or lowered.startswith(word) for word in HEADER_WORDS):
+            # Could still become a header (or a header followed only by whitespace so far)
+            return False
+        self.state = "content"
+        return True
+
+    def _process_content(self, events, final):
+        idx = self.pending.find("<")
+        if self.token_argument is not None:
+            # Argument of a harmony token (<|start|>assistant, <|channel|>final) is never shown
+            if idx == -1:
+                self.token_argument += self.pending
+                self.pending = ""
+                return False
+            self.token_argument += self.pending[:idx]
+            self.pending = self.pending[idx:]
+            idx = 0
+        if idx == -1:
+            self._emit(events, "token", self.pending)
+            self.pending = ""
+            return False
+        if idx > 0:
+            self._emit(events, "token", self.pending[:idx])
+            self.pending = self.pending[idx:]
+
+        for open_pattern, close_pattern in THOUGHT_OPEN_PATTERNS:
+            match = open_pattern.match(self.pending)
+            if match:
+                self.pending = self.pending[match.end():]
+                self.close_pattern = close_pattern
+                self.state = "thought"
+                return True
+
+        match = THOUGHT_CLOSE_WITHOUT_OPEN.match(self.pending)
+        if match:
+            # Reasoning without its opening tag: everything shown so far was thought
+            moved = self.content_text
+            self.content_buffer = []
+            events.append(("reset", ""))
+            self._emit(events, "thought", moved)
+            self.pending = self.pending[match.end():]
+            return True
+
+        match = SPECIAL_TOKEN.match(self.pending)
+        if match:
+            token_name = (match.group(1) or "").strip().lower()
+            self.pending = self.pending[match.end():]
+            if token_name == "message" and self.argument_token == "channel":
+                if self.token_argument.strip().lower().startswith(("analysis", "commentary")):
+                    # Harmony reasoning channel: thought until the next special token
+                    self.close_pattern = None
+                    self.state = "thought"
+            if token_name in ("start", "channel"):
+                self.argument_token = token_name
+                self.token_argument = ""
+            else:
+                self.argument_token = None
+                self.token_argument = None
+            return True
+
+        if not final and len(self.pending) < MAX_MARKER_LENGTH and ">" not in self.pending:
+            # Possibly a marker split across chunks
+            return False
+
+        self._emit(events, "token", "<")
+        self.pending = self.pending[1:]
+        return True
+
+    def _process_thought(self, events, final):
+        if self.close_pattern is None:
+            # Harmony channel content ends at the next special token
+            idx = self.pending.find("<|")
+            if idx != -1:
+                self._emit(events, "thought", self.pending[:idx])
+                self.pending = self.pending[idx:]
+                self.state = "content"
+                return True
+        else:
+            match = self.close_pattern.search(self.pending)
+            if match:
+                self._emit(events, "thought", self.pending[:match.start()])
+                self.pending = self.pending[match.end():]
+                self.close_pattern = None
+                self.state = "content"
+                return True
+
+        hold = 0 if final else self._partial_marker_length()
+        self._emit(events, "thought", self.pending[:len(self.pending) - hold])
+        self.pending = self.pending[len(self.pending) - hold:]
+        return False
+
+    def _process_header_thought(self, events, final):
+        match = HEADER_RESPONSE.search(self.pending)
+        if match and not final and match.end() == len(self.pending):
+            # More whitespace after the 'Response:' marker may follow
+            self._emit(events, "thought", self.pending[:match.start()])
+            self.pending = self.pending[match.start():]
+            return False
+        if match:
+            self._emit(events, "thought", self.pending[:match.start()])
+            self.pending = self.pending[match.end():]
+            self.state = "content"
+            return True
+
+        hold = 0
+        if not final:
+            newline = self.pending.rfind("\n")
+            if newline != -1:
+                tail = self.pending[newline + 1:].lower()
+                if any(word.startswith(tail) or tail.startswith(word) for word in RESPONSE_WORDS):
+                    hold = len(self.pending) - newline
+        self._emit(events, "thought", self.pending[:len(self.pending) - hold])
+        self.pending = self.pending[len(self.pending) - hold:]
+        return False
+
+    def _partial_marker_length(self):
+        """Length of a trailing '<...' that may be the start of a closing marker."""
+        idx = self.pending.rfind("<")
+        if idx == -1 or ">" in self.pending[idx:] or len(self.pending) - idx >= MAX_MARKER_LENGTH:
+            return 0
+        return len(self.pending) - idx
@@ -30,15 +30,28 @@ SOBRE EL PASO DE LOS DÍAS:
 - Si la charla sigue otro día, actuá como si hubiera pasado un día entero.
 - Contá qué pasó con la medicación en ese lapso.`;
 
+const INGESTION_STATE_LABELS = {
+    queued: 'En cola',
+    converting: 'Convirtiendo',
+    chunking: 'Fragmentando',
+    embedding: 'Generando embeddings',
+    done: 'Listo',
+    failed: 'Error'
+};
+
 function App() {
     const [view, setView] = useState('setup'); // setup, chat, history
     const [currentInteractionFilename, setCurrentInteractionFilename] = useState(null);
+    // Messages the server holds for currentInteractionFilename (as sent to /api/save_interaction)
+    const [savedMessages, setSavedMessages] = useState(null);
     const [messages, setMessages] = useState([]);
     const [input, setInput] = useState('');
     const [loading, setLoading] = useState(false);
     const [suggestedReply, setSuggestedReply] = useState('');
     const [models, setModels] = useState([]);
     const [interactions, setInteractions] = useState([]);
+    const [interactionsCursor, setInteractionsCursor] = useState(null);
+    const [interactionFacets, setInteractionFacets] = useState({ patient_names: [], chatbot_models: [], patient_models: [] });
     const [selectedInteraction, setSelectedInteraction] = useState(null);
     const [isGeneratingPDF, setIsGeneratingPDF] = useState(false);
 
@@ -58,6 +71,7 @@ function App() {
     const [documents, setDocuments] = useState([]);
     const [selectedDocumentIds, setSelectedDocumentIds] = useState(new Set());
     const [ragDocumentIds, setRagDocumentIds] = useState(new Set());
+    const [ingestionJob, setIngestionJob] = useState(null);
     const [soloMode, setSoloMode] = useState(false);
 
     // Filter states
@@ -154,18 +168,38 @@ function App() {
 
 
 
-    const fetchInteractions = async () => {
+    const fetchInteractions = async (cursor = null) => {
         try {
-            const res = await fetch('http://localhost:8000/api/interactions');
+            // Paginated listing: filters are applied server-side
+            const params = new URLSearchParams({ limit: '50' });
+            if (cursor) params.set('cursor', cursor);
+            if (filterPatientName) params.set('patient_name', filterPatientName);
+            if (filterChatbotModel) params.set('chatbot_model', filterChatbotModel);
+            if (filterPatientModel) params.set('patient_model', filterPatientModel);
+
+            const res = await fetch(`http://localhost:8000/api/interactions?${params.toString()}`);
             if (res.ok) {
                 const data = await res.json();
-                setInteractions(data);
+                setInteractions(prev => cursor ? [...prev, ...data.items] : data.items);
+                setInteractionsCursor(data.next_cursor);
             }
         } catch (error) {
             console.error("Error fetching interactions:", error);
         }
     };
 
+    const fetchInteractionFacets = async () => {
+        try {
+            const res = await fetch('http://localhost:8000/api/interaction_facets');
+            if (res.ok) {
+                const data = await res.json();
+                setInteractionFacets(data);
+            }
+        } catch (error) {
+            console.error("Error fetching interaction facets:", error);
+        }
+    };
+
     const fetchDocuments = async () => {
         try {
             const res = await fetch('http://localhost:8000/api/documents');
@@ -182,7 +216,7 @@ function App() {
     };
 
     const handleReindex = async () => {
-        if (!confirm("Esto borrará la base de datos y re-indexará todos los documentos con la configuración actual. ¿Continuar?")) return;
+        if (!confirm("Esto re-indexará los documentos nuevos o modificados (y los afectados por un cambio de configuración) con la configuración actual. ¿Continuar?")) return;
 
         try {
             const res = await fetch('http://localhost:8000/api/reindex_documents', {
@@ -275,11 +309,19 @@ function App() {
     // eslint-disable-next-line react-hooks/exhaustive-deps
     useEffect(() => {
         if (view === 'history') {
-            fetchInteractions();
+            fetchInteractionFacets();
             fetchDocuments();
         }
     }, [view]);
 
+    // eslint-disable-next-line react-hooks/exhaustive-deps
+    useEffect(() => {
+        if (view === 'history') {
+            fetchInteractions();
+        }
+        // eslint-disable-next-line react-hooks/exhaustive-deps
+    }, [view, filterPatientName, filterChatbotModel, filterPatientModel]);
+
     // eslint-disable-next-line react-hooks/exhaustive-deps
     useEffect(() => {
         scrollToBottom();
@@ -356,6 +398,7 @@ function App() {
         }
         setMessages([]); // Clear previous chat history
         setCurrentInteractionFilename(null); // Ensure fresh start
+        setSavedMessages(null);
         setCurrentInteractionTitle(null);
         setView('chat');
         // No longer auto-generate initial suggestion - user will click button when ready
@@ -377,28 +420,41 @@ function App() {
     const performEndSession = () => {
         setMessages([]);
         setCurrentInteractionFilename(null);
+        setSavedMessages(null);
         setView('setup');
         setShowExitConfirmation(false);
     };
 
     const [notification, setNotification] = useState(null);
 
+    const toSavedMessage = (msg) => ({
+        role: msg.role,
+        content: msg.content,
+        thought: msg.thought,
+        suggested_reply_used: msg.role === 'user' ? msg.suggested_reply_used : undefined
+    });
+
     const saveInteraction = async (asNew = false) => {
         // Handle event object if passed directly
         if (typeof asNew !== 'boolean') asNew = false;
 
+        const messagesToSave = messages.map(toSavedMessage);
         const interactionData = {
             timestamp: new Date().toISOString(),
             config: config,
-            messages: messages.map(msg => ({
-                role: msg.role,
-                content: msg.content,
-                thought: msg.thought,
-                suggested_reply_used: msg.role === 'user' ? msg.suggested_reply_used : undefined
-            })),
+            messages: messagesToSave,
             filename: asNew ? null : currentInteractionFilename
         };
 
+        // Delta save when the loaded messages are untouched: only the new ones are sent, and the
+        // server answers 409 if the interaction changed since it was loaded
+        const sameMessage = (a, b) => a.role === b.role && a.content === b.content && (a.thought || null) === (b.thought || null);
+        if (!asNew && currentInteractionFilename && savedMessages && savedMessages.length <= messagesToSave.length
+            && savedMessages.every((msg, i) => sameMessage(msg, messagesToSave[i]))) {
+            interactionData.known_message_count = savedMessages.length;
+            interactionData.messages = messagesToSave.slice(savedMessages.length);
+        }
+
         try {
             const res = await fetch('http://localhost:8000/api/save_interaction', {
                 method: 'POST',
@@ -406,6 +462,17 @@ function App() {
                 body: JSON.stringify(interactionData)
             });
 
+            if (res.status === 409) {
+                if (window.confirm("La interacción fue modificada desde otra ventana desde que la abriste.\n\nAceptar: recargar la versión guardada (se pierden los mensajes nuevos de esta sesión).\nCancelar: guardar esta sesión como una nueva rama.")) {
+                    await handleContinueInteraction(currentInteractionFilename);
+                    setNotification({ type: 'success', message: 'Interacción recargada desde el servidor.' });
+                    setTimeout(() => setNotification(null), 3000);
+                } else {
+                    await saveInteraction(true);
+                }
+                return;
+            }
+
             if (res.ok) {
                 const data = await res.json();
                 setCurrentInteractionFilename(data.filename);
@@ -414,11 +481,13 @@ function App() {
 
                 if (asNew) {
                     // Fork: Stay in chat
+                    setSavedMessages(messagesToSave);
                     setNotification({ type: 'success', message: `${actionMsg}. Seguimos en la copia.` });
                 } else {
                     // Save (Update): Exit to home
                     setMessages([]);
                     setCurrentInteractionFilename(null);
+                    setSavedMessages(null);
                     setView('setup');
                     setNotification({ type: 'success', message: `${actionMsg}. Volviendo al inicio.` });
                 }
@@ -461,14 +530,16 @@ function App() {
         setSuggestedReply('');
         setLoading('psychologist');
 
+        const botId = `${msgId}_bot`;
+
         try {
             // Filter out 'episode' and 'system' messages for psychologist - they only know what patient tells them
             const history = messages
                 .filter(m => m.role !== 'system' && m.role !== 'episode')
                 .map(m => ({ role: m.role, content: m.content }));
 
-            // Step 1: Get Psychologist Response
-            const res = await fetch('http://localhost:8000/api/chat', {
+            // Step 1: Stream Psychologist Response (Server-Sent Events)
+            const res = await fetch('http://localhost:8000/api/chat_stream', {
                 method: 'POST',
                 headers: { 'Content-Type': 'application/json' },
                 body: JSON.stringify({
@@ -488,11 +559,45 @@ function App() {
                 })
             });
 
-            if (!res.ok) throw new Error('Error al obtener respuesta');
-            const data = await res.json();
-
-            const botMsg = { role: 'assistant', content: data.response, thought: data.thought };
-            setMessages(prev => [...prev, botMsg]);
+            if (!res.ok || !res.body) throw new Error('Error al obtener respuesta');
+
+            // Show the reply as it is generated; the 'done' event carries the final {response, thought}
+            setMessages(prev => [...prev, { id: botId, role: 'assistant', content: '', thought: '' }]);
+            const updateBotMsg = (patch) =>
+                setMessages(prev => prev.map(m => (m.id === botId ? { ...m, ...patch(m) } : m)));
+
+            const reader = res.body.getReader();
+            const decoder = new TextDecoder();
+            let buffer = '';
+            let finished = false;
+            while (!finished) {
+                const { value, done } = await reader.read();
+                if (done) break;
+                buffer += decoder.decode(value, { stream: true });
+                const rawEvents = buffer.split('\n\n');
+                buffer = rawEvents.pop();
+                for (const rawEvent of rawEvents) {
+                    const lines = rawEvent.split('\n');
+                    const eventLine = lines.find(l => l.startsWith('event:'));
+                    const dataLine = lines.find(l => l.startsWith('data:'));
+                    if (!eventLine || !dataLine) continue;
+                    const eventName = eventLine.slice(6).trim();
+                    const data = JSON.parse(dataLine.slice(5));
+                    if (eventName === 'token') {
+                        updateBotMsg(m => ({ content: m.content + data.text }));
+                    } else if (eventName === 'reset') {
+                        updateBotMsg(() => ({ content: '' }));
+                    } else if (eventName === 'thought') {
+                        updateBotMsg(m => ({ thought: (m.thought || '') + data.text }));
+                    } else if (eventName === 'done') {
+                        updateBotMsg(() => ({ content: data.response, thought: data.thought }));
+                        finished = true;
+                    } else if (eventName === 'error') {
+                        throw new Error(data.detail);
+                    }
+                }
+            }
+            if (!finished) throw new Error('Respuesta incompleta del servidor');
 
             // Step 2: Trigger Sentiment Analysis for the USER message (Patient)
             console.log("Iniciando análisis de sentimiento para mensaje:", msgId);
@@ -550,7 +655,7 @@ function App() {
 
         } catch (error) {
             console.error("Error in chat flow:", error);
-            setMessages(prev => [...prev, { role: 'assistant', content: "Error: No se pudo obtener respuesta del modelo." }]);
+            setMessages(prev => [...prev.filter(m => m.id !== botId), { role: 'assistant', content: "Error: No se pudo obtener respuesta del modelo." }]);
         } finally {
             setLoading(false);
         }
@@ -795,6 +900,19 @@ El paciente debe actuar naturalmente, como si realmente hubiera pasado un día,
                 const newSelected = new Set(ragDocumentIds);
                 data.filenames.forEach(f => newSelected.add(f));
                 setRagDocumentIds(newSelected);
+
+                // Indexing runs in the background: follow the job's progress
+                const source = new EventSource(`http://localhost:8000/api/jobs/${data.job_id}/events`);
+                source.addEventListener('progress', (e) => setIngestionJob(JSON.parse(e.data)));
+                source.addEventListener('done', (e) => {
+                    const job = JSON.parse(e.data);
+                    setIngestionJob(job);
+                    source.close();
+                    if (job.failed > 0) {
+                        alert(`${job.failed} documento(s) no se pudieron indexar.`);
+                    }
+                });
+                source.onerror = () => source.close();
             } else {
                 alert("Error al subir documentos");
             }
@@ -1343,6 +1461,20 @@ El paciente NO debe mencionar que "pasó tiempo" explícitamente, solo debe comp
                                             <BrainCircuit size={16} /> Re-indexar Todos los Documentos
                                         </button>
 
+                                        {ingestionJob && ingestionJob.status !== 'finished' && (
+                                            <div style={{ padding: '0.75rem', background: '#2a2a2a', borderRadius: '4px', marginBottom: '1rem', fontSize: '0.85rem' }}>
+                                                <div style={{ marginBottom: '0.5rem' }}>
+                                                    Indexando documentos: {ingestionJob.done + ingestionJob.failed}/{ingestionJob.total}
+                                                </div>
+                                                {ingestionJob.files.map(f => (
+                                                    <div key={f.filename} style={{ display: 'flex', justifyContent: 'space-between', gap: '0.5rem', color: 'var(--text-secondary)' }}>
+                                                        <span style={{ overflow: 'hidden', textOverflow: 'ellipsis', whiteSpace: 'nowrap' }}>{f.filename}</span>
+                                                        <span>{INGESTION_STATE_LABELS[f.state] || f.state}</span>
+                                                    </div>
+                                                ))}
+                                            </div>
+                                        )}
+
                                         <div className="documents-list">
                                             {documents.map(doc => (
                                                 <div
@@ -1990,6 +2122,7 @@ El paciente NO debe mencionar que "pasó tiempo" explícitamente, solo debe comp
                 if (currentInteractionFilename === filename) {
                     setMessages([]);
                     setCurrentInteractionFilename(null);
+                    setSavedMessages(null);
                     setView('setup');
                 }
 
@@ -2097,6 +2230,7 @@ El paciente NO debe mencionar que "pasó tiempo" explícitamente, solo debe comp
             if (res.ok) {
                 const fullInteraction = await res.json();
                 setMessages(fullInteraction.messages);
+                setSavedMessages(fullInteraction.messages.map(toSavedMessage));
                 setConfig(prev => ({
                     ...prev,
                     ...fullInteraction.config
@@ -2371,7 +2505,7 @@ El paciente NO debe mencionar que "pasó tiempo" explícitamente, solo debe comp
                                 style={{ padding: '0.5rem', borderRadius: '4px', background: '#222', color: '#fff', border: '1px solid #444', minWidth: '150px' }}
                             >
                                 <option value="">Todos los Pacientes</option>
-                                {[...new Set(interactions.map(i => i.patient_name))].filter(Boolean).sort().map(name => (
+                                {interactionFacets.patient_names.map(name => (
                                     <option key={name} value={name}>{name}</option>
                                 ))}
                             </select>
@@ -2386,7 +2520,7 @@ El paciente NO debe mencionar que "pasó tiempo" explícitamente, solo debe comp
                                 style={{ padding: '0.5rem', borderRadius: '4px', background: '#222', color: '#fff', border: '1px solid #444', minWidth: '150px' }}
                             >
                                 <option value="">Todos los Modelos</option>
-                                {[...new Set(interactions.map(i => i.chatbot_model))].filter(Boolean).sort().map(model => (
+                                {interactionFacets.chatbot_models.map(model => (
                                     <option key={model} value={model}>{model}</option>
                                 ))}
                             </select>
@@ -2401,7 +2535,7 @@ El paciente NO debe mencionar que "pasó tiempo" explícitamente, solo debe comp
                                 style={{ padding: '0.5rem', borderRadius: '4px', background: '#222', color: '#fff', border: '1px solid #444', minWidth: '150px' }}
                             >
                                 <option value="">Todos los Modelos</option>
-                                {[...new Set(interactions.map(i => i.patient_model))].filter(Boolean).sort().map(model => (
+                                {interactionFacets.patient_models.map(model => (
                                     <option key={model} value={model}>{model}</option>
                                 ))}
                             </select>
@@ -2511,6 +2645,13 @@ El paciente NO debe mencionar que "pasó tiempo" explícitamente, solo debe comp
                                     ))}
                             </div>
                         )}
+                        {interactionsCursor && (
+                            <div style={{ display: 'flex', justifyContent: 'center', marginTop: '1.5rem' }}>
+                                <button className="btn-secondary" onClick={() => fetchInteractions(interactionsCursor)}>
+                                    Cargar más
+                                </button>
+                            </div>
+                        )}
                     </div>
 
 